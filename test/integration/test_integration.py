@@ -1,9 +1,11 @@
+import base64
 import datetime
 import hashlib
 import os
 import shutil
 import socket
 import sys
+import time
 
 import pytest
 
@@ -20,11 +22,13 @@ from vcdriver.vm import (
     VirtualMachine,
     virtual_machines,
     snapshot,
-    get_all_virtual_machines
+    get_all_virtual_machines,
+    iter_virtual_machines
 )
 from vcdriver.folder import destroy_virtual_machines
 from vcdriver.config import load
 from vcdriver.helpers import timeout_loop
+from vcdriver.transfer import base64_chunks
 
 
 def touch(file_name):
@@ -123,6 +127,41 @@ def test_ssh_upload_and_ssh_download(files, vms):
         vms['unix'].ssh_upload(local_path='dir-0', remote_path='wrong-path')
 
 
+def test_ssh_archive_upload_and_download(files, vms):
+    for compress in (False, True):
+        result = vms['unix'].ssh_upload(
+            local_path='dir-0', remote_path='archive', archive=True,
+            compress=compress
+        )
+        assert len(result) == 3
+        assert result.throughput > 0
+        shutil.rmtree('dir-0')
+        result = vms['unix'].ssh_download(
+            local_path='.', remote_path='archive/dir-0', archive=True,
+            compress=compress
+        )
+        assert len(result) == 3
+        assert os.path.isfile(os.path.join('dir-0', 'dir-1', 'file-2'))
+    with pytest.raises(DownloadError):
+        vms['unix'].ssh_download(
+            local_path='.', remote_path='wrong-path', archive=True
+        )
+
+
+def test_ssh_sync_upload(files, vms):
+    assert len(vms['unix'].ssh_upload(
+        local_path='dir-0', remote_path='sync', sync=True
+    )) == 3
+    assert len(vms['unix'].ssh_upload(
+        local_path='dir-0', remote_path='sync', sync=True
+    )) == 0
+    with open(os.path.join('dir-0', 'file-1'), 'wb') as f:
+        f.write(b'changed')
+    assert vms['unix'].ssh_upload(
+        local_path='dir-0', remote_path='sync', sync=True
+    ) == ['sync/dir-0/file-1']
+
+
 def test_winrm(vms):
     vms['windows'].winrm('ipconfig /all')
     with pytest.raises(WinRmError):
@@ -147,12 +186,111 @@ def test_winrm_upload(files, vms):
         assert expected_sha256 == str(resulted_sha256.strip())
 
 
+def test_winrm_upload_parallel_benchmark(vms):
+    with open('image', 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+    with open('image', 'rb') as f:
+        expected_sha256 = hashlib.sha256(f.read()).hexdigest().upper()
+    try:
+        for parallel in (1, 2, 4, 8):
+            result = vms['windows'].winrm_upload(
+                local_path='image', remote_path='C:\\image', step=2048,
+                parallel=parallel, quiet=True
+            )
+            print('WinRM upload with {} shells: {:.2f} KB/s'.format(
+                parallel, result.throughput / 1024
+            ))
+            _, resulted_sha256, _ = vms['windows'].winrm(
+                '$(Get-FileHash -Algorithm SHA256 C:\\image).hash',
+                quiet=True
+            )
+            assert expected_sha256 == str(resulted_sha256.strip())
+    finally:
+        os.remove('image')
+
+
+def test_base64_chunks_benchmark():
+    tracemalloc = pytest.importorskip('tracemalloc')
+    megabytes = 64
+    with open('image', 'wb') as f:
+        f.write(os.urandom(megabytes * 1024 * 1024))
+
+    def read_chunks():
+        with open('image', 'rb') as f:
+            for _ in iter(lambda: f.read(2048), b''):
+                pass
+
+    def read_base64_chunks():
+        with open('image', 'rb') as f:
+            for chunk in iter(lambda: f.read(2048), b''):
+                base64.b64encode(chunk).decode()
+
+    def mapped_base64_chunks():
+        for _ in base64_chunks('image', 2048):
+            pass
+
+    try:
+        for description, func in (
+                ('read', read_chunks),
+                ('read + base64', read_base64_chunks),
+                ('mmap + base64', mapped_base64_chunks),
+        ):
+            tracemalloc.start()
+            start = time.time()
+            func()
+            seconds = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('{}: {:.2f} MB/s, {:.2f} KB peak per MB'.format(
+                description, megabytes / seconds, peak / 1024.0 / megabytes
+            ))
+    finally:
+        os.remove('image')
+
+
+def test_winrm_download(files, vms):
+    vms['windows'].winrm(
+        '[System.IO.File]::WriteAllBytes("C:\\file-1", [byte[]](1..200))'
+    )
+    digest = vms['windows'].winrm_download(
+        remote_path='C:\\file-1', local_path='file-1', step=64
+    )
+    expected = bytes(bytearray(range(1, 201)))
+    with open('file-1', 'rb') as f:
+        assert f.read() == expected
+    assert digest == hashlib.sha256(expected).hexdigest()
+    os.remove('file-1')
+
+
 def test_get_all_virtual_machines(vms):
     vm_names = [vm.name for vm in get_all_virtual_machines()]
     assert vms['unix'].name in vm_names
     assert vms['windows'].name in vm_names
 
 
+def test_iter_virtual_machines_benchmark(vms):
+    tracemalloc = pytest.importorskip('tracemalloc')
+    for description, func in (
+            ('get_all_virtual_machines', lambda: [
+                vm.name for vm in get_all_virtual_machines()
+            ]),
+            ('iter_virtual_machines', lambda: [
+                record.name for record in iter_virtual_machines()
+            ]),
+    ):
+        tracemalloc.start()
+        start = time.time()
+        vm_names = func()
+        seconds = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{}: {} virtual machines in {:.2f}s, {:.2f} KB peak'.format(
+            description, len(vm_names), seconds, peak / 1024.0
+        ))
+        assert vms['unix'].name in vm_names
+        assert vms['windows'].name in vm_names
+
+
 def test_boot_methods(vms):
     for vm in vms.values():
         vm_object = vm._vm_object
@@ -104,7 +104,8 @@ def test_read(config_files):
             'vcdriver_port': '443',
             'vcdriver_username': '',
             'vcdriver_password': '',
-            'vcdriver_idle_timeout': '7200'
+            'vcdriver_idle_timeout': '7200',
+            'vcdriver_session_file': ''
         },
         'Virtual Machine Deployment': {
             'vcdriver_resource_pool': '',
@@ -116,7 +117,9 @@ def test_read(config_files):
             'vcdriver_vm_ssh_username': '',
             'vcdriver_vm_ssh_password': '',
             'vcdriver_vm_winrm_username': '',
-            'vcdriver_vm_winrm_password': ''
+            'vcdriver_vm_winrm_password': '',
+            'vcdriver_vm_guest_username': '',
+            'vcdriver_vm_guest_password': ''
         }
     }
     load('config_file_3.cfg')
@@ -126,7 +129,8 @@ def test_read(config_files):
             'vcdriver_port': '443',
             'vcdriver_username': '',
             'vcdriver_password': 'myway',
-            'vcdriver_idle_timeout': '7200'
+            'vcdriver_idle_timeout': '7200',
+            'vcdriver_session_file': ''
         },
         'Virtual Machine Deployment': {
             'vcdriver_resource_pool': '',
@@ -138,7 +142,9 @@ def test_read(config_files):
             'vcdriver_vm_ssh_username': '',
             'vcdriver_vm_ssh_password': '',
             'vcdriver_vm_winrm_username': '',
-            'vcdriver_vm_winrm_password': ''
+            'vcdriver_vm_winrm_password': '',
+            'vcdriver_vm_guest_username': '',
+            'vcdriver_vm_guest_password': ''
         }
     }
 
@@ -1,3 +1,5 @@
+import itertools
+
 import mock
 import pytest
 from pyVmomi import vim, vmodl
@@ -7,15 +9,31 @@ from vcdriver.exceptions import (
     TooManyObjectsFound,
     TimeoutError,
     IpError,
+    WinRmError,
 )
 from vcdriver.helpers import (
+    container_view,
+    destroy_container_views,
     get_all_vcenter_objects,
+    get_vcenter_object_by_id,
+    get_vcenter_object_by_inventory_path,
     get_vcenter_object_by_name,
+    get_vcenter_parents,
+    get_vcenter_property,
+    get_virtual_machine_by_dns_name,
+    get_virtual_machine_by_ip,
+    get_virtual_machine_by_uuid,
+    iter_vcenter_properties,
     timeout_loop,
     validate_ip,
     validate_ipv4,
     validate_ipv6,
     wait_for_vcenter_task,
+    wait_for_vcenter_tasks,
+    powershell_quote,
+    print_progress,
+    winrm_shell,
+    winrm_stdin_script,
 )
 
 
@@ -35,6 +53,101 @@ def test_all_vcenter_objects():
     ]
 
 
+def properties_page(objects, token=None):
+    page = mock.MagicMock()
+    page.token = token
+    page.objects = []
+    for obj, properties in objects:
+        object_content = mock.MagicMock()
+        object_content.obj = obj
+        object_content.propSet = []
+        for name, val in properties.items():
+            prop = mock.MagicMock()
+            prop.name, prop.val = name, val
+            object_content.propSet.append(prop)
+        page.objects.append(object_content)
+    return page
+
+
+def test_get_vcenter_property():
+    stub = mock.MagicMock()
+    vm = vim.VirtualMachine('vm-1', stub)
+    prop = mock.MagicMock()
+    prop.val = 'poweredOn'
+    stub.InvokeMethod.return_value.objects = [mock.MagicMock(propSet=[prop])]
+    assert get_vcenter_property(vm, 'runtime.powerState') == 'poweredOn'
+    collector, _, (specs, _) = stub.InvokeMethod.call_args[0]
+    assert collector._moId == 'propertyCollector'
+    assert specs[0].objectSet[0].obj is vm
+    assert specs[0].propSet[0].pathSet == ['runtime.powerState']
+    stub.InvokeMethod.return_value.objects = [mock.MagicMock(propSet=[])]
+    assert get_vcenter_property(vm, 'runtime.powerState') is None
+    stub.InvokeMethod.return_value = None
+    assert get_vcenter_property(vm, 'runtime.powerState') is None
+
+
+@mock.patch('vcdriver.helpers.container_view')
+def test_iter_vcenter_properties(container_view):
+    container_view.return_value.__enter__.return_value = (
+        vim.view.ContainerView('session[x]view', None)
+    )
+    connection_mock = mock.MagicMock()
+    collector = connection_mock.RetrieveContent.return_value.propertyCollector
+    collector.RetrievePropertiesEx.return_value = properties_page(
+        [('vm1', {'name': 'one', 'runtime.powerState': 'poweredOn'})], '1'
+    )
+    collector.ContinueRetrievePropertiesEx.return_value = properties_page(
+        [('vm2', {'name': 'two'}), ('vm3', {'name': 'three'})]
+    )
+    assert list(iter_vcenter_properties(
+        connection_mock, vim.VirtualMachine, ['name', 'runtime.powerState'],
+        page_size=1
+    )) == [
+        ('vm1', ['one', 'poweredOn']),
+        ('vm2', ['two', None]),
+        ('vm3', ['three', None])
+    ]
+    collector.ContinueRetrievePropertiesEx.assert_called_once_with('1')
+    assert collector.RetrievePropertiesEx.call_args[0][1].maxObjects == 1
+    assert not collector.CancelRetrievePropertiesEx.called
+    objects = iter_vcenter_properties(
+        connection_mock, vim.VirtualMachine, ['name']
+    )
+    assert next(objects) == ('vm1', ['one'])
+    assert container_view.return_value.__exit__.call_count == 1
+    objects.close()
+    collector.CancelRetrievePropertiesEx.assert_called_once_with('1')
+    assert container_view.return_value.__exit__.call_count == 2
+    container_view.assert_called_with(
+        connection_mock, vim.VirtualMachine, None
+    )
+
+
+@mock.patch('vcdriver.helpers.container_view')
+@mock.patch('vcdriver.helpers.inventory_mirror')
+def test_iter_vcenter_properties_mirror(inventory_mirror, container_view):
+    container_view.return_value.__enter__.return_value = (
+        vim.view.ContainerView('session[x]view', None)
+    )
+    mirror = inventory_mirror.return_value
+    mirror.properties = {vim.VirtualMachine: ['name', 'runtime.powerState']}
+    mirror.get_all_properties.return_value = [('vm1', ['one'])]
+    connection_mock = mock.MagicMock()
+    assert list(iter_vcenter_properties(
+        connection_mock, vim.VirtualMachine, ['name']
+    )) == [('vm1', ['one'])]
+    mirror.get_all_properties.assert_called_once_with(
+        vim.VirtualMachine, ['name']
+    )
+    assert not connection_mock.RetrieveContent.called
+    collector = connection_mock.RetrieveContent.return_value.propertyCollector
+    collector.RetrievePropertiesEx.return_value = None
+    assert list(iter_vcenter_properties(
+        connection_mock, vim.VirtualMachine, ['guest.ipAddress']
+    )) == []
+    assert container_view.called
+
+
 def test_get_vcenter_object_by_name():
     apple = mock.MagicMock()
     orange_1 = mock.MagicMock()
@@ -83,6 +196,163 @@ def test_get_vcenter_object_by_name():
         )
 
 
+def test_get_vcenter_object_by_name_scope():
+    scope = mock.MagicMock()
+    apple = mock.MagicMock()
+    apple.name = 'apple'
+    connection_mock = mock.MagicMock()
+    create_view = (
+        connection_mock.RetrieveContent.return_value.viewManager
+        .CreateContainerView
+    )
+    create_view.return_value.view = [apple]
+    assert get_vcenter_object_by_name(
+        connection_mock, vim.VirtualMachine, 'apple', scope
+    ) == apple
+    create_view.assert_called_with(scope, [vim.VirtualMachine], True)
+    assert get_all_vcenter_objects(
+        connection_mock, vim.VirtualMachine, scope=scope
+    ) == [apple]
+    create_view.assert_called_with(scope, [vim.VirtualMachine], True)
+
+
+def test_search_index_lookups():
+    connection_mock = mock.MagicMock()
+    search_index = connection_mock.RetrieveContent.return_value.searchIndex
+    datacenter = mock.MagicMock()
+    assert get_vcenter_object_by_inventory_path(
+        connection_mock, 'dc/vm/apple'
+    ) == search_index.FindByInventoryPath.return_value
+    search_index.FindByInventoryPath.assert_called_with('dc/vm/apple')
+    assert get_virtual_machine_by_uuid(
+        connection_mock, 'uuid'
+    ) == search_index.FindByUuid.return_value
+    search_index.FindByUuid.assert_called_with(None, 'uuid', True, True)
+    get_virtual_machine_by_uuid(connection_mock, 'uuid', False, datacenter)
+    search_index.FindByUuid.assert_called_with(datacenter, 'uuid', True, False)
+    assert get_virtual_machine_by_ip(
+        connection_mock, '127.0.0.1'
+    ) == search_index.FindByIp.return_value
+    search_index.FindByIp.assert_called_with(None, '127.0.0.1', True)
+    assert get_virtual_machine_by_dns_name(
+        connection_mock, 'apple.local', datacenter
+    ) == search_index.FindByDnsName.return_value
+    search_index.FindByDnsName.assert_called_with(
+        datacenter, 'apple.local', True
+    )
+    search_index.FindByIp.return_value = None
+    with pytest.raises(NoObjectFound):
+        get_virtual_machine_by_ip(connection_mock, '127.0.0.1')
+
+
+def test_get_vcenter_object_by_id():
+    connection_mock = mock.MagicMock()
+    vm = get_vcenter_object_by_id(
+        connection_mock, vim.VirtualMachine, 'vm-42'
+    )
+    assert isinstance(vm, vim.VirtualMachine)
+    assert vm._moId == 'vm-42'
+    assert vm._stub == connection_mock._stub
+
+
+def test_container_view_reuse():
+    apple = mock.MagicMock()
+    apple.name = 'apple'
+    connection_mock = mock.MagicMock()
+    create_view = (
+        connection_mock.RetrieveContent.return_value.viewManager
+        .CreateContainerView
+    )
+    create_view.return_value.view = [apple]
+    for _ in range(10000):
+        get_vcenter_object_by_name(
+            connection_mock, vim.VirtualMachine, 'apple'
+        )
+    get_all_vcenter_objects(connection_mock, vim.VirtualMachine)
+    get_vcenter_object_by_name(connection_mock, vim.Folder, 'apple')
+    assert create_view.call_count == 2
+    destroy_container_views()
+    assert create_view.return_value.DestroyView.call_count == 2
+    get_vcenter_object_by_name(connection_mock, vim.VirtualMachine, 'apple')
+    assert create_view.call_count == 3
+    destroy_container_views(release=False)
+    assert create_view.return_value.DestroyView.call_count == 2
+    get_vcenter_object_by_name(connection_mock, vim.VirtualMachine, 'apple')
+    assert create_view.call_count == 4
+    destroy_container_views()
+
+
+def test_container_view_eviction():
+    connection_mock = mock.MagicMock()
+    create_view = (
+        connection_mock.RetrieveContent.return_value.viewManager
+        .CreateContainerView
+    )
+    views = [mock.MagicMock() for _ in range(34)]
+    views[0].DestroyView.side_effect = vmodl.fault.ManagedObjectNotFound
+    create_view.side_effect = views
+    scopes = [mock.MagicMock() for _ in range(34)]
+    for scope in scopes[:32]:
+        with container_view(connection_mock, vim.VirtualMachine, scope):
+            pass
+    with container_view(
+            connection_mock, vim.VirtualMachine, scopes[0]
+    ) as view:
+        assert view == views[0]
+    with container_view(connection_mock, vim.VirtualMachine, scopes[32]):
+        pass
+    assert views[1].DestroyView.call_count == 1
+    assert views[0].DestroyView.call_count == 0
+    with container_view(connection_mock, vim.VirtualMachine, scopes[33]):
+        pass
+    assert views[2].DestroyView.call_count == 1
+    destroy_container_views()
+    assert views[0].DestroyView.call_count == 1
+    assert views[33].DestroyView.call_count == 1
+
+
+def test_container_view_in_use():
+    connection_mock = mock.MagicMock()
+    create_view = (
+        connection_mock.RetrieveContent.return_value.viewManager
+        .CreateContainerView
+    )
+    views = [mock.MagicMock() for _ in range(36)]
+    create_view.side_effect = views
+    scopes = [mock.MagicMock() for _ in range(35)]
+    with container_view(connection_mock, vim.VirtualMachine, scopes[0]):
+        for scope in scopes[1:33]:
+            with container_view(connection_mock, vim.VirtualMachine, scope):
+                pass
+        # Evicted while in use
+        assert views[0].DestroyView.call_count == 0
+    assert views[0].DestroyView.call_count == 1
+    with container_view(connection_mock, vim.VirtualMachine, scopes[1]):
+        destroy_container_views()
+        assert views[1].DestroyView.call_count == 0
+        assert views[2].DestroyView.call_count == 1
+    assert views[1].DestroyView.call_count == 1
+    with container_view(connection_mock, vim.VirtualMachine, scopes[2]):
+        destroy_container_views(release=False)
+    assert views[33].DestroyView.call_count == 0
+
+    def create_meanwhile(*args):
+        # Another lookup creates the same view while this one creates it
+        create_view.side_effect = views[35:]
+        with container_view(connection_mock, vim.VirtualMachine, scopes[34]):
+            pass
+        return views[34]
+    create_view.side_effect = create_meanwhile
+    with container_view(
+            connection_mock, vim.VirtualMachine, scopes[34]
+    ) as view:
+        assert view == views[35]
+    assert views[34].DestroyView.call_count == 1
+    assert views[35].DestroyView.call_count == 0
+    destroy_container_views()
+    assert views[35].DestroyView.call_count == 1
+
+
 def test_timeout_loop_success():
     timeout_loop(1, '', 1, False, lambda: True)
 
@@ -180,3 +450,150 @@ def test_wait_for_vcenter_task_timeout():
     task.info.state = vim.TaskInfo.State.running
     with pytest.raises(TimeoutError):
         wait_for_vcenter_task(task, 'description', timeout=1)
+
+
+def update_set(version, changes):
+    """ A property collector UpdateSet with the (object, name, value) """
+    object_updates = []
+    for obj, name, value in changes:
+        change = mock.MagicMock(val=value)
+        change.name = name
+        object_updates.append(mock.MagicMock(obj=obj, changeSet=[change]))
+    return mock.MagicMock(
+        version=version, filterSet=[mock.MagicMock(objectSet=object_updates)]
+    )
+
+
+def test_wait_for_vcenter_tasks(capsys):
+    stub = mock.MagicMock()
+    collector = stub.InvokeMethod.return_value
+    fault = vim.fault.InvalidPowerState()
+    succeeded = vim.Task('task-1', stub)
+    failed = vim.Task('task-2', stub)
+    collector.WaitForUpdatesEx.side_effect = [
+        update_set('1', [
+            (vim.Task('task-1', stub), 'info.state', 'success'),
+            (vim.Task('task-1', stub), 'info.result', 'hello'),
+            (vim.Task('task-2', stub), 'info.state', 'queued'),
+        ]),
+        None,
+        update_set('2', [
+            (vim.Task('task-2', stub), 'info.state', 'error'),
+            (vim.Task('task-2', stub), 'info.error', fault),
+        ]),
+    ]
+    assert wait_for_vcenter_tasks(
+        [succeeded, failed], 'description', timeout=5, _max_wait=2
+    ) == ['hello', fault]
+    assert 'Waiting for [description] ... ' in capsys.readouterr().out
+    (spec, _), _ = collector.CreateFilter.call_args
+    assert [obj_spec.obj for obj_spec in spec.objectSet] == [
+        succeeded, failed
+    ]
+    versions = [
+        (args[0], args[1].maxWaitSeconds)
+        for args, _ in collector.WaitForUpdatesEx.call_args_list
+    ]
+    assert versions == [('', 0), ('1', 2), ('1', 2)]
+    assert collector.DestroyPropertyCollector.call_count == 1
+    assert wait_for_vcenter_tasks([], 'description', timeout=2) == []
+    collector.WaitForUpdatesEx.side_effect = [
+        update_set('1', [(vim.Task('task-3', stub), 'info.state', 'running')])
+    ]
+    collector.DestroyPropertyCollector.side_effect = Exception
+    with pytest.raises(TimeoutError):
+        wait_for_vcenter_tasks(
+            [vim.Task('task-3', stub)], 'description', timeout=0
+        )
+
+
+def test_get_vcenter_parents():
+    stub = mock.MagicMock()
+    vm = vim.VirtualMachine('vm-1', stub)
+    vapp_vm = vim.VirtualMachine('vm-2', stub)
+    folder = vim.Folder('group-1', stub)
+    vapp = vim.VirtualApp('resgroup-1', stub)
+    datacenter = vim.Datacenter('datacenter-1', stub)
+
+    def page(objects, token=None):
+        contents = []
+        for obj, values in objects:
+            props = []
+            for name, value in values.items():
+                prop = mock.MagicMock(val=value)
+                prop.name = name
+                props.append(prop)
+            contents.append(mock.MagicMock(obj=obj, propSet=props))
+        return mock.MagicMock(objects=contents, token=token)
+    stub.InvokeMethod.side_effect = [
+        page([
+            (vm, {'parent': folder}),
+            (vapp_vm, {'parent': None, 'parentVApp': vapp}),
+        ], 'token'),
+        page([(folder, {'parent': datacenter}), (datacenter, {})]),
+    ]
+    assert get_vcenter_parents([vm, vapp_vm]) == {
+        vm: folder, vapp_vm: vapp, folder: datacenter, datacenter: None
+    }
+    _, _, (specs, _) = stub.InvokeMethod.call_args_list[0][0]
+    assert [obj_spec.obj for obj_spec in specs[0].objectSet] == [vm, vapp_vm]
+    assert stub.InvokeMethod.call_count == 2
+    assert get_vcenter_parents([]) == {}
+
+
+def test_powershell_quote():
+    assert powershell_quote("C:\\it's") == "'C:\\it''s'"
+
+
+def test_winrm_shell():
+    session = mock.MagicMock()
+    protocol = session.protocol
+    protocol.open_shell.return_value = 'shell'
+    protocol.run_command.return_value = 'command'
+    protocol.get_command_output.return_value = (b'out', b'err', 0)
+    with winrm_shell(session) as run_ps:
+        assert run_ps('ls') == (0, b'out', b'err')
+        assert run_ps('ls') == (0, b'out', b'err')
+    protocol.open_shell.assert_called_once_with()
+    protocol.run_command.assert_called_with(
+        'shell', 'powershell', ['-encodedcommand', 'bABzAA==']
+    )
+    assert protocol.cleanup_command.call_count == 2
+    protocol.close_shell.assert_called_once_with('shell')
+
+
+def test_winrm_stdin_script():
+    session = mock.MagicMock()
+    protocol = session.protocol
+    protocol.open_shell.return_value = 'shell'
+    protocol.run_command.return_value = 'command'
+    protocol.get_command_output.return_value = (b'', b'', 0)
+    with winrm_stdin_script(session, 'ls') as send:
+        send(b'data')
+    protocol.run_command.assert_called_once_with(
+        'shell', 'powershell', ['-encodedcommand', 'bABzAA==']
+    )
+    assert protocol.send_command_input.call_args_list == [
+        mock.call('shell', 'command', b'data'),
+        mock.call('shell', 'command', b'', end=True)
+    ]
+    protocol.get_command_output.return_value = (b'out', b'disk full', 1)
+    with pytest.raises(WinRmError) as error:
+        with winrm_stdin_script(session, 'ls'):
+            pass
+    assert 'disk full' in str(error.value)
+    with pytest.raises(ValueError):
+        with winrm_stdin_script(session, 'ls'):
+            raise ValueError()
+    assert protocol.send_command_input.call_count == 3
+    assert protocol.cleanup_command.call_count == 3
+    assert protocol.close_shell.call_count == 3
+
+
+def test_print_progress(capsys):
+    print_progress('Copying', 5, 10)
+    assert capsys.readouterr().out == (
+        '\rCopying ... [' + '=' * 15 + ' ' * 15 + ']  50 %'
+    )
+    print_progress('Copying', 20, 10)
+    assert capsys.readouterr().out.endswith('] 100 %')
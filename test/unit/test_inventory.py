@@ -0,0 +1,257 @@
+import collections
+import threading
+
+import mock
+import pytest
+from pyVmomi import vim, vmodl
+from six.moves import queue
+
+from vcdriver.exceptions import NoObjectFound, TooManyObjectsFound
+from vcdriver.helpers import (
+    get_all_vcenter_objects,
+    get_vcenter_object_by_name,
+    inventory_mirror,
+)
+from vcdriver.inventory import InventoryMirror
+from vcdriver.session import renew
+from vcdriver.vm import VirtualMachine, get_all_virtual_machines
+
+
+Change = collections.namedtuple('Change', 'name op val')
+ObjectUpdate = collections.namedtuple('ObjectUpdate', 'obj kind changeSet')
+FilterUpdate = collections.namedtuple('FilterUpdate', 'objectSet')
+UpdateSet = collections.namedtuple('UpdateSet', 'version truncated filterSet')
+
+
+def update_set(version, object_updates, truncated=False):
+    return UpdateSet(version, truncated, [FilterUpdate(object_updates)])
+
+
+def enter(obj, **properties):
+    return ObjectUpdate(obj, 'enter', [
+        Change(name, 'assign', val) for name, val in properties.items()
+    ])
+
+
+class FakeCollector(object):
+    """ Property collector serving the queued update sets """
+    def __init__(self, initial):
+        self.initial = list(initial)
+        self.updates = queue.Queue()
+        self.versions = []
+        self.DestroyPropertyCollector = mock.MagicMock()
+
+    def CreateFilter(self, spec, partial_updates):
+        self.spec = spec
+
+    def WaitForUpdatesEx(self, version, options):
+        self.versions.append(version)
+        if self.initial:
+            return self.initial.pop(0)
+        update = self.updates.get(timeout=5)
+        if isinstance(update, Exception):
+            raise update
+        return update
+
+    def CancelWaitForUpdates(self):
+        self.updates.put(vmodl.fault.RequestCanceled())
+
+
+def fake_connection(collector):
+    conn = mock.MagicMock()
+    content = conn.RetrieveContent.return_value
+    content.propertyCollector.CreatePropertyCollector.return_value = collector
+    view_stub = mock.MagicMock()
+    content.viewManager.CreateContainerView.return_value = (
+        vim.view.ContainerView('view-1', view_stub)
+    )
+    return conn, view_stub
+
+
+def test_inventory_mirror():
+    vm1 = vim.VirtualMachine('vm-1')
+    vm2 = vim.VirtualMachine('vm-2')
+    folder = vim.Folder('group-1')
+    collector = FakeCollector([
+        update_set('1', [
+            enter(vm1, **{'name': 'vm1', 'runtime.powerState': 'poweredOn'})
+        ], truncated=True),
+        update_set('2', [
+            enter(vm2, name='twin'), enter(folder, name='twin')
+        ]),
+    ])
+    conn, view_stub = fake_connection(collector)
+    with InventoryMirror(conn=conn) as mirror:
+        mirror.start()
+        assert mirror.running
+        assert mirror.version == 2
+        assert collector.versions[:2] == ['', '1']
+        assert inventory_mirror() is mirror
+        assert inventory_mirror(conn) is mirror
+        assert inventory_mirror(mock.MagicMock()) is None
+        assert mirror.mirrors(vim.VirtualMachine)
+        assert not mirror.mirrors(vim.Network)
+        assert set(mirror.get_all(vim.VirtualMachine)) == set([vm1, vm2])
+        assert dict(
+            (obj, tuple(values))
+            for obj, values in mirror.get_all_properties(
+                vim.VirtualMachine, ['name', 'guest.ipAddress']
+            )
+        ) == {vm1: ('vm1', None), vm2: ('twin', None)}
+        assert mirror.get_by_name(vim.VirtualMachine, 'twin') is vm2
+        assert mirror.get_by_name(vim.ManagedEntity, 'vm1') is vm1
+        with pytest.raises(TooManyObjectsFound):
+            mirror.get_by_name(vim.ManagedEntity, 'twin')
+        with pytest.raises(NoObjectFound):
+            mirror.get_by_name(vim.VirtualMachine, 'missing')
+        assert mirror.get_property(vm1, 'runtime.powerState') == 'poweredOn'
+        assert mirror.get_property(vm2, 'guest.ipAddress') is None
+        with pytest.raises(KeyError):
+            mirror.get_property(vm1, 'config.hardware')
+        with pytest.raises(KeyError):
+            mirror.get_property(vim.VirtualMachine('vm-3'), 'name')
+        collector.updates.put(update_set('3', [
+            ObjectUpdate(vm1, 'modify', [
+                Change('name', 'assign', 'renamed'),
+                Change('runtime.powerState', 'remove', None),
+            ]),
+            ObjectUpdate(vm2, 'leave', []),
+            ObjectUpdate(folder, 'modify', [
+                Change('name', 'indirectRemove', None)
+            ]),
+        ]))
+        assert mirror.wait_for_version(3, timeout=5)
+        assert mirror.get_all(vim.VirtualMachine) == [vm1]
+        assert mirror.get_by_name(vim.VirtualMachine, 'renamed') is vm1
+        assert mirror.get_property(vm1, 'runtime.powerState') is None
+        with pytest.raises(NoObjectFound):
+            mirror.get_by_name(vim.ManagedEntity, 'twin')
+        assert not mirror.wait_for_version(4, timeout=0)
+    mirror.stop()
+    assert not mirror.running
+    assert mirror.error is None
+    assert inventory_mirror() is None
+    assert not mirror.wait_for_version(4)
+    collector.DestroyPropertyCollector.assert_called_once_with()
+    assert view_stub.InvokeMethod.call_count == 1
+
+
+def test_inventory_mirror_follow_error():
+    collector = FakeCollector([update_set('1', [])])
+    conn, view_stub = fake_connection(collector)
+    collector.DestroyPropertyCollector.side_effect = Exception
+    mirror = InventoryMirror(conn=conn)
+    mirror.stop()
+    mirror.start()
+    collector.updates.put(None)
+    error = Exception('Session gone')
+    collector.updates.put(error)
+    assert not mirror.wait_for_version(2)
+    assert mirror.error is error
+    assert inventory_mirror() is None
+    mirror.stop()
+    collector.updates.put(update_set('2', []))
+    mirror.start()
+    assert mirror.running and mirror.error is None
+
+    def cancel_and_fail():
+        collector.updates.put(vmodl.fault.RequestCanceled())
+        raise Exception('Session gone')
+    with mock.patch.object(
+        collector, 'CancelWaitForUpdates', side_effect=cancel_and_fail
+    ):
+        mirror.stop()
+    assert not mirror.running
+
+
+def test_inventory_mirror_renew():
+    vm = vim.VirtualMachine('vm-1')
+    collector = FakeCollector([update_set('1', [enter(vm, name='vm1')])])
+    conn, view_stub = fake_connection(collector)
+    conn.content.sessionManager.currentSession = None
+    mirror = InventoryMirror(conn=conn)
+    mirror.start()
+    collector.updates.put(vim.fault.NotAuthenticated())
+    assert not mirror.wait_for_version(2)
+    assert inventory_mirror() is None
+    collector.updates.put(update_set('2', [enter(vm, name='renamed')]))
+    with mock.patch.multiple(
+            'vcdriver.session', _connection_obj=conn,
+            _credentials=('user', 'pass'), _persisted=None
+    ):
+        assert renew() is conn
+    try:
+        assert mirror.running
+        assert mirror.error is None
+        assert inventory_mirror(conn) is mirror
+        assert mirror.get_by_name(vim.VirtualMachine, 'renamed') is vm
+        assert collector.versions[:3] == ['', '1', '']
+        conn.content.sessionManager.Login.assert_called_once_with(
+            'user', 'pass'
+        )
+        # The objects of the expired session are only forgotten
+        assert not collector.DestroyPropertyCollector.called
+        assert not view_stub.InvokeMethod.called
+    finally:
+        mirror.stop()
+
+
+@mock.patch('vcdriver.inventory.connection')
+def test_inventory_mirror_lookups(connection):
+    vm = vim.VirtualMachine('vm-1')
+    collector = FakeCollector([update_set('1', [enter(vm, **{
+        'name': 'vm1',
+        'runtime.powerState': 'poweredOff',
+        'guest.ipAddress': '10.0.0.1',
+    })])])
+    conn, _ = fake_connection(collector)
+    connection.return_value = conn
+    with InventoryMirror() as mirror:
+        assert mirror.connection is conn
+        assert get_all_vcenter_objects(conn, vim.VirtualMachine) == [vm]
+        assert get_vcenter_object_by_name(
+            conn, vim.VirtualMachine, 'vm1'
+        ) is vm
+        assert not conn.RetrieveContent.return_value.viewManager.\
+            CreateContainerView.call_count > 1
+        virtual_machine = VirtualMachine()
+        virtual_machine._vm_object = vm
+        assert virtual_machine.ip() == '10.0.0.1'
+        assert virtual_machine._summary_property(
+            'runtime.powerState'
+        ) == 'poweredOff'
+        vm_mock = mock.MagicMock()
+        vm_mock.summary.runtime.powerState = 'poweredOn'
+        virtual_machine._vm_object = vm_mock
+        assert virtual_machine._summary_property(
+            'runtime.powerState'
+        ) == 'poweredOn'
+        with mock.patch('vcdriver.vm.connection', return_value=conn):
+            vms = get_all_virtual_machines()
+        assert [v.name for v in vms] == ['vm1']
+
+
+def test_inventory_mirror_thread_safety():
+    vms = [vim.VirtualMachine('vm-{}'.format(i)) for i in range(100)]
+    collector = FakeCollector([update_set('0', [])])
+    conn, _ = fake_connection(collector)
+    with InventoryMirror(conn=conn) as mirror:
+        readers = [
+            threading.Thread(target=lambda: [
+                mirror.get_all(vim.VirtualMachine) for _ in range(100)
+            ])
+            for _ in range(4)
+        ]
+        for reader in readers:
+            reader.start()
+        for i, vm in enumerate(vms):
+            collector.updates.put(update_set(str(i + 1), [
+                enter(vm, name='vm{}'.format(i))
+            ]))
+        assert mirror.wait_for_version(101, timeout=10)
+        for reader in readers:
+            reader.join()
+        assert len(mirror.get_all(vim.VirtualMachine)) == 100
+        # The last wait can also return normally right after the cancel
+        collector.CancelWaitForUpdates = lambda: collector.updates.put(None)
+    assert mirror.error is None
@@ -0,0 +1,136 @@
+import mock
+
+from vcdriver.helpers import timeout_loop
+from vcdriver.profiling import Profiler, profile
+from vcdriver.vm import VirtualMachine
+
+
+class FakeResponse(object):
+    status = 200
+
+    def __init__(self, body):
+        self._body = body
+
+    def read(self, size=-1):
+        body, self._body = self._body, b''
+        return body
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.sock = None
+
+    def request(self, method, url, body, headers):
+        self.body = body
+
+    def getresponse(self):
+        return FakeResponse(b'x' * 2 * len(self.body))
+
+
+class FakeStub(object):
+    def __init__(self):
+        self.pool = []
+
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        conn = self.GetConnection()
+        conn.request('POST', '/sdk', b'12345', {})
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 200
+        assert conn.sock is None
+        self.ReturnConnection(conn)
+        return response
+
+    def GetConnection(self):
+        return FakeConnection()
+
+    def ReturnConnection(self, conn):
+        self.pool.append(conn)
+
+
+def method_info(name):
+    info = mock.MagicMock()
+    info.wsdlName = name
+    return info
+
+
+def test_profiler_counts_and_attributes_calls():
+    stub = FakeStub()
+    profiler = Profiler()
+    profiler.attach(stub)
+    stub.InvokeMethod(None, method_info('RetrieveContent'), ())
+    timeout_loop(
+        1, '', 0, True,
+        lambda: stub.InvokeMethod(None, method_info('Fetch'), ('name',))
+    )
+    timeout_loop(
+        1, '', 0, True,
+        lambda: stub.InvokeMethod(None, method_info('Fetch'), ())
+    )
+    stub.GetConnection()
+    profiler.detach()
+    profiler.detach()
+    stub.InvokeMethod(None, method_info('RetrieveContent'), ())
+    assert isinstance(stub.pool[0], FakeConnection)
+    unattributed = profiler.stats['<unattributed>']['RetrieveContent']
+    assert unattributed.calls == 1
+    assert unattributed.request_bytes == 5
+    assert unattributed.response_bytes == 10
+    timeout_loop_stats = profiler.stats['timeout_loop']
+    assert timeout_loop_stats['Fetch(name)'].calls == 1
+    assert timeout_loop_stats['Fetch'].calls == 1
+    report = profiler.report()
+    assert 'timeout_loop' in report
+    assert 'TOTAL' in report
+    profiler.reset()
+    assert not profiler.stats
+
+
+def test_profiler_nested():
+    stub = FakeStub()
+    outer = Profiler()
+    inner = Profiler()
+    outer.attach(stub)
+    outer_methods = dict(vars(stub))
+    inner.attach(stub)
+    stub.InvokeMethod(None, method_info('RetrieveContent'), ())
+    inner.detach()
+    assert dict(vars(stub)) == outer_methods
+    stub.InvokeMethod(None, method_info('RetrieveContent'), ())
+    outer.detach()
+    assert 'InvokeMethod' not in vars(stub)
+    inner_stats = inner.stats['<unattributed>']['RetrieveContent']
+    outer_stats = outer.stats['<unattributed>']['RetrieveContent']
+    assert inner_stats.calls == 1
+    assert inner_stats.response_bytes == 10
+    assert outer_stats.calls == 2
+    assert outer_stats.response_bytes == 20
+    assert all(isinstance(conn, FakeConnection) for conn in stub.pool)
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_vcenter_object_by_name')
+def test_profiler_attributes_methods_to_class(
+        get_vcenter_object_by_name, connection
+):
+    stub = FakeStub()
+    get_vcenter_object_by_name.side_effect = (
+        lambda *args: stub.InvokeMethod(None, method_info('Fetch'), ('n',))
+    )
+    profiler = Profiler()
+    profiler.attach(stub)
+    VirtualMachine().find()
+    profiler.detach()
+    assert profiler.stats['VirtualMachine.find']['Fetch(n)'].calls == 1
+
+
+@mock.patch('vcdriver.profiling.connection')
+def test_profile(connection):
+    stub = FakeStub()
+    connection.return_value._stub = stub
+    with profile() as profiler:
+        stub.InvokeMethod(None, method_info('RetrieveContent'), ())
+    with profile(connection.return_value, quiet=True):
+        pass
+    assert 'InvokeMethod' not in vars(stub)
+    assert profiler.stats['<unattributed>']['RetrieveContent'].calls == 1
@@ -0,0 +1,152 @@
+import contextlib
+import errno
+import socket
+
+import mock
+import pytest
+
+from vcdriver.exceptions import TimeoutError
+from vcdriver.readiness import (
+    ReadinessResult,
+    _connect,
+    wait_for_ports,
+    wait_for_service,
+    wait_for_services,
+)
+
+
+@contextlib.contextmanager
+def listening_socket(family=socket.AF_INET, host='127.0.0.1'):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    sock.listen(8)
+    try:
+        yield sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def closed_port():
+    with listening_socket() as port:
+        pass
+    return port
+
+
+def test_readiness_result():
+    assert ReadinessResult(1.5, 2.0).seconds == 3.5
+
+
+@mock.patch('vcdriver.readiness.socket.socket')
+def test_connect_refused(socket_mock):
+    socket_mock.return_value.connect_ex.return_value = errno.ECONNREFUSED
+    assert _connect('127.0.0.1', 22) is None
+    socket_mock.assert_called_once_with(socket.AF_INET, socket.SOCK_STREAM)
+    assert socket_mock.return_value.close.call_count == 1
+    socket_mock.return_value.connect_ex.return_value = errno.EINPROGRESS
+    assert _connect('::1', 22) is socket_mock.return_value
+    socket_mock.assert_called_with(socket.AF_INET6, socket.SOCK_STREAM)
+
+
+def test_wait_for_ports():
+    with listening_socket() as first, listening_socket() as second:
+        latencies = wait_for_ports(
+            [('127.0.0.1', first), ('127.0.0.1', second)], 5
+        )
+    assert sorted(latencies) == sorted(
+        [('127.0.0.1', first), ('127.0.0.1', second)]
+    )
+    assert all(latency < 5 for latency in latencies.values())
+    assert wait_for_ports([], 5) == {}
+
+
+def test_wait_for_ports_ipv6():
+    if not socket.has_ipv6:
+        pytest.skip('No IPv6 support')  # pragma: no cover
+    try:
+        context = listening_socket(socket.AF_INET6, '::1')
+        port = context.__enter__()
+    except socket.error:  # pragma: no cover
+        pytest.skip('No IPv6 loopback')
+    try:
+        assert ('::1', port) in wait_for_ports([('::1', port)], 5)
+    finally:
+        context.__exit__(None, None, None)
+
+
+def test_wait_for_ports_timeout():
+    port = closed_port()
+    with pytest.raises(TimeoutError) as error:
+        wait_for_ports([('127.0.0.1', port)], 0.2, _poll_interval=0.1)
+    assert '127.0.0.1:{}'.format(port) in str(error.value)
+
+
+@mock.patch('vcdriver.readiness._connect')
+def test_wait_for_ports_connect_failed(connect):
+    connect.return_value = None
+    with pytest.raises(TimeoutError):
+        wait_for_ports([('127.0.0.1', 1)], 0, _poll_interval=0)
+
+
+@mock.patch('vcdriver.readiness.select.select')
+@mock.patch('vcdriver.readiness._connect')
+def test_wait_for_ports_slow_connect(connect, select_mock):
+    slow, refused, retried = [mock.MagicMock() for _ in range(3)]
+    slow.getsockopt.return_value = 0
+    refused.getsockopt.return_value = errno.ECONNREFUSED
+    retried.getsockopt.return_value = 0
+    attempts = {1: [slow], 2: [refused, retried]}
+    connect.side_effect = lambda host, port: attempts[port].pop(0)
+    select_mock.side_effect = [
+        ([], [refused], []), ([], [], []), ([], [slow, retried], [])
+    ]
+    latencies = wait_for_ports(
+        [('127.0.0.1', 1), ('127.0.0.1', 2)], 5, _poll_interval=0
+    )
+    assert sorted(latencies) == [('127.0.0.1', 1), ('127.0.0.1', 2)]
+    assert connect.call_args_list.count(mock.call('127.0.0.1', 1)) == 1
+    assert connect.call_count == 3
+    for sock in (slow, refused, retried):
+        assert sock.close.call_count == 1
+
+
+@mock.patch('vcdriver.readiness.select.select')
+@mock.patch('vcdriver.readiness._connect')
+def test_wait_for_ports_timeout_in_progress(connect, select_mock):
+    select_mock.return_value = ([], [], [])
+    with pytest.raises(TimeoutError):
+        wait_for_ports([('127.0.0.1', 1)], 0, _poll_interval=0)
+    assert connect.return_value.close.call_count == 1
+
+
+def test_wait_for_services(capsys):
+    probe = mock.MagicMock(side_effect=[Exception, True, True])
+    with listening_socket() as first, listening_socket() as second:
+        results = wait_for_services(
+            [('127.0.0.1', first, probe), ('127.0.0.1', second, probe)],
+            'Check service', 5
+        )
+    assert probe.call_count == 3
+    assert results[('127.0.0.1', first)].probe_seconds >= 1
+    assert 'Check service on 127.0.0.1:{} ... port'.format(second) in (
+        capsys.readouterr().out
+    )
+
+
+def test_wait_for_service(capsys):
+    probe = mock.MagicMock(return_value=True)
+    with listening_socket() as port:
+        result = wait_for_service('127.0.0.1', port, probe, 'Check', 5)
+    assert isinstance(result, ReadinessResult)
+    assert capsys.readouterr().out == ''
+
+
+@mock.patch('vcdriver.readiness.wait_for_ports')
+def test_wait_for_service_probe_timeout(wait_for_ports):
+    wait_for_ports.return_value = {('127.0.0.1', 22): 0.0}
+    probe = mock.MagicMock(side_effect=Exception)
+    with pytest.raises(TimeoutError):
+        wait_for_service('127.0.0.1', 22, probe, 'Check', 0)
+    assert probe.call_count == 1
+    probe = mock.MagicMock(return_value=True)
+    wait_for_service('127.0.0.1', 22, probe, 'Check', 0)
+    assert probe.call_count == 1
@@ -0,0 +1,98 @@
+import datetime
+
+import mock
+import pytest
+
+from vcdriver.reaper import (
+    ReapResult,
+    find_stale_virtual_machines,
+    reap_virtual_machines,
+)
+from vcdriver.vm import VirtualMachine
+
+
+def test_reap_result():
+    result = ReapResult(['vm'], stale=['vm'], seconds=30.0)
+    assert result.succeeded
+    assert result.throughput == 2.0
+    result = ReapResult(failed=[('vm', Exception())])
+    assert not result.succeeded
+    assert result.throughput == 0.0
+
+
+@mock.patch('vcdriver.reaper.query_virtual_machines')
+def test_find_stale_virtual_machines(query_virtual_machines):
+    record = mock.MagicMock()
+    query_virtual_machines.return_value = iter([record])
+    assert find_stale_virtual_machines(name='ci-*', timeout=10) == [
+        record.virtual_machine.return_value
+    ]
+    record.virtual_machine.assert_called_once_with(timeout=10)
+    kwargs = query_virtual_machines.call_args[1]
+    assert (kwargs['name'], kwargs['scope']) == ('ci-*', None)
+    assert kwargs['template'] is False
+    assert datetime.datetime.utcnow() - kwargs['created_before'] >= (
+        datetime.timedelta(hours=6)
+    )
+    with pytest.raises(ValueError):
+        find_stale_virtual_machines()
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.iter_vcenter_properties')
+def test_find_stale_virtual_machines_templates(
+        iter_vcenter_properties, connection
+):
+    machines = []
+    created = datetime.datetime(2018, 6, 13)
+    for name, template, created_date in [
+        ('ci-1', False, created),
+        ('ci-2', True, created),
+        ('ci-3', None, created),
+        ('ci-4', False, None),
+        ('ci-5', False, created)
+    ]:
+        vm_object = mock.MagicMock()
+        vm_object.name = name
+        machines.append((vm_object, template, created_date))
+    iter_vcenter_properties.side_effect = (
+        lambda conn, object_type, paths, scope, page_size: iter([
+            (vm_object, [{
+                'name': vm_object.name,
+                'config.createDate': created_date,
+                'config.changeVersion': '1',
+                'config.template': template
+            }.get(path) for path in paths])
+            for vm_object, template, created_date in machines
+        ])
+    )
+    assert [vm.name for vm in find_stale_virtual_machines(name='ci-*')] == [
+        'ci-1', 'ci-3', 'ci-5'
+    ]
+    assert 'config.template' in iter_vcenter_properties.call_args[0][2]
+
+
+@mock.patch('vcdriver.reaper.find_stale_virtual_machines')
+@mock.patch.object(VirtualMachine, 'destroy')
+def test_reap_virtual_machines(destroy, find_stale_virtual_machines, capsys):
+    vms = [VirtualMachine(name='vm-{}'.format(i)) for i in range(4)]
+    find_stale_virtual_machines.return_value = vms
+    result = reap_virtual_machines(folder='ci', dry_run=True)
+    assert result == [] and result.stale == vms
+    assert not destroy.called
+    assert 'Stale virtual machine "vm-3"' in capsys.readouterr()[0]
+    destroy.side_effect = [None, Exception('gone'), None, None]
+    result = reap_virtual_machines(folder='ci', workers=2, rate=100)
+    assert destroy.call_count == 4
+    assert len(result) == 3
+    assert len(result.failed) == 1 and str(result.failed[0][1]) == 'gone'
+    assert sorted(vm.name for vm in result + [result.failed[0][0]]) == [
+        vm.name for vm in vms
+    ]
+    output = capsys.readouterr()[0]
+    assert 'Reaped 3 of 4 stale virtual machines' in output
+    assert 'Failed to destroy' in output
+    destroy.side_effect = None
+    assert len(reap_virtual_machines(name='ci-*', quiet=True)) == 4
+    find_stale_virtual_machines.return_value = []
+    assert reap_virtual_machines(name='ci-*', quiet=True).stale == []
@@ -1,11 +1,27 @@
+import json
+import os
+
 import mock
+from pyVmomi import vim
 
-from vcdriver.session import connection, close, id
+from vcdriver.session import (
+    _keep_alive,
+    close,
+    connection,
+    id,
+    renew,
+    start_keepalive,
+    stop_keepalive,
+)
 
 
 @mock.patch('vcdriver.session.SmartConnect')
 @mock.patch('vcdriver.session.Disconnect')
-def test_session(disconnect, connect):
+@mock.patch('vcdriver.session.destroy_container_views')
+@mock.patch('vcdriver.session.inventory_mirror', return_value=None)
+def test_session(
+        inventory_mirror, destroy_container_views, disconnect, connect
+):
     connection(
         vcdriver_username='something', vcdriver_password='something',
         vcdriver_host='something', vcdriver_port='something'
@@ -19,3 +35,156 @@ def test_session(disconnect, connect):
     close()
     assert connect.call_count == 1
     assert disconnect.call_count == 1
+    assert destroy_container_views.call_count == 1
+
+
+@mock.patch('vcdriver.session.SmartConnect')
+@mock.patch('vcdriver.session.Disconnect')
+@mock.patch('vcdriver.session.destroy_container_views')
+@mock.patch('vcdriver.session.inventory_mirror')
+def test_session_stops_inventory_mirror(
+        inventory_mirror, destroy_container_views, disconnect, connect
+):
+    connection(
+        vcdriver_username='something', vcdriver_password='something',
+        vcdriver_host='something', vcdriver_port='something'
+    )
+    close()
+    inventory_mirror.return_value.stop.assert_called_once_with()
+
+
+@mock.patch('vcdriver.session.SmartConnect')
+@mock.patch('vcdriver.session.Disconnect')
+@mock.patch('vcdriver.session.destroy_container_views')
+@mock.patch('vcdriver.session.inventory_mirror', return_value=None)
+@mock.patch('vcdriver.session.SoapStubAdapter')
+@mock.patch('vcdriver.session.vim.ServiceInstance')
+def test_session_file(
+        service_instance, soap_stub_adapter, inventory_mirror,
+        destroy_container_views, disconnect, connect, tmpdir
+):
+    session_file = str(tmpdir.join('sessions.json'))
+    kwargs = dict(
+        vcdriver_username='user', vcdriver_password='something',
+        vcdriver_host='host', vcdriver_port='443',
+        vcdriver_session_file=session_file
+    )
+    connect.return_value._stub.cookie = 'vmware_soap_session="1"'
+    connect.return_value._stub.version = 'vim.version.version11'
+    assert connection(**kwargs) == connect.return_value
+    close()
+    assert disconnect.call_count == 0
+    assert os.stat(session_file).st_mode & 0o077 == 0
+    with open(session_file) as f:
+        assert json.load(f) == {'user@host:443': {
+            'cookie': 'vmware_soap_session="1"',
+            'version': 'vim.version.version11'
+        }}
+    assert connection(**kwargs) == service_instance.return_value
+    close()
+    assert connect.call_count == 1
+    assert soap_stub_adapter.call_args[1]['version'] == (
+        'vim.version.version11'
+    )
+    assert soap_stub_adapter.return_value.cookie == 'vmware_soap_session="1"'
+    service_instance.return_value.content.sessionManager.currentSession = None
+    assert connection(**kwargs) == connect.return_value
+    close()
+    type(service_instance.return_value.content.sessionManager).currentSession \
+        = mock.PropertyMock(side_effect=vim.fault.NotAuthenticated())
+    assert connection(**kwargs) == connect.return_value
+    close()
+    with open(session_file, 'w') as f:
+        f.write('corrupted')
+    assert connection(**kwargs) == connect.return_value
+    close()
+    assert connect.call_count == 4
+    assert disconnect.call_count == 0
+
+
+@mock.patch('vcdriver.session.SmartConnect')
+@mock.patch('vcdriver.session.Disconnect')
+@mock.patch('vcdriver.session.destroy_container_views')
+@mock.patch('vcdriver.session.inventory_mirror', return_value=None)
+def test_session_renew(
+        inventory_mirror, destroy_container_views, disconnect, connect, tmpdir
+):
+    credentials = dict(vcdriver_username='user', vcdriver_password='pass')
+    with mock.patch('vcdriver.session.connection') as connection_mock:
+        assert renew() == connection_mock.return_value
+    session_file = str(tmpdir.join('sessions.json'))
+    connect.return_value._stub.cookie = 'old'
+    connect.return_value._stub.version = 'vim.version.version11'
+    conn = connection(
+        vcdriver_host='host', vcdriver_port='443',
+        vcdriver_session_file=session_file, **credentials
+    )
+    session_manager = conn.content.sessionManager
+    assert renew() is conn
+    assert not session_manager.Logout.called
+    assert not session_manager.Login.called
+    assert not destroy_container_views.called
+    session_manager.currentSession = None
+    session_manager.Login.return_value.key = 'renewed'
+    conn._stub.cookie = 'new'
+    assert renew() is conn
+    assert not session_manager.Logout.called
+    session_manager.Login.assert_called_once_with('user', 'pass')
+    destroy_container_views.assert_called_once_with(release=False)
+    with open(session_file) as f:
+        assert json.load(f)['user@host:443']['cookie'] == 'new'
+    close()
+    session_manager.currentSession = mock.MagicMock()
+    connection(vcdriver_host='host', vcdriver_port='443', **credentials)
+    type(session_manager).currentSession = mock.PropertyMock(
+        side_effect=vim.fault.NotAuthenticated()
+    )
+    assert renew() is conn
+    assert not session_manager.Logout.called
+    del type(session_manager).currentSession
+    assert renew(force=True) is conn
+    destroy_container_views.assert_called_with(release=True)
+    session_manager.Logout.side_effect = vim.fault.NotAuthenticated()
+    assert renew(force=True) is conn
+    assert session_manager.Logout.call_count == 2
+    assert session_manager.Login.call_count == 4
+    close()
+
+
+@mock.patch('vcdriver.session.SmartConnect')
+@mock.patch('vcdriver.session.Disconnect')
+@mock.patch('vcdriver.session.destroy_container_views')
+@mock.patch('vcdriver.session.inventory_mirror', return_value=None)
+@mock.patch('vcdriver.session.renew')
+def test_keep_alive(
+        renew, inventory_mirror, destroy_container_views, disconnect, connect
+):
+    stopped = mock.MagicMock()
+    stopped.wait.side_effect = [False, True]
+    _keep_alive(10, stopped)
+    stopped.wait.assert_called_with(10)
+    conn = connection(
+        vcdriver_username='something', vcdriver_password='something',
+        vcdriver_host='something', vcdriver_port='something'
+    )
+    conn.CurrentTime.side_effect = [
+        None, Exception('glitch'), vim.fault.NotAuthenticated(),
+        vim.fault.NotAuthenticated()
+    ]
+    renew.side_effect = [Exception('unreachable'), conn]
+    stopped.wait.side_effect = [False, False, False, False, True]
+    _keep_alive(10, stopped)
+    assert conn.CurrentTime.call_count == 4
+    assert renew.call_count == 2
+    close()
+
+
+@mock.patch('vcdriver.session._keep_alive')
+def test_start_and_stop_keepalive(keep_alive):
+    start_keepalive(interval=60)
+    start_keepalive(interval=60)
+    stop_keepalive()
+    stop_keepalive()
+    assert keep_alive.call_count == 1
+    interval, stopped = keep_alive.call_args[0]
+    assert interval == 60 and stopped.is_set()
@@ -0,0 +1,149 @@
+import io
+import os
+import tempfile
+
+import mock
+import pytest
+from winrm.exceptions import WinRMOperationTimeoutError
+
+from vcdriver.exceptions import TimeoutError
+from vcdriver.streaming import (
+    LineSplitter,
+    OutputSink,
+    SshOutput,
+    WinRmOutput,
+)
+
+
+def test_line_splitter():
+    splitter = LineSplitter(max_line=4)
+    assert splitter.feed(b'one\r\ntw') == ['one']
+    assert splitter.feed(b'o\n\xc3') == ['two']
+    assert splitter.feed(b'\xa9\n') == [u'\xe9']
+    assert splitter.feed(b'abcdefghij') == ['abcd', 'efgh']
+    assert splitter.flush() == ['ij']
+    assert splitter.flush() == []
+
+
+def test_output_sink():
+    spool_path = os.path.join(tempfile.mkdtemp(), 'spool.log')
+    sink = OutputSink(tail_lines=2, spool_path=spool_path)
+    for line in ('a', 'b', 'c'):
+        sink.write('stdout', line)
+    sink.write('stderr', 'oops')
+    sink.close()
+    sink.close()
+    assert sink.tail('stdout') == 'b\nc'
+    assert sink.tail('stderr') == 'oops'
+    with io.open(spool_path, encoding='utf-8') as spool:
+        assert spool.read() == 'a\nb\nc\noops\n'
+    sink = OutputSink()
+    sink.write('stdout', 'a')
+    sink.close()
+    assert sink.tail('stdout') == 'a'
+    sink = OutputSink(spool_path=spool_path, separator=u'')
+    sink.write('stdout', 'de')
+    sink.write('stdout', 'f')
+    sink.close()
+    assert sink.tail('stdout') == 'def'
+    with io.open(spool_path, encoding='utf-8') as spool:
+        assert spool.read().endswith('oops\ndef')
+    sink = OutputSink(tail_lines=3, separator=u'', tail_size=5)
+    for chunk in ('ab', 'cd', 'ef', 'ghij', 'klmnopq', 'r'):
+        sink.write('stdout', chunk)
+        assert len(sink.tail('stdout')) <= 5
+    assert sink.tail('stdout') == 'nopqr'
+    sink.write('stdout', 'stuvwxyz')
+    assert sink.tail('stdout') == 'vwxyz'
+
+
+@mock.patch('vcdriver.streaming._open_ssh_channel')
+def test_ssh_output(open_ssh_channel):
+    channel = open_ssh_channel.return_value
+    channel.recv_ready.side_effect = [True, False, False, True, False, False]
+    channel.recv.side_effect = [b'hello\nwor', b'ld']
+    channel.recv_stderr_ready.side_effect = [
+        False, True, False, False, False, False
+    ]
+    channel.recv_stderr.return_value = b'warning\n'
+    channel.exit_status_ready.side_effect = [False, True]
+    channel.recv_exit_status.return_value = 3
+    output = SshOutput('build', use_sudo=True, _poll_interval=0)
+    output.open()
+    assert list(output) == [
+        ('stdout', 'hello'), ('stderr', 'warning'), ('stdout', 'world')
+    ]
+    assert output.return_code == 3
+    open_ssh_channel.assert_called_once_with('build', True)
+    assert channel.close.call_count == 1
+
+
+@mock.patch('vcdriver.streaming._open_ssh_channel')
+def test_ssh_output_opens_on_iteration(open_ssh_channel):
+    channel = open_ssh_channel.return_value
+    channel.recv_ready.return_value = False
+    channel.recv_stderr_ready.return_value = False
+    channel.exit_status_ready.return_value = True
+    channel.recv_exit_status.return_value = 0
+    output = SshOutput('true')
+    assert list(output) == []
+    assert output.return_code == 0
+    open_ssh_channel.assert_called_once_with('true', False)
+
+
+def test_winrm_output():
+    session = mock.MagicMock()
+    protocol = session.protocol
+    protocol.get_command_output_raw.side_effect = [
+        (b'Install\xc3', b'', 0, False),
+        WinRMOperationTimeoutError(),
+        (b'\xa9 done', b'warn', 1, True),
+    ]
+    output = WinRmOutput(session, 'install', encoding='utf-8')
+    assert list(output) == [
+        ('stdout', 'Install'), ('stdout', u'\xe9 done'), ('stderr', 'warn')
+    ]
+    assert output.return_code == 1
+    assert not output.cancelled
+    command = protocol.run_command.call_args[0]
+    assert command[1] == 'powershell'
+    protocol.cleanup_command.assert_called_once_with(
+        protocol.open_shell.return_value, protocol.run_command.return_value
+    )
+    protocol.close_shell.assert_called_once_with(
+        protocol.open_shell.return_value
+    )
+
+
+@mock.patch('vcdriver.streaming.time')
+def test_winrm_output_timeout(time_mock):
+    session = mock.MagicMock()
+    protocol = session.protocol
+    protocol.get_command_output_raw.side_effect = WinRMOperationTimeoutError()
+    time_mock.time.side_effect = [0, 10, 25, 31]
+    output = WinRmOutput(session, 'hang', timeout=30)
+    with pytest.raises(TimeoutError):
+        list(output)
+    assert protocol.get_command_output_raw.call_count == 2
+    assert output.return_code is None
+    assert protocol.cleanup_command.call_count == 1
+    assert protocol.close_shell.call_count == 1
+
+
+def test_winrm_output_cancel():
+    session = mock.MagicMock()
+    protocol = session.protocol
+    del protocol.get_command_output_raw
+    protocol._raw_get_command_output.return_value = (b'a', b'', 0, False)
+    cancel = mock.MagicMock()
+    cancel.is_set.side_effect = [False, True]
+    output = WinRmOutput(session, 'install', cancel=cancel)
+    assert list(output) == [('stdout', 'a')]
+    assert output.cancelled
+    assert output.return_code is None
+    assert protocol.cleanup_command.call_count == 1
+    chunks = iter(WinRmOutput(session, 'install'))
+    assert next(chunks) == ('stdout', 'a')
+    chunks.close()
+    assert protocol.cleanup_command.call_count == 2
+    assert protocol.close_shell.call_count == 2
@@ -0,0 +1,288 @@
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+
+import mock
+
+from vcdriver.transfer import (
+    TransferResult,
+    base64_chunks,
+    file_prefix_digest,
+    gzip_file,
+    local_manifest,
+    print_throughput,
+    ssh_archive_download,
+    ssh_archive_upload,
+    ssh_remote_manifest,
+    ssh_resume_upload,
+    ssh_sync_upload,
+)
+
+
+class FakeFile(io.BytesIO):
+    def close(self):
+        pass
+
+
+def fake_channel(connections, data=b'', status=0):
+    channel = mock.MagicMock()
+    channel.file = FakeFile(data)
+    channel.makefile.return_value = channel.file
+    channel.recv_exit_status.return_value = status
+    connections.__getitem__.return_value.get_transport.return_value \
+        .open_session.return_value = channel
+    return channel
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, 'tree', 'sub'))
+    for path in ('file-0', os.path.join('sub', 'file-1')):
+        with open(os.path.join(root, 'tree', path), 'wb') as f:
+            f.write(b'\0' * 1024)
+    return os.path.join(root, 'tree')
+
+
+def test_transfer_result():
+    result = TransferResult(['a'], size=10, seconds=2)
+    assert result.succeeded
+    assert result.throughput == 5
+    assert TransferResult().throughput == 0
+    assert not TransferResult(failed=['a']).succeeded
+    print_throughput('description', result)
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_archive_upload(connections, tmpdir):
+    tree = make_tree(str(tmpdir))
+    channel = fake_channel(connections)
+    result = ssh_archive_upload(tree, '/remote/', compress=True)
+    assert sorted(result) == [
+        '/remote/tree/file-0', '/remote/tree/sub/file-1'
+    ]
+    assert result.succeeded
+    assert result.size == len(channel.file.getvalue())
+    command = channel.exec_command.call_args[0][0]
+    assert command == 'mkdir -p /remote/ && tar -xzf - -C /remote/'
+    channel.shutdown_write.assert_called_once_with()
+    channel.file.seek(0)
+    with tarfile.open(fileobj=channel.file, mode='r:gz') as archive:
+        assert 'tree/sub/file-1' in archive.getnames()
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_archive_upload_fail(connections, tmpdir):
+    tree = make_tree(str(tmpdir))
+    channel = fake_channel(connections, status=2)
+    result = ssh_archive_upload(tree, 'remote', use_sudo=True)
+    assert result.failed == [tree]
+    assert channel.exec_command.call_args[0][0].startswith('sudo -n sh -c ')
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_archive_download(connections, tmpdir):
+    tree = make_tree(str(tmpdir.join('source')))
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:') as archive:
+        archive.add(tree, arcname='tree')
+    channel = fake_channel(connections, data.getvalue())
+    destination = str(tmpdir.join('destination'))
+    result = ssh_archive_download('/remote/tree/', destination)
+    assert result.succeeded
+    assert sorted(result) == [
+        os.path.join(destination, 'tree', 'file-0'),
+        os.path.join(destination, 'tree', 'sub', 'file-1')
+    ]
+    assert os.path.isfile(os.path.join(destination, 'tree', 'sub', 'file-1'))
+    assert channel.exec_command.call_args[0][0] == 'tar -cf - -C /remote tree'
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_archive_download_fail(connections, tmpdir):
+    channel = fake_channel(connections, status=2)
+    result = ssh_archive_download('missing', str(tmpdir), compress=True)
+    assert result.failed == ['missing']
+    assert list(result) == []
+    assert channel.exec_command.call_args[0][0] == 'tar -czf - -C . missing'
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_archive_download_truncated(connections, tmpdir):
+    fake_channel(connections, b'not a tar stream')
+    result = ssh_archive_download('tree', str(tmpdir))
+    assert result.failed == ['tree']
+
+
+@mock.patch('vcdriver.transfer._EXTRACT_KWARGS', {})
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_archive_download_unsafe(connections, tmpdir):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:') as archive:
+        for name, kind, link in [
+            ('tree', tarfile.DIRTYPE, ''),
+            ('tree/file', tarfile.REGTYPE, ''),
+            ('tree/link', tarfile.SYMTYPE, 'file'),
+            ('tree/hard', tarfile.LNKTYPE, 'tree/file'),
+            ('../evil', tarfile.REGTYPE, ''),
+            ('/absolute', tarfile.REGTYPE, ''),
+            ('tree/passwd', tarfile.SYMTYPE, '/etc/passwd'),
+            ('tree/up', tarfile.SYMTYPE, '../..'),
+            ('tree/shadow', tarfile.LNKTYPE, '../shadow'),
+            ('tree/fifo', tarfile.FIFOTYPE, ''),
+        ]:
+            member = tarfile.TarInfo(name)
+            member.type = kind
+            member.linkname = link
+            archive.addfile(member, io.BytesIO())
+    fake_channel(connections, data.getvalue())
+    destination = str(tmpdir.join('destination'))
+    result = ssh_archive_download('tree', destination)
+    assert result.failed == ['tree']
+    assert sorted(result) == [
+        os.path.join(destination, 'tree', name)
+        for name in ('file', 'hard', 'link')
+    ]
+    assert sorted(os.listdir(destination)) == ['tree']
+    assert sorted(os.listdir(os.path.join(destination, 'tree'))) == [
+        'file', 'hard', 'link'
+    ]
+    assert not os.path.exists(str(tmpdir.join('evil')))
+
+
+def test_local_manifest(tmpdir):
+    tree = make_tree(str(tmpdir))
+    digest = '60cacbf3d72e1e7834203da608037b1bf83b40e8'
+    assert local_manifest(tree) == {
+        'tree/file-0': digest, 'tree/sub/file-1': digest
+    }
+    assert local_manifest(os.path.join(tree, 'file-0')) == {'file-0': digest}
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_remote_manifest(connections):
+    channel = fake_channel(
+        connections, b'abc  tree/file-0\ndef *tree/sub/file-1\n\n'
+    )
+    assert ssh_remote_manifest('/remote', 'tree') == {
+        'tree/file-0': 'abc', 'tree/sub/file-1': 'def'
+    }
+    assert channel.exec_command.call_args[0][0] == (
+        'cd /remote && find tree -type f -exec sha1sum {} +'
+    )
+
+
+@mock.patch('vcdriver.transfer.connections')
+@mock.patch('vcdriver.transfer.ssh_remote_manifest')
+def test_ssh_sync_upload(ssh_remote_manifest, connections, tmpdir):
+    tree = make_tree(str(tmpdir))
+    local = local_manifest(tree)
+    ssh_remote_manifest.return_value = {
+        'tree/file-0': local['tree/file-0'], 'tree/old': 'abc'
+    }
+    channel = fake_channel(connections)
+    result = ssh_sync_upload(tree, '/remote')
+    assert list(result) == ['/remote/tree/sub/file-1']
+    assert result.manifest == dict(local, **{'tree/old': 'abc'})
+    channel.file.seek(0)
+    with tarfile.open(fileobj=channel.file, mode='r:') as archive:
+        assert archive.getnames() == ['tree/sub/file-1']
+    connections.reset_mock()
+    result = ssh_sync_upload(tree, '/remote', result.manifest)
+    assert list(result) == []
+    assert result.size == 0
+    assert not connections.__getitem__.called
+    assert ssh_remote_manifest.call_count == 1
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_sync_upload_fail(connections, tmpdir):
+    tree = make_tree(str(tmpdir))
+    fake_channel(connections, status=2)
+    result = ssh_sync_upload(tree, '/remote', {'tree/file-0': 'abc'})
+    assert result.failed
+    assert result.manifest == {'tree/file-0': 'abc'}
+
+
+def test_gzip_file(tmpdir):
+    source = tmpdir.join('source')
+    source.write(b'a' * 10000, mode='wb')
+    compressed_path = gzip_file(str(source))
+    try:
+        assert os.stat(compressed_path).st_size < 100
+        with gzip.open(compressed_path, 'rb') as f:
+            assert f.read() == b'a' * 10000
+    finally:
+        os.remove(compressed_path)
+
+
+def test_file_prefix_digest(tmpdir):
+    path = str(tmpdir.join('file'))
+    with open(path, 'wb') as f:
+        f.write(b'0123456789')
+    assert file_prefix_digest(path, 4, block_size=3) == (
+        hashlib.sha256(b'0123').hexdigest()
+    )
+    assert file_prefix_digest(path, 0) == hashlib.sha256().hexdigest()
+    assert file_prefix_digest(path, 11) is None
+
+
+def test_base64_chunks(tmpdir):
+    path = str(tmpdir.join('file'))
+    with open(path, 'wb') as f:
+        f.write(b'0123456789')
+    assert list(base64_chunks(path, 4)) == [
+        (0, 4, 'MDEyMw=='), (4, 4, 'NDU2Nw=='), (8, 2, 'ODk=')
+    ]
+    assert list(base64_chunks(path, 4, offset=6)) == [
+        (6, 4, 'Njc4OQ==')
+    ]
+    assert list(base64_chunks(path, 4, offset=10)) == []
+    chunks = base64_chunks(path, 4)
+    next(chunks)
+    chunks.close()
+    empty_path = str(tmpdir.join('empty'))
+    open(empty_path, 'wb').close()
+    assert list(base64_chunks(empty_path, 4)) == []
+
+
+def resume_channels(connections, query_output, status=0):
+    channels = [mock.MagicMock(), mock.MagicMock()]
+    channels[0].makefile.return_value = FakeFile(query_output)
+    channels[1].file = FakeFile()
+    channels[1].makefile.return_value = channels[1].file
+    channels[1].recv_exit_status.return_value = status
+    connections.__getitem__.return_value.get_transport.return_value \
+        .open_session.side_effect = channels
+    return channels
+
+
+@mock.patch('vcdriver.transfer.connections')
+def test_ssh_resume_upload(connections, tmpdir):
+    path = str(tmpdir.join('file'))
+    with open(path, 'wb') as f:
+        f.write(b'0123456789')
+    prefix_digest = hashlib.sha256(b'0123').hexdigest()
+    channels = resume_channels(
+        connections,
+        '/remote/file\n4\n{}  -\n'.format(prefix_digest).encode('ascii')
+    )
+    result = ssh_resume_upload(path, '/remote/')
+    assert result == ['/remote/file']
+    assert result.offset == 4
+    assert result.size == 6
+    assert result.succeeded
+    assert channels[1].file.getvalue() == b'456789'
+    assert channels[1].exec_command.call_args[0][0] == (
+        'p=/remote/; [ -d "$p" ] && p="$p"/file; cat >> "$p"'
+    )
+    channels = resume_channels(
+        connections, b'/remote/file\n4\nmismatch  -\n', status=1
+    )
+    result = ssh_resume_upload(path, '/remote/file', use_sudo=True)
+    assert result.offset == 0
+    assert result.failed == [path]
+    assert channels[1].file.getvalue() == b'0123456789'
+    assert 'cat > ' in channels[1].exec_command.call_args[0][0]
+    resume_channels(connections, b'/remote/file\n')
+    assert ssh_resume_upload(path, '/remote/file').offset == 0
@@ -1,28 +1,55 @@
+import base64
+import contextlib
 import datetime
+import hashlib
 import mock
 import os
+import pickle
+import re
+import tempfile
 
+from fabric.state import env
 import pytest
 from pyVmomi import vim
+from six.moves import BaseHTTPServer
+import threading
 import winrm
 
 from vcdriver.exceptions import (
     NoObjectFound,
     TooManyObjectsFound,
+    GuestOperationError,
     SshError,
     DownloadError,
     UploadError,
     WinRmError,
     TimeoutError,
     NotEnoughDiskSpace,
+    IpError,
+    IpPoolExhausted,
+    VcenterMismatch,
 )
 from vcdriver.vm import (
     VirtualMachine,
     virtual_machines,
     snapshot,
     get_all_virtual_machines,
+    iter_virtual_machines,
+    power_off_virtual_machines,
+    query_virtual_machines,
+    power_on_virtual_machines,
 )
 from vcdriver.config import load
+from vcdriver.transfer import TransferResult
+
+
+@pytest.fixture(autouse=True)
+def wait_for_ports():
+    with mock.patch('vcdriver.readiness.wait_for_ports') as wait_for_ports:
+        wait_for_ports.side_effect = lambda addresses, timeout: dict(
+            (address, 0.0) for address in addresses
+        )
+        yield wait_for_ports
 
 
 @mock.patch('vcdriver.vm.connection')
@@ -46,9 +73,109 @@ def test_virtual_machine_create(
     vm.create()
     vm.create()
     assert vm.__getattribute__('_vm_object') is not None
+    assert vm.power_state() == 'poweredOn'
     assert wait_for_vcenter_task.call_count == 1
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_vcenter_object_by_name')
+@mock.patch('vcdriver.vm.vim.vm.CloneSpec')
+@mock.patch('vcdriver.vm.vim.vm.RelocateSpec')
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_create_static_ip(
+        get_vcenter_property,
+        wait_for_vcenter_task,
+        relocate_spec,
+        clone_spec,
+        get_vcenter_object_by_name,
+        connection
+):
+    os.environ['vcdriver_resource_pool'] = 'something'
+    os.environ['vcdriver_data_store'] = 'something'
+    os.environ['vcdriver_data_store_threshold'] = '20'
+    os.environ['vcdriver_folder'] = 'something'
+    load()
+    pool = iter(['10.0.0.2', '10.0.0.3'])
+    vm = VirtualMachine(name='apple')
+    vm.create(
+        ip_source=pool, gateway='10.0.0.1', dns_servers=['10.0.0.53'],
+        domain='example.com'
+    )
+    assert vm.ip() == '10.0.0.2'
+    customization = clone_spec.call_args[1]['customization']
+    assert customization.identity.hostName.name == 'apple'
+    assert customization.identity.domain == 'example.com'
+    assert customization.globalIPSettings.dnsSuffixList == ['example.com']
+    adapter = customization.nicSettingMap[0].adapter
+    assert adapter.ip.ipAddress == '10.0.0.2'
+    assert adapter.gateway == ['10.0.0.1']
+    assert adapter.dnsServerList == ['10.0.0.53']
+    vm = VirtualMachine(name='pear')
+    vm.create(ip_source=pool, hostname='pear-host', windows=True)
+    assert vm.ip() == '10.0.0.3'
+    customization = clone_spec.call_args[1]['customization']
+    assert customization.identity.userData.computerName.name == 'pear-host'
+    assert customization.identity.userData.fullName == 'pear-host'
+    assert customization.identity.guiUnattended.timeZone == 85
+    assert customization.identity.guiUnattended.password is None
+    assert customization.nicSettingMap[0].adapter.gateway == []
+    assert vm.__getstate__()['_ip_pool'] is None
+    vm.destroy()
+    # The address of the destroyed machine goes back to the pool
+    vm = VirtualMachine(name='quince')
+    vm.create(
+        ip_source=pool, windows=True, time_zone=4, full_name='CI',
+        org_name='Example', admin_password='secret'
+    )
+    assert vm.ip() == '10.0.0.3'
+    identity = clone_spec.call_args[1]['customization'].identity
+    assert identity.guiUnattended.timeZone == 4
+    assert identity.guiUnattended.password.value == 'secret'
+    assert identity.guiUnattended.password.plainText
+    assert (identity.userData.fullName, identity.userData.orgName) == (
+        'CI', 'Example'
+    )
+    vm.destroy()
+    # And so does the address of a failed clone, unless it timed out
+    wait_for_vcenter_task.side_effect = vim.fault.InsufficientResourcesFault
+    with pytest.raises(vim.fault.InsufficientResourcesFault):
+        VirtualMachine().create(ip_source=pool)
+    wait_for_vcenter_task.side_effect = TimeoutError('Clone', 10)
+    with pytest.raises(TimeoutError):
+        VirtualMachine().create(ip_source=pool)
+    wait_for_vcenter_task.side_effect = vim.fault.InsufficientResourcesFault
+    with pytest.raises(vim.fault.InsufficientResourcesFault):
+        VirtualMachine().create(ip_source='10.0.0.9')
+    wait_for_vcenter_task.side_effect = None
+    with pytest.raises(IpPoolExhausted):
+        VirtualMachine().create(ip_source=pool)
+    pool = iter(['10.0.3.2', '10.0.3.3'])
+    machines = [VirtualMachine(), VirtualMachine()]
+    for machine in machines:
+        machine.create(ip_source=pool)
+    for machine in machines:
+        machine.destroy()
+    for ip in ('10.0.3.2', '10.0.3.3'):
+        vm = VirtualMachine()
+        vm.create(ip_source=pool)
+        assert vm.ip() == ip
+    with pytest.raises(IpError):
+        VirtualMachine().create(ip_source=iter(['10.0.0.256']))
+    for ip_source in (['10.0.0.4'], 42):
+        with pytest.raises(TypeError):
+            VirtualMachine().create(ip_source=ip_source)
+    vm = VirtualMachine(name='plum')
+    vm.create(ip_source=lambda machine: '10.0.1.{}'.format(len(machine.name)))
+    assert vm.ip() == '10.0.1.4'
+    vm = VirtualMachine()
+    vm.create(ip_source='10.0.2.2')
+    assert vm.ip() == '10.0.2.2'
+    with pytest.raises(IpError):
+        VirtualMachine().create(ip_source='::1')
+    assert wait_for_vcenter_task.call_count == 20
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.get_vcenter_object_by_name')
 @mock.patch('vcdriver.vm.vim.vm.CloneSpec')
@@ -75,7 +202,10 @@ def test_virtual_machine_create_not_enough_disk_space(
 
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
-def test_virtual_machine_destroy_vm_on(wait_for_vcenter_task, connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_destroy_vm_on(
+        get_vcenter_property, wait_for_vcenter_task, connection
+):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     vm.__setattr__('_vm_object', vm_object_mock)
@@ -87,7 +217,10 @@ def test_virtual_machine_destroy_vm_on(wait_for_vcenter_task, connection):
 
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
-def test_virtual_machine_destroy_vm_off(wait_for_vcenter_task, connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_destroy_vm_off(
+        get_vcenter_property, wait_for_vcenter_task, connection
+):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     vm.__setattr__('_vm_object', vm_object_mock)
@@ -108,42 +241,131 @@ def test_virtual_machine_find(get_vcenter_object_by_name, connection):
     assert get_vcenter_object_by_name.call_count == 1
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_virtual_machine_by_uuid')
+def test_virtual_machine_from_instance_uuid(
+        get_virtual_machine_by_uuid, connection
+):
+    get_virtual_machine_by_uuid.return_value.name = 'apple'
+    vm = VirtualMachine.from_instance_uuid('uuid', timeout=10)
+    assert vm.name == 'apple'
+    assert vm.timeout == 10
+    assert vm._vm_object == get_virtual_machine_by_uuid.return_value
+    get_virtual_machine_by_uuid.assert_called_once_with(
+        connection.return_value, 'uuid'
+    )
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_vcenter_object_by_id')
+def test_virtual_machine_from_vm_id(get_vcenter_object_by_id, connection):
+    get_vcenter_object_by_id.return_value.name = 'apple'
+    vm = VirtualMachine.from_vm_id('vm-42', template='template')
+    assert vm.name == 'apple'
+    assert vm.template == 'template'
+    get_vcenter_object_by_id.assert_called_once_with(
+        connection.return_value, vim.VirtualMachine, 'vm-42'
+    )
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.get_vcenter_object_by_name')
-@mock.patch('vcdriver.vm.close')
-def test_virtual_machine_refresh(
-    close, get_vcenter_object_by_name, connection
+@mock.patch('vcdriver.vm.get_vcenter_object_by_id')
+def test_virtual_machine_pickle(
+        get_vcenter_object_by_id, get_vcenter_object_by_name, connection
 ):
+    vm = VirtualMachine(name='apple', template='template', timeout=10)
+    unbound = pickle.loads(pickle.dumps(vm))
+    assert unbound._vm_object is None
+    assert (unbound.name, unbound.template) == ('apple', 'template')
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock._moId = 'vm-42'
+    vm_object_mock._stub.host = 'vcenter:443'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm._power_state = 'poweredOn'
+    vm._winrm_scripts.add('digest')
+    handle = pickle.loads(pickle.dumps(vm))
+    assert handle.timeout == 10
+    assert handle._winrm_scripts == {'digest'}
+    assert handle._power_state is None
+    assert not get_vcenter_object_by_id.called
+    handle = pickle.loads(pickle.dumps(handle))
+    connection.return_value._stub.host = 'vcenter:443'
+    assert handle._vm_object == get_vcenter_object_by_id.return_value
+    assert handle._vm_object == get_vcenter_object_by_id.return_value
+    get_vcenter_object_by_id.assert_called_once_with(
+        connection.return_value, vim.VirtualMachine, 'vm-42'
+    )
+    handle = pickle.loads(pickle.dumps(vm))
+    connection.return_value._stub.host = 'other-vcenter:443'
+    with pytest.raises(VcenterMismatch):
+        handle._vm_object
+    assert not get_vcenter_object_by_name.called
+    connection.return_value._stub.host = 'vcenter:443'
+    get_vcenter_object_by_id.side_effect = [Exception('expired'), 'vm']
+    with pytest.raises(Exception):
+        handle._vm_object
+    assert handle._vm_object == 'vm'
+    with pytest.raises(AttributeError):
+        handle.whatever
+
+
+@mock.patch('vcdriver.vm._bind_lock')
+def test_virtual_machine_pickle_bound_meanwhile(bind_lock):
+    vm = VirtualMachine(name='apple')
+    vm.__setattr__('_vm_object', None)
+    handle = pickle.loads(pickle.dumps(vm))
+
+    def bind():
+        # Another thread binds the handle while this one waits for the lock
+        del handle.__dict__['_vm_id'], handle.__dict__['_vcenter_host']
+        handle.__dict__['_vm_object'] = 'vm'
+    bind_lock.__enter__.side_effect = bind
+    assert handle._vm_object == 'vm'
+
+
+@mock.patch('vcdriver.vm.get_vcenter_object_by_id')
+@mock.patch('vcdriver.vm.renew')
+def test_virtual_machine_refresh(renew, get_vcenter_object_by_id):
     vm = VirtualMachine()
     assert vm.__getattribute__('_vm_object') is None
 
     # Test that refresh does nothing if no _vm_object
     vm.refresh()
     assert vm.__getattribute__('_vm_object') is None
+    assert not renew.called
 
-    # Test that refresh assigns a new _vm_object
-    vm.__setattr__('_vm_object', mock.Mock())
-
-    initial__vm_object = vm.__getattribute__('_vm_object')
-    assert initial__vm_object is not None
+    # Test that refresh keeps the _vm_object of the renewed connection
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock._stub = renew.return_value._stub
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm._power_state = 'poweredOn'
     vm.refresh()
+    assert vm.__getattribute__('_vm_object') is vm_object_mock
+    assert vm._power_state is None
+    assert not get_vcenter_object_by_id.called
 
-    refreshed__vm_object = vm.__getattribute__('_vm_object')
-    assert refreshed__vm_object is not None
-
-    assert initial__vm_object != refreshed__vm_object
-
-    close.assert_called_once()
-    get_vcenter_object_by_name.assert_called_once()
+    # Test that refresh binds the _vm_object by ID to a new connection
+    vm_object_mock._moId = 'vm-42'
+    vm_object_mock._stub = mock.MagicMock()
+    vm.refresh()
+    assert vm.__getattribute__('_vm_object') is (
+        get_vcenter_object_by_id.return_value
+    )
+    get_vcenter_object_by_id.assert_called_once_with(
+        renew.return_value, vim.VirtualMachine, 'vm-42'
+    )
+    assert renew.call_count == 2
 
 
 @mock.patch('vcdriver.vm.connection')
-def test_virtual_machine_reboot(connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_reboot(get_vcenter_property, connection):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     reboot_mock = mock.MagicMock()
     vm_object_mock.RebootGuest = reboot_mock
-    vm_object_mock.summary.runtime.powerState = 'poweredOn'
+    get_vcenter_property.return_value = 'poweredOn'
     vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
     vm.reboot()
     vm.__setattr__('_vm_object', vm_object_mock)
@@ -152,11 +374,14 @@ def test_virtual_machine_reboot(connection):
 
 
 @mock.patch('vcdriver.vm.connection')
-def test_virtual_machine_reboot_wrong_power_state(connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_reboot_wrong_power_state(
+        get_vcenter_property, connection
+):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     reboot_mock = mock.MagicMock()
-    vm_object_mock.summary.runtime.powerState = 'poweredOff'
+    get_vcenter_property.return_value = 'poweredOff'
     vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
     vm_object_mock.RebootGuest = reboot_mock
     vm.reboot()
@@ -166,12 +391,13 @@ def test_virtual_machine_reboot_wrong_power_state(connection):
 
 
 @mock.patch('vcdriver.vm.connection')
-def test_virtual_machine_shutdown(connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_shutdown(get_vcenter_property, connection):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     shutdown_mock = mock.MagicMock()
     vm_object_mock.ShutdownGuest = shutdown_mock
-    vm_object_mock.summary.runtime.powerState = 'poweredOn'
+    get_vcenter_property.return_value = 'poweredOn'
     vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
     vm.shutdown()
     vm.__setattr__('_vm_object', vm_object_mock)
@@ -180,12 +406,15 @@ def test_virtual_machine_shutdown(connection):
 
 
 @mock.patch('vcdriver.vm.connection')
-def test_virtual_machine_shutdown_wrong_power_state(connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_shutdown_wrong_power_state(
+        get_vcenter_property, connection
+):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     shutdown_mock = mock.MagicMock()
     vm_object_mock.ShutdownGuest = shutdown_mock
-    vm_object_mock.summary.runtime.powerState = 'poweredOff'
+    get_vcenter_property.return_value = 'poweredOff'
     vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
     vm.shutdown()
     vm.__setattr__('_vm_object', vm_object_mock)
@@ -195,7 +424,10 @@ def test_virtual_machine_shutdown_wrong_power_state(connection):
 
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
-def test_virtual_machine_power_on(wait_for_vcenter_task, connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_power_on(
+        get_vcenter_property, wait_for_vcenter_task, connection
+):
     vm = VirtualMachine()
     vm.power_on()
     vm.__setattr__('_vm_object', mock.MagicMock())
@@ -205,8 +437,9 @@ def test_virtual_machine_power_on(wait_for_vcenter_task, connection):
 
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
+@mock.patch('vcdriver.vm.get_vcenter_property')
 def test_virtual_machine_power_on_wrong_power_state(
-        wait_for_vcenter_task, connection
+        get_vcenter_property, wait_for_vcenter_task, connection
 ):
     wait_for_vcenter_task.side_effect = vim.fault.InvalidPowerState
     vm = VirtualMachine()
@@ -216,9 +449,108 @@ def test_virtual_machine_power_on_wrong_power_state(
     assert wait_for_vcenter_task.call_count == 1
 
 
+@mock.patch('vcdriver.vm.get_vcenter_parents')
+@mock.patch('vcdriver.vm.wait_for_vcenter_tasks')
+def test_power_on_virtual_machines(
+        wait_for_vcenter_tasks, get_vcenter_parents
+):
+    datacenters = [mock.MagicMock(vim.Datacenter) for _ in range(2)]
+    folder, vapp, lost_folder = [mock.MagicMock() for _ in range(3)]
+    parents = {folder: datacenters[0], vapp: datacenters[1]}
+    get_vcenter_parents.return_value = parents
+    vms = [VirtualMachine(timeout=timeout) for timeout in (1, 5, 2, 3, 4)]
+    for vm in vms[:3]:
+        vm._vm_object = mock.MagicMock()
+        parents[vm._vm_object] = folder
+    vms[3]._vm_object = mock.MagicMock()
+    parents[vms[3]._vm_object] = vapp
+    task = mock.MagicMock()
+    insufficient_resources = vim.fault.InsufficientResourcesFault()
+    no_permission = vim.fault.NoPermission()
+    power_on_result = mock.MagicMock(vim.cluster.PowerOnVmResult)
+    power_on_result.attempted = [
+        mock.MagicMock(vm=vms[0]._vm_object, task=task),
+        mock.MagicMock(vm=vms[1]._vm_object, task=None),
+    ]
+    power_on_result.notAttempted = [
+        mock.MagicMock(vm=vms[2]._vm_object, fault=insufficient_resources)
+    ]
+    wait_for_vcenter_tasks.side_effect = [
+        [power_on_result, no_permission], [vim.fault.InvalidPowerState()]
+    ]
+    assert power_on_virtual_machines(vms) == {
+        vms[0]: None,
+        vms[1]: None,
+        vms[2]: insufficient_resources,
+        vms[3]: no_permission,
+    }
+    assert [vm._power_state for vm in vms] == [
+        'poweredOn', 'poweredOn', None, None, None
+    ]
+    get_vcenter_parents.assert_called_with(
+        [vm._vm_object for vm in vms[:4]]
+    )
+    (tasks, _, timeout), _ = wait_for_vcenter_tasks.call_args_list[0]
+    assert tasks == [
+        datacenter.PowerOnMultiVM_Task.return_value
+        for datacenter in datacenters
+    ]
+    assert timeout == 5
+    _, kwargs = datacenters[0].PowerOnMultiVM_Task.call_args
+    assert kwargs['vm'] == [vm._vm_object for vm in vms[:3]]
+    assert kwargs['option'][0].value == 'fullyAutomated'
+    assert wait_for_vcenter_tasks.call_args_list[1][0][0] == [task]
+    wait_for_vcenter_tasks.reset_mock()
+    wait_for_vcenter_tasks.side_effect = [[no_permission]]
+    assert power_on_virtual_machines(vms[3:], timeout=7) == {
+        vms[3]: no_permission
+    }
+    assert wait_for_vcenter_tasks.call_args[0][2] == 7
+    assert power_on_virtual_machines([VirtualMachine()]) == {}
+    orphan = VirtualMachine()
+    orphan._vm_object = mock.MagicMock()
+    parents[orphan._vm_object] = lost_folder
+    wait_for_vcenter_tasks.reset_mock()
+    wait_for_vcenter_tasks.side_effect = [[None]]
+    with mock.patch('vcdriver.vm.time.time') as time_mock:
+        time_mock.side_effect = [100, 130]
+        assert power_on_virtual_machines([orphan]) == {orphan: None}
+    wait_for_vcenter_tasks.assert_called_once_with(
+        [orphan._vm_object.PowerOnVM_Task.return_value],
+        'Power on tasks of 1 virtual machines', orphan.timeout - 30
+    )
+    assert orphan._power_state == 'poweredOn'
+
+
+@mock.patch('vcdriver.vm.wait_for_vcenter_tasks')
+def test_power_off_virtual_machines(wait_for_vcenter_tasks):
+    vms = [VirtualMachine(timeout=timeout) for timeout in (1, 5, 2, 3)]
+    for vm in vms[:3]:
+        vm._vm_object = mock.MagicMock()
+    no_permission = vim.fault.NoPermission()
+    wait_for_vcenter_tasks.return_value = [
+        None, vim.fault.InvalidPowerState(), no_permission
+    ]
+    assert power_off_virtual_machines(vms) == {
+        vms[0]: None, vms[1]: None, vms[2]: no_permission
+    }
+    assert [vm._power_state for vm in vms] == [
+        'poweredOff', 'poweredOff', None, None
+    ]
+    tasks, _, timeout = wait_for_vcenter_tasks.call_args[0]
+    assert tasks == [vm._vm_object.PowerOffVM_Task() for vm in vms[:3]]
+    assert timeout == 5
+    power_off_virtual_machines(vms, timeout=7)
+    assert wait_for_vcenter_tasks.call_args[0][2] == 7
+    assert power_off_virtual_machines(vms[3:]) == {}
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
-def test_virtual_machine_power_off(wait_for_vcenter_task, connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_power_off(
+        get_vcenter_property, wait_for_vcenter_task, connection
+):
     vm = VirtualMachine()
     mock_schedule_vcenter_task_on_vm = mock.MagicMock()
     vm.__setattr__(
@@ -252,7 +584,10 @@ def test_virtual_machine_power_off_with_delay(
 
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
-def test_virtual_machine_reset(wait_for_vcenter_task, connection):
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_reset(
+        get_vcenter_property, wait_for_vcenter_task, connection
+):
     vm = VirtualMachine()
     vm.reset()
     vm.__setattr__('_vm_object', mock.MagicMock())
@@ -262,8 +597,9 @@ def test_virtual_machine_reset(wait_for_vcenter_task, connection):
 
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
+@mock.patch('vcdriver.vm.get_vcenter_property')
 def test_virtual_machine_reset_wrong_power_state(
-        wait_for_vcenter_task, connection
+        get_vcenter_property, wait_for_vcenter_task, connection
 ):
     wait_for_vcenter_task.side_effect = vim.fault.InvalidPowerState
     vm = VirtualMachine()
@@ -273,6 +609,102 @@ def test_virtual_machine_reset_wrong_power_state(
     assert wait_for_vcenter_task.call_count == 1
 
 
+@mock.patch('vcdriver.vm.inventory_mirror')
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_power_state(get_vcenter_property, inventory_mirror):
+    inventory_mirror.return_value = None
+    vm = VirtualMachine()
+    assert vm.power_state() is None
+    vm_object_mock = mock.MagicMock()
+    get_vcenter_property.return_value = 'poweredOn'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    assert vm.power_state() == 'poweredOn'
+    get_vcenter_property.return_value = 'poweredOff'
+    assert vm.power_state() == 'poweredOn'
+    assert vm.power_state(refresh=True) == 'poweredOff'
+    get_vcenter_property.assert_called_with(
+        vm_object_mock, 'runtime.powerState'
+    )
+    inventory_mirror.return_value = mock.MagicMock()
+    inventory_mirror.return_value.get_property.return_value = 'suspended'
+    assert vm.power_state() == 'suspended'
+    inventory_mirror.return_value.get_property.side_effect = KeyError
+    assert vm.power_state() == 'poweredOff'
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_power_tasks_skipped(
+        get_vcenter_property, wait_for_vcenter_task, connection
+):
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    get_vcenter_property.return_value = 'poweredOff'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm.power_off()
+    vm.reset()
+    vm.destroy()
+    assert vm.skipped_tasks == 3
+    assert wait_for_vcenter_task.call_count == 1
+    assert vm_object_mock.PowerOffVM_Task.call_count == 0
+    assert vm_object_mock.ResetVM_Task.call_count == 0
+    vm = VirtualMachine()
+    get_vcenter_property.return_value = 'poweredOn'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm.power_on()
+    vm.power_off()
+    vm.power_off()
+    vm.power_on()
+    vm.power_on()
+    assert vm.skipped_tasks == 3
+    assert vm.power_state() == 'poweredOn'
+    # A suspended machine is reset, which powers it on
+    get_vcenter_property.return_value = 'suspended'
+    vm.reset()
+    assert vm.skipped_tasks == 3
+    assert vm_object_mock.ResetVM_Task.call_count == 1
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_power_state_stale(
+        get_vcenter_property, wait_for_vcenter_task, connection
+):
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    get_vcenter_property.return_value = 'poweredOn'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm.power_on()
+    assert vm.skipped_tasks == 1
+    # The guest powers itself off e.g. with "sudo poweroff"
+    get_vcenter_property.return_value = 'poweredOff'
+    vm.power_on()
+    assert vm.skipped_tasks == 1
+    assert vm_object_mock.PowerOnVM_Task.call_count == 1
+    assert vm.power_state() == 'poweredOn'
+    # The state changes between the read and the task
+    get_vcenter_property.return_value = 'poweredOn'
+    wait_for_vcenter_task.side_effect = vim.fault.InvalidPowerState
+    vm.power_off()
+    assert vm.__getattribute__('_power_state') is None
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_shutdown_forgets_power_state(
+        get_vcenter_property, connection
+):
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    get_vcenter_property.return_value = 'poweredOn'
+    vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm.shutdown()
+    assert vm.__getattribute__('_power_state') is None
+
+
 def test_virtual_machine_vm_id_return_none():
     vm = VirtualMachine()
     vm_id = vm.vm_id()
@@ -327,7 +759,9 @@ def test_virtual_machine_ip_timeout(connection):
 @mock.patch('vcdriver.vm.sudo')
 @mock.patch('vcdriver.vm.run')
 @mock.patch('vcdriver.helpers.run')
-def test_virtual_machine_ssh_success(helpers_run, vm_run, sudo, connection):
+def test_virtual_machine_ssh_success(
+        helpers_run, vm_run, sudo, connection, wait_for_ports
+):
     os.environ['vcdriver_vm_ssh_username'] = 'user'
     os.environ['vcdriver_vm_ssh_password'] = 'pass'
     load()
@@ -345,6 +779,7 @@ def test_virtual_machine_ssh_success(helpers_run, vm_run, sudo, connection):
     assert vm.ssh('whatever', use_sudo=False).return_code == 3
     assert vm.ssh('whatever', use_sudo=True).return_code == 3
     assert vm.ssh('whatever', quiet=True).return_code == 3
+    assert wait_for_ports.call_args[0][0] == [('127.0.0.1', 22)]
 
 
 @mock.patch('vcdriver.vm.connection')
@@ -380,6 +815,44 @@ def test_virtual_machine_ssh_timeout(helpers_run, vm_run, connection):
         vm.ssh('whatever', use_sudo=True)
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.SshOutput')
+@mock.patch('vcdriver.vm.run')
+@mock.patch('vcdriver.helpers.run')
+def test_virtual_machine_ssh_lines(
+        helpers_run, vm_run, ssh_output, connection
+):
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert list(vm.ssh_lines('whatever')) == []
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    lines = [('stdout', 'one'), ('stderr', 'two'), ('stdout', 'three')]
+    hosts = []
+    ssh_output.return_value.open.side_effect = (
+        lambda: hosts.append(env.host_string)
+    )
+
+    def iterate():
+        hosts.append(env.host_string)
+        return iter(lines)
+    ssh_output.return_value.__iter__.side_effect = iterate
+    ssh_output.return_value.return_code = 0
+    assert list(vm.ssh_lines('build', use_sudo=True)) == lines
+    ssh_output.assert_called_with('build', True)
+    assert hosts == ['user@127.0.0.1', None]
+    callback = mock.MagicMock()
+    vm.ssh_stream('build', callback)
+    assert callback.call_args_list == [mock.call(*line) for line in lines]
+    ssh_output.return_value.return_code = 2
+    with pytest.raises(SshError) as error:
+        vm.ssh_stream('build', callback, tail_lines=1)
+    assert 'STDOUT: three. STDERR: two.' in str(error.value)
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.put')
 @mock.patch('vcdriver.vm.run')
@@ -402,6 +875,31 @@ def test_virtual_machine_ssh_upload_success(
     assert vm.ssh_upload('from', 'to', quiet=True) == result_mock
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.ssh_archive_upload')
+@mock.patch('vcdriver.vm.run')
+@mock.patch('vcdriver.helpers.run')
+def test_virtual_machine_ssh_upload_archive(
+        helpers_run, vm_run, ssh_archive_upload, connection
+):
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    ssh_archive_upload.return_value = TransferResult(['to/from'], size=1)
+    assert vm.ssh_upload('to', 'from', archive=True) == ['to/from']
+    assert vm.ssh_upload(
+        'to', 'from', archive=True, compress=True, quiet=True
+    ) == ['to/from']
+    ssh_archive_upload.assert_called_with('from', 'to', False, True)
+    ssh_archive_upload.return_value = TransferResult(failed=['from'])
+    with pytest.raises(UploadError):
+        vm.ssh_upload('to', 'from', archive=True)
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.put')
 @mock.patch('vcdriver.vm.run')
@@ -440,6 +938,69 @@ def test_virtual_machine_ssh_download_success(
     assert vm.ssh_download('from', 'to', quiet=True) == result_mock
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.ssh_sync_upload')
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+@mock.patch('vcdriver.vm.run')
+@mock.patch('vcdriver.helpers.run')
+@mock.patch('vcdriver.vm.get_vcenter_property')
+def test_virtual_machine_ssh_upload_sync(
+        get_vcenter_property, helpers_run, vm_run, wait_for_vcenter_task,
+        ssh_sync_upload, connection
+):
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm.find_snapshot = mock.MagicMock()
+    synced = TransferResult(['to/from'], size=1)
+    synced.manifest = {'from': 'abc'}
+    ssh_sync_upload.return_value = synced
+    assert vm.ssh_upload('to', 'from', sync=True) == ['to/from']
+    assert vm.ssh_upload('to', 'from', sync=True, quiet=True) == ['to/from']
+    key = ('to', os.path.abspath('from'))
+    assert ssh_sync_upload.call_args[0][2] == {'from': 'abc'}
+    ssh_sync_upload.return_value = TransferResult(failed=['from'])
+    with pytest.raises(UploadError):
+        vm.ssh_upload('to', 'from', sync=True)
+    assert key not in vm._ssh_manifests
+    ssh_sync_upload.return_value = synced
+    vm.ssh_upload('to', 'from', sync=True)
+    vm.revert_snapshot('snapshot')
+    assert vm._ssh_manifests == {}
+    vm.ssh_upload('to', 'from', sync=True)
+    vm.destroy()
+    assert vm._ssh_manifests == {}
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.ssh_archive_download')
+@mock.patch('vcdriver.vm.run')
+@mock.patch('vcdriver.helpers.run')
+def test_virtual_machine_ssh_download_archive(
+        helpers_run, vm_run, ssh_archive_download, connection
+):
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    ssh_archive_download.return_value = TransferResult(['to/from'], size=1)
+    assert vm.ssh_download('from', 'to', archive=True) == ['to/from']
+    assert vm.ssh_download(
+        'from', 'to', archive=True, use_sudo=True, quiet=True
+    ) == ['to/from']
+    ssh_archive_download.assert_called_with('from', 'to', True, False)
+    ssh_archive_download.return_value = TransferResult(failed=['from'])
+    with pytest.raises(DownloadError):
+        vm.ssh_download('from', 'to', archive=True)
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.get')
 @mock.patch('vcdriver.vm.run')
@@ -474,6 +1035,133 @@ def test_virtual_machine_winrm_success(run_ps, connection):
     assert run_ps.call_count == 4
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(VirtualMachine, '_winrm_upload_chunks')
+@mock.patch.object(VirtualMachine, '_run_winrm_ps')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_script(
+        run_ps, run_winrm_ps, winrm_upload_chunks, connection
+):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert vm.winrm_script('whatever') is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    run_ps.return_value.status_code = 0
+    script = u'param($Name) Write-Output "caf\xe9 $Name"'
+    digest = hashlib.sha256(
+        b'\xef\xbb\xbf' + script.encode('utf-8')
+    ).hexdigest()
+    missing = 'vcdriver: missing script {}'.format(digest)
+    verified = (0, digest.upper() + '\r\n', '')
+    run_winrm_ps.side_effect = [
+        (0, '', ''), verified, (0, 'done', ''), (0, 'done', ''),
+        (1, missing, ''), (0, '', ''), verified, (0, 'done', ''),
+    ]
+    assert vm.winrm_script(script, {'Name': "it's"}) == (0, 'done', '')
+    assert winrm_upload_chunks.call_count == 1
+    _, temporary_path, local_path, _, _ = winrm_upload_chunks.call_args[0]
+    remote_path = '$env:TEMP\\vcdriver-{}.ps1'.format(digest)
+    assert temporary_path.startswith(remote_path + '.')
+    assert temporary_path.endswith('.tmp')
+    assert not os.path.exists(local_path)
+    move = run_winrm_ps.call_args_list[1][0][1]
+    assert 'Move-Item -LiteralPath "{}" -Destination "{}" -Force'.format(
+        temporary_path, remote_path
+    ) in move
+    invocation = run_winrm_ps.call_args[0][1]
+    run_block = (
+        '& ([ScriptBlock]::Create([IO.File]::ReadAllText("{}")))'.format(
+            remote_path
+        )
+    )
+    assert run_block + ' -Name \'it\'\'s\';' in invocation
+    assert 'catch { Write-Error $_; exit 1 }' in invocation
+    assert 'if (-not $ok) { exit 1 }' in invocation
+    vm.winrm_script(script, ['a', 'b'], quiet=True)
+    assert winrm_upload_chunks.call_count == 1
+    assert run_block + ' \'a\' \'b\';' in run_winrm_ps.call_args[0][1]
+    assert vm.winrm_script(script) == (0, 'done', '')
+    assert winrm_upload_chunks.call_count == 2
+    vm = VirtualMachine()
+    vm.__setattr__('_vm_object', vm_object_mock)
+    run_winrm_ps.side_effect = [
+        (0, digest.upper() + '\r\n', ''), (2, '', 'failed'), (2, '', '')
+    ]
+    with pytest.raises(WinRmError):
+        vm.winrm_script(script)
+    assert winrm_upload_chunks.call_count == 2
+    with pytest.raises(WinRmError):
+        vm.winrm_script(script, quiet=True)
+    vm = VirtualMachine()
+    vm.__setattr__('_vm_object', vm_object_mock)
+    run_winrm_ps.side_effect = [(0, '', ''), (0, 'truncated', '')]
+    with pytest.raises(UploadError):
+        vm.winrm_script(script)
+    assert digest not in vm._winrm_scripts
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.WinRmOutput')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_chunks(run_ps, winrm_output, connection):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert list(vm.winrm_chunks('whatever')) == []
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    run_ps.return_value.status_code = 0
+    chunks = [('stdout', 'Inst'), ('stderr', 'warn'), ('stdout', 'alled')]
+    winrm_output.return_value.__iter__.side_effect = lambda: iter(chunks)
+    winrm_output.return_value.return_code = 0
+    winrm_output.return_value.cancelled = False
+    assert list(
+        vm.winrm_chunks('install', encoding='cp850', timeout=60)
+    ) == chunks
+    session, script, encoding, cancel, timeout = winrm_output.call_args[0]
+    assert (script, encoding, cancel, timeout) == (
+        'install', 'cp850', None, 60
+    )
+    assert session.protocol.operation_timeout_sec == 20
+    callback = mock.MagicMock()
+    vm.winrm_stream('install', callback)
+    assert callback.call_args_list == [mock.call(*chunk) for chunk in chunks]
+    winrm_output.return_value.return_code = 1
+    with pytest.raises(WinRmError) as error:
+        vm.winrm_stream('install', callback, tail_chunks=1)
+    assert 'STDOUT: alled. STDERR: warn.' in str(error.value)
+    with pytest.raises(WinRmError) as error:
+        vm.winrm_stream('install', callback, tail_size=3)
+    assert 'STDOUT: led. STDERR: arn.' in str(error.value)
+    winrm_output.return_value.cancelled = True
+    vm.winrm_stream('install', callback)
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_readiness_ports(
+        run_ps, connection, wait_for_ports
+):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    run_ps.return_value.status_code = 0
+    vm.winrm('script', dict())
+    assert wait_for_ports.call_args[0][0] == [('127.0.0.1', 5985)]
+    vm.winrm('script', dict(transport='ssl'))
+    assert wait_for_ports.call_args[0][0] == [('127.0.0.1', 5986)]
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch.object(winrm.Session, 'run_ps')
 def test_virtual_machine_winrm_fail(run_ps, connection):
@@ -507,11 +1195,11 @@ def test_virtual_machine_winrm_timeout(run_ps, connection):
 
 
 @mock.patch('vcdriver.vm.os.stat')
-@mock.patch('vcdriver.vm.open')
+@mock.patch('vcdriver.vm.base64_chunks')
 @mock.patch('vcdriver.vm.connection')
 @mock.patch.object(winrm.Session, 'run_ps')
 def test_virtual_machine_winrm_upload_success(
-        run_ps, connection, open, os_stat
+        run_ps, connection, base64_chunks, os_stat
 ):
     st_size_mock = mock.Mock()
     st_size_mock.st_size = 3
@@ -519,10 +1207,7 @@ def test_virtual_machine_winrm_upload_success(
     code_mock = mock.Mock()
     code_mock.status_code = 0
     run_ps.return_value = code_mock
-    read_mock = mock.Mock
-    read_mock.read = lambda x, y: b'\0\0\0'
-    open.__enter__ = read_mock
-    open.__exit__ = mock.Mock()
+    base64_chunks.return_value = [(0, 2, 'AAA='), (2, 1, 'AA==')]
     os.environ['vcdriver_vm_winrm_username'] = 'user'
     os.environ['vcdriver_vm_winrm_password'] = 'pass'
     load()
@@ -535,11 +1220,162 @@ def test_virtual_machine_winrm_upload_success(
     assert vm.winrm_upload('whatever', 'whatever', step=2, quiet=True) is None
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(VirtualMachine, '_run_winrm_ps')
+def test_virtual_machine_winrm_upload_resume(run_winrm_ps, connection):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    local_path = os.path.join(tempfile.mkdtemp(), 'file')
+    with open(local_path, 'wb') as f:
+        f.write(b'0123456789')
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    run_winrm_ps.side_effect = [
+        (0, '4\r\n{}\r\n'.format(
+            hashlib.sha256(b'0123').hexdigest().upper()
+        ), ''),
+        (0, '', ''), (0, '', ''),
+    ]
+    vm.winrm_upload('C:\\file', local_path, step=4, resume=True)
+    scripts = [call[0][1] for call in run_winrm_ps.call_args_list]
+    assert 'Get-Item -path C:\\file' in scripts[0]
+    assert [
+        base64.b64decode(re.search(r'String\("([^"]*)"', script).group(1))
+        for script in scripts[1:]
+    ] == [b'4567', b'89']
+    run_winrm_ps.reset_mock()
+    run_winrm_ps.side_effect = [
+        (0, '4\r\nMISMATCH\r\n', ''), (0, '', ''), (0, '', ''),
+        (0, '', ''), (0, '', ''),
+    ]
+    vm.winrm_upload('C:\\file', local_path, step=4, resume=True, quiet=True)
+    scripts = [call[0][1] for call in run_winrm_ps.call_args_list]
+    assert 'Remove-Item' in scripts[1]
+    assert len(scripts) == 5
+    run_winrm_ps.reset_mock()
+    run_winrm_ps.side_effect = [(0, '', '')] * 5
+    vm.winrm_upload('C:\\file', local_path, step=4, resume=True, quiet=True)
+    assert 'Remove-Item' in run_winrm_ps.call_args_list[1][0][1]
+    run_winrm_ps.reset_mock()
+    for options in ({'compress': True}, {'parallel': 2}):
+        with pytest.raises(ValueError):
+            vm.winrm_upload('C:\\file', local_path, resume=True, **options)
+    assert run_winrm_ps.call_count == 0
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.ssh_resume_upload')
+@mock.patch('vcdriver.vm.run')
+@mock.patch('vcdriver.helpers.run')
+def test_virtual_machine_ssh_upload_resume(
+        helpers_run, vm_run, ssh_resume_upload, connection
+):
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    ssh_resume_upload.return_value = TransferResult(['to'], size=1)
+    assert vm.ssh_upload('to', 'from', resume=True) == ['to']
+    assert vm.ssh_upload('to', 'from', resume=True, quiet=True) == ['to']
+    ssh_resume_upload.assert_called_with('from', 'to', False)
+    ssh_resume_upload.return_value = TransferResult(failed=['from'])
+    with pytest.raises(UploadError):
+        vm.ssh_upload('to', 'from', resume=True)
+    for options in ({'archive': True}, {'sync': True}):
+        with pytest.raises(ValueError):
+            vm.ssh_upload('to', 'from', resume=True, **options)
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.winrm_stdin_script')
+@mock.patch.object(VirtualMachine, '_run_winrm_ps')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_upload_parallel(
+        run_ps, run_winrm_ps, winrm_stdin_script, connection
+):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    content = os.urandom(300000)
+    local_path = os.path.join(tempfile.mkdtemp(), 'image')
+    with open(local_path, 'wb') as f:
+        f.write(content)
+    remote = bytearray(len(content))
+    shells = []
+
+    @contextlib.contextmanager
+    def fake_winrm_stdin_script(session, script):
+        def send(line):
+            offset, data = line.decode('ascii').split()
+            chunk = base64.b64decode(data)
+            remote[int(offset):int(offset) + len(chunk)] = chunk
+        assert '[Console]::In.ReadLine()' in script
+        shells.append(session)
+        yield send
+    winrm_stdin_script.side_effect = fake_winrm_stdin_script
+    run_winrm_ps.side_effect = lambda session, script: (
+        (0, hashlib.sha256(bytes(remote)).hexdigest() + '\r\n', '')
+        if 'ComputeHash' in script else (0, '', '')
+    )
+    run_ps.return_value.status_code = 0
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    result = vm.winrm_upload(
+        'C:\\image', local_path, step=1000, parallel=4
+    )
+    assert bytes(remote) == content
+    assert len(shells) == 3
+    assert result == ['C:\\image']
+    assert result.size == len(content)
+    assert 'SetLength(300000)' in run_winrm_ps.call_args_list[0][0][1]
+    vm.winrm_upload(
+        'C:\\image', local_path, step=200000, parallel=4, quiet=True
+    )
+    assert len(shells) == 5
+    run_winrm_ps.side_effect = [(0, '', ''), (0, 'bad digest', '')]
+    with pytest.raises(UploadError):
+        vm.winrm_upload('C:\\image', local_path, parallel=2)
+    run_winrm_ps.side_effect = [(1, '', 'access denied')]
+    with pytest.raises(WinRmError):
+        vm.winrm_upload('C:\\image', local_path, parallel=2)
+    run_winrm_ps.side_effect = None
+    run_winrm_ps.return_value = (0, '', '')
+    winrm_stdin_script.side_effect = None
+    send = winrm_stdin_script.return_value.__enter__.return_value
+    send.side_effect = WinRmError('writer', 1, '', 'disk full')
+    with pytest.raises(WinRmError):
+        vm.winrm_upload('C:\\image', local_path, parallel=2)
+    send.reset_mock(side_effect=True)
+    with mock.patch('vcdriver.vm.time.time') as time_mock:
+        time_mock.side_effect = lambda: (
+            vm.timeout + 1 if time_mock.call_count > 1 else 0
+        )
+        with pytest.raises(TimeoutError):
+            vm.winrm_upload('C:\\image', local_path, parallel=2)
+    assert send.call_count == 0
+    empty_path = os.path.join(os.path.dirname(local_path), 'empty')
+    open(empty_path, 'wb').close()
+    run_winrm_ps.return_value = (
+        0, hashlib.sha256(b'').hexdigest(), ''
+    )
+    assert vm.winrm_upload('C:\\empty', empty_path, parallel=2).size == 0
+
+
 @mock.patch('vcdriver.vm.os.stat')
-@mock.patch('vcdriver.vm.open')
+@mock.patch('vcdriver.vm.base64_chunks')
 @mock.patch('vcdriver.vm.connection')
 @mock.patch.object(winrm.Session, 'run_ps')
-def test_virtual_machine_winrm_upload_fail(run_ps, connection, open, os_stat):
+def test_virtual_machine_winrm_upload_fail(
+        run_ps, connection, base64_chunks, os_stat
+):
     st_size_mock = mock.Mock()
     st_size_mock.st_size = 3
     os_stat.return_value = st_size_mock
@@ -547,10 +1383,7 @@ def test_virtual_machine_winrm_upload_fail(run_ps, connection, open, os_stat):
     code_mock.status_code = 1
     code_mock.std_err = 'Whatever'.encode('ascii')
     run_ps.return_value = code_mock
-    read_mock = mock.Mock
-    read_mock.read = lambda x, y: b'\0\0\0'
-    open.__enter__ = read_mock
-    open.__exit__ = mock.Mock()
+    base64_chunks.return_value = [(0, 2, 'AAA='), (2, 1, 'AA==')]
     os.environ['vcdriver_vm_winrm_username'] = 'user'
     os.environ['vcdriver_vm_winrm_password'] = 'pass'
     load()
@@ -563,11 +1396,11 @@ def test_virtual_machine_winrm_upload_fail(run_ps, connection, open, os_stat):
 
 
 @mock.patch('vcdriver.vm.os.stat')
-@mock.patch('vcdriver.vm.open')
+@mock.patch('vcdriver.vm.base64_chunks')
 @mock.patch('vcdriver.vm.connection')
 @mock.patch.object(winrm.Session, 'run_ps')
 def test_virtual_machine_winrm_upload_timeout(
-        run_ps, connection, open, os_stat
+        run_ps, connection, base64_chunks, os_stat
 ):
     st_size_mock = mock.Mock()
     st_size_mock.st_size = 3
@@ -576,10 +1409,7 @@ def test_virtual_machine_winrm_upload_timeout(
     code_mock.status_code = 1
     code_mock.std_err = 'Blah is being used by another process'.encode('ascii')
     run_ps.return_value = code_mock
-    read_mock = mock.Mock
-    read_mock.read = lambda x, y: b'\0\0\0'
-    open.__enter__ = read_mock
-    open.__exit__ = mock.Mock()
+    base64_chunks.return_value = [(0, 2, 'AAA='), (2, 1, 'AA==')]
     os.environ['vcdriver_vm_winrm_username'] = 'user'
     os.environ['vcdriver_vm_winrm_password'] = 'pass'
     load()
@@ -592,6 +1422,253 @@ def test_virtual_machine_winrm_upload_timeout(
         vm.winrm_upload('whatever', 'whatever', step=2)
 
 
+def fake_winrm_shell(remote_file, digest=None, fail_on=None):
+    """ A winrm_shell replacement serving a remote file """
+    def run_ps(script):
+        if fail_on and fail_on in script:
+            return 1, b'', b'Failed'
+        if 'Get-Item' in script:
+            return 0, str(len(remote_file)).encode('ascii') + b'\r\n', b''
+        if 'SHA256' in script:
+            return 0, (
+                digest or hashlib.sha256(remote_file).hexdigest().upper()
+            ).encode('ascii'), b''
+        offset = int(script.split('Seek(')[1].split(',')[0])
+        step = int(script.split('byte[] ')[1].split(';')[0])
+        return 0, base64.b64encode(remote_file[offset:offset + step]), b''
+
+    @contextlib.contextmanager
+    def winrm_shell(session):
+        yield run_ps
+    return winrm_shell
+
+
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_winrm_download_success(connection, tmpdir):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    local_path = str(tmpdir.join('file'))
+    vm = VirtualMachine()
+    assert vm.winrm_download('whatever', local_path) is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    remote_file = b'hello world'
+    with mock.patch('vcdriver.vm.winrm_shell', fake_winrm_shell(remote_file)):
+        assert vm.winrm_download(
+            'C:\\file', local_path, step=4
+        ) == hashlib.sha256(remote_file).hexdigest()
+        with open(local_path, 'rb') as f:
+            assert f.read() == remote_file
+        vm.winrm_download('C:\\file', local_path, step=3, quiet=True)
+        with open(local_path, 'rb') as f:
+            assert f.read() == remote_file
+    with mock.patch('vcdriver.vm.winrm_shell', fake_winrm_shell(b'')):
+        vm.winrm_download('C:\\file', local_path)
+
+
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_winrm_download_fail(connection, tmpdir):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    local_path = str(tmpdir.join('file'))
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    with mock.patch(
+        'vcdriver.vm.winrm_shell', fake_winrm_shell(b'data', digest='BAD')
+    ):
+        with pytest.raises(DownloadError):
+            vm.winrm_download('C:\\file', local_path)
+    with mock.patch(
+        'vcdriver.vm.winrm_shell', fake_winrm_shell(b'data', fail_on='Seek')
+    ):
+        with pytest.raises(WinRmError):
+            vm.winrm_download('C:\\file', local_path)
+    truncated = fake_winrm_shell(b'data')
+
+    @contextlib.contextmanager
+    def short_read_shell(session):
+        with truncated(session) as run_ps:
+            yield lambda script: (
+                (0, b'', b'') if 'Seek(2,' in script else run_ps(script)
+            )
+    with mock.patch('vcdriver.vm.winrm_shell', short_read_shell):
+        with pytest.raises(DownloadError):
+            vm.winrm_download('C:\\file', local_path, step=2)
+    vm.timeout = 1
+    with mock.patch('vcdriver.vm.winrm_shell', fake_winrm_shell(b'data')):
+        with mock.patch('vcdriver.vm.time.time', side_effect=[0, 2]):
+            with pytest.raises(TimeoutError):
+                vm.winrm_download('C:\\file', local_path)
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_upload_compress(run_ps, connection, tmpdir):
+    run_ps.return_value.status_code = 0
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    text = tmpdir.join('text')
+    text.write(b'Write-Host "hello"\n' * 1000, mode='wb')
+    noise = tmpdir.join('noise')
+    noise.write(os.urandom(4096), mode='wb')
+
+    def scripts():
+        return [call[0][0] for call in run_ps.call_args_list]
+
+    vm.winrm_upload('C:\\text', str(text), step=4096, compress=True)
+    assert any('GZipStream' in script for script in scripts())
+    assert any('-path C:\\text.gz' in script for script in scripts())
+    run_ps.reset_mock()
+    vm.winrm_upload(
+        'C:\\noise', str(noise), step=4096, compress=True, quiet=True
+    )
+    assert not any('GZipStream' in script for script in scripts())
+    assert len(scripts()) == 2
+    assert sorted(os.listdir(str(tmpdir))) == ['noise', 'text']
+    run_ps.return_value.status_code = 1
+    run_ps.return_value.std_err = b'Failed'
+    with mock.patch.object(VirtualMachine, '_winrm_upload_chunks'):
+        with pytest.raises(WinRmError):
+            vm.winrm_upload('C:\\text', str(text), compress=True)
+
+
+@pytest.fixture
+def guest_http_server():
+    """ A local stand-in for the esxi guest file transfer service """
+    files = {}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_PUT(self):
+            files[self.path] = self.rfile.read(
+                int(self.headers['Content-Length'])
+            )
+            self.send_response(200 if 'fail' not in self.path else 500)
+            self.end_headers()
+
+        def do_GET(self):
+            body = files.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://*:{}'.format(server.server_port), files
+    server.shutdown()
+    server.server_close()
+
+
+def load_guest_credentials():
+    os.environ['vcdriver_vm_guest_username'] = 'user'
+    os.environ['vcdriver_vm_guest_password'] = 'pass'
+    load()
+
+
+def guest_vm(connection):
+    connection.return_value._stub.host = '127.0.0.1:443'
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    return vm
+
+
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_guest_upload(
+        connection, guest_http_server, tmpdir
+):
+    base_url, files = guest_http_server
+    file_manager = (
+        connection.return_value.content.guestOperationsManager.fileManager
+    )
+    file_manager.InitiateFileTransferToGuest.return_value = (
+        base_url + '/guestFile?id=1'
+    )
+    local_file = tmpdir.join('file')
+    local_file.write(b'\0' * 3 * 1024 * 1024, mode='wb')
+    load_guest_credentials()
+    assert VirtualMachine().guest_upload('C:\\file', str(local_file)) is None
+    vm = guest_vm(connection)
+    result = vm.guest_upload('C:\\file', str(local_file))
+    assert result == ['C:\\file']
+    assert result.size == 3 * 1024 * 1024
+    assert files['/guestFile?id=1'] == b'\0' * 3 * 1024 * 1024
+    vm.guest_upload('C:\\file', str(local_file), quiet=True)
+    file_manager.InitiateFileTransferToGuest.return_value = (
+        base_url + '/guestFile?id=fail'
+    )
+    with pytest.raises(UploadError):
+        vm.guest_upload('C:\\file', str(local_file))
+
+
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_guest_download(
+        connection, guest_http_server, tmpdir
+):
+    base_url, files = guest_http_server
+    files['/guestFile?id=2'] = b'data' * 1000
+    file_manager = (
+        connection.return_value.content.guestOperationsManager.fileManager
+    )
+    info = file_manager.InitiateFileTransferFromGuest.return_value
+    info.url = base_url + '/guestFile?id=2'
+    info.size = 4000
+    local_path = str(tmpdir.join('file'))
+    load_guest_credentials()
+    assert VirtualMachine().guest_download('C:\\file', local_path) is None
+    vm = guest_vm(connection)
+    result = vm.guest_download('C:\\file', local_path, step=100)
+    assert result.size == 4000
+    with open(local_path, 'rb') as f:
+        assert f.read() == b'data' * 1000
+    vm.guest_download('C:\\file', local_path, quiet=True)
+    info.size = 5000
+    with pytest.raises(DownloadError):
+        vm.guest_download('C:\\file', local_path)
+    info.url = base_url + '/missing'
+    with pytest.raises(DownloadError):
+        vm.guest_download('C:\\file', local_path)
+
+
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_guest_run(connection):
+    process_manager = (
+        connection.return_value.content.guestOperationsManager.processManager
+    )
+    process = mock.MagicMock()
+    process.exitCode = 0
+    process_manager.ListProcessesInGuest.return_value = [process]
+    load_guest_credentials()
+    assert VirtualMachine().guest_run('/bin/true') is None
+    vm = guest_vm(connection)
+    assert vm.guest_run('/bin/true') == 0
+    spec = process_manager.StartProgramInGuest.call_args[0][2]
+    assert spec.programPath == '/bin/true'
+    process.exitCode = 3
+    with pytest.raises(GuestOperationError):
+        vm.guest_run('/bin/false', '-x', '/tmp')
+
+
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
 def test_virtual_machine_find_snapshot(wait_for_vcenter_task):
     fake_snapshots = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
@@ -775,3 +1852,140 @@ def test_schedule_vcenter_task_on_vm(connection):
         .call_count
         == 1
     )
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.iter_vcenter_properties')
+def test_iter_virtual_machines(iter_vcenter_properties, connection):
+    vm_object = mock.MagicMock()
+    vm_object.name = 'apple'
+    iter_vcenter_properties.return_value = iter([
+        (vm_object, ['poweredOn', 'apple'])
+    ])
+    records = iter_virtual_machines(
+        ['runtime.powerState', 'name'], page_size=10
+    )
+    assert not iter_vcenter_properties.called
+    record = next(records)
+    iter_vcenter_properties.assert_called_once_with(
+        connection.return_value, vim.VirtualMachine,
+        ('runtime.powerState', 'name'), None, 10
+    )
+    assert record.runtime_powerState == 'poweredOn'
+    assert record.name == 'apple'
+    assert not hasattr(record, '__dict__')
+    vm = record.virtual_machine(template='template')
+    assert (vm.name, vm.template) == ('apple', 'template')
+    assert vm._vm_object == vm_object
+    iter_vcenter_properties.return_value = iter([(vm_object, ['poweredOff'])])
+    record, = list(iter_virtual_machines(['runtime.powerState']))
+    assert record == (vm_object, 'poweredOff')
+    assert record.virtual_machine().name == 'apple'
+    iter_vcenter_properties.return_value = iter([(vm_object, ['poweredOn'])])
+    assert type(next(iter_virtual_machines(['runtime.powerState']))) is (
+        type(record)
+    )
+
+
+class UtcPlusOne(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(hours=1)
+
+
+def custom_value(key, value):
+    custom_value_mock = mock.MagicMock()
+    custom_value_mock.key = key
+    custom_value_mock.value = value
+    return custom_value_mock
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_vcenter_object_by_name')
+@mock.patch('vcdriver.vm.iter_vcenter_properties')
+def test_query_virtual_machines(
+        iter_vcenter_properties, get_vcenter_object_by_name, connection
+):
+    owner_field, other_field = mock.MagicMock(), mock.MagicMock()
+    owner_field.key, owner_field.name = 1, 'owner'
+    other_field.key, other_field.name = 2, 'other'
+    connection.return_value.content.customFieldsManager.field = [
+        owner_field, other_field
+    ]
+    machines = [
+        {
+            'name': 'ci-1',
+            'runtime.powerState': 'poweredOn',
+            'config.createDate': datetime.datetime(2018, 6, 13),
+            'config.changeVersion': '2018-06-15T15:12:43.700814Z',
+            'customValue': [custom_value(1, 'ci'), custom_value(2, 'x')]
+        },
+        {
+            'name': 'ci-2',
+            'runtime.powerState': 'poweredOff',
+            'config.changeVersion': '2018-06-13T15:12:43.700814Z'
+        },
+        {
+            'name': 'ci-3',
+            'runtime.powerState': 'poweredOn',
+            'config.createDate': datetime.datetime(
+                2018, 6, 14, 0, 30, tzinfo=UtcPlusOne()
+            ),
+            'config.changeVersion': '2018-06-14T15:12:43.700814Z'
+        },
+        {
+            'name': 'ci-4',
+            'runtime.powerState': 'poweredOn',
+            'config.changeVersion': '7'
+        },
+        {'name': 'ci-5', 'customValue': [custom_value(1, 'qa')]},
+        {'name': 'ci-6', 'config.template': True},
+        {'name': 'dev-ci-7', 'config.template': False},
+        {'name': None},
+    ]
+    iter_vcenter_properties.side_effect = (
+        lambda conn, object_type, paths, scope, page_size: iter([
+            (machine['name'], [machine.get(path) for path in paths])
+            for machine in machines
+        ])
+    )
+
+    def query(**kwargs):
+        return [
+            record.name for record in query_virtual_machines(**kwargs)
+        ]
+
+    assert query(name='ci-*') == ['ci-{}'.format(i) for i in range(1, 7)]
+    assert query(name=re.compile(r'ci-[17]')) == ['ci-1', 'dev-ci-7']
+    assert query(power_state='poweredOn') == ['ci-1', 'ci-3', 'ci-4']
+    assert query(power_state=['poweredOff', 'poweredOn']) == [
+        'ci-1', 'ci-2', 'ci-3', 'ci-4'
+    ]
+    assert query(created_before=datetime.datetime(2018, 6, 14)) == [
+        'ci-1', 'ci-2', 'ci-3'
+    ]
+    assert query(created_after=datetime.datetime(2018, 6, 13, 12)) == [
+        'ci-2', 'ci-3'
+    ]
+    assert query(custom_values={'owner': 'ci'}) == ['ci-1']
+    assert query(custom_values={'owner': 'ci', 'other': 'y'}) == []
+    assert query(name='*ci-*', template=False) == [
+        'ci-{}'.format(i) for i in range(1, 6)
+    ] + ['dev-ci-7']
+    assert query(template=True) == ['ci-6']
+    assert query(
+        predicate=lambda record: record.guest_ipAddress is None,
+        properties=['name', 'guest.ipAddress']
+    ) == ['ci-{}'.format(i) for i in range(1, 7)] + ['dev-ci-7']
+    assert query(
+        name='ci-*', power_state='poweredOn',
+        created_before=datetime.datetime(2018, 6, 13, 12)
+    ) == ['ci-1']
+    assert iter_vcenter_properties.call_args[0][2] == (
+        'name', 'runtime.powerState', 'config.createDate',
+        'config.changeVersion'
+    )
+    assert query(scope='folder', page_size=10) == query()
+    assert iter_vcenter_properties.call_args[0][3:] == (None, 1000)
+    get_vcenter_object_by_name.assert_called_once_with(
+        connection.return_value, vim.Folder, 'folder'
+    )
@@ -16,7 +16,8 @@ _CONFIG = {
         'vcdriver_port': _DEFAULTS['vcdriver_port'],
         'vcdriver_username': '',
         'vcdriver_password': '',
-        'vcdriver_idle_timeout': '7200'
+        'vcdriver_idle_timeout': '7200',
+        'vcdriver_session_file': ''
     },
     'Virtual Machine Deployment': {
         'vcdriver_resource_pool': '',
@@ -29,14 +30,17 @@ _CONFIG = {
         'vcdriver_vm_ssh_username': '',
         'vcdriver_vm_ssh_password': '',
         'vcdriver_vm_winrm_username': '',
-        'vcdriver_vm_winrm_password': ''
+        'vcdriver_vm_winrm_password': '',
+        'vcdriver_vm_guest_username': '',
+        'vcdriver_vm_guest_password': ''
     }
 }
 
 _SECRETS = {
     'vcdriver_password',
     'vcdriver_vm_ssh_password',
-    'vcdriver_vm_winrm_password'
+    'vcdriver_vm_winrm_password',
+    'vcdriver_vm_guest_password'
 }
 
 _config = copy.deepcopy(_CONFIG)
@@ -69,14 +73,14 @@ def load(path=None):
         config.read(path)
     for section_key, section_content in _config.items():
         for config_key in section_content.keys():
-            if path:
-                _config[section_key][config_key] = config.get(
-                    section_key, config_key
-                ) or os.getenv(config_key, _DEFAULTS.get(config_key, ''))
+            # Keys missing from older files fall back to the environment
+            if path and config.has_option(section_key, config_key):
+                value = config.get(section_key, config_key)
             else:
-                _config[section_key][config_key] = os.getenv(
-                    config_key, _DEFAULTS.get(config_key, '')
-                )
+                value = None
+            _config[section_key][config_key] = value or os.getenv(
+                config_key, _DEFAULTS.get(config_key, '')
+            )
 
 
 def reset():
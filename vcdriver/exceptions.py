@@ -16,10 +16,23 @@ class NoObjectFound(Exception):
         )
 
 
+class VcenterMismatch(Exception):
+    def __init__(self, name, vcenter_host, current_host):
+        super(VcenterMismatch, self).__init__(
+            'Virtual machine "{}" belongs to vcenter "{}", but the session is '
+            'connected to "{}"'.format(name, vcenter_host, current_host)
+        )
+
+
 class IpError(Exception):
-    def __init__(self, ip):
-        super(IpError, self).__init__(
-            '"{}" is not a valid IPv4/IPv6 address'.format(ip)
+    def __init__(self, ip, message='"{}" is not a valid IPv4/IPv6 address'):
+        super(IpError, self).__init__(message.format(ip))
+
+
+class IpPoolExhausted(IpError):
+    def __init__(self):
+        super(IpPoolExhausted, self).__init__(
+            None, 'The pool of static IP addresses is exhausted'
         )
 
 
@@ -48,6 +61,10 @@ class WinRmError(RemoteCommandError):
     pass
 
 
+class GuestOperationError(RemoteCommandError):
+    pass
+
+
 class FileTransferError(Exception):
     def __init__(self, local_path, remote_path):
         super(FileTransferError, self).__init__(
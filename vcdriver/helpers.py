@@ -1,9 +1,12 @@
 from __future__ import print_function
+import base64
+import collections
 import contextlib
 import datetime
 import os
 import socket
 import sys
+import threading
 import time
 
 from colorama import init, Style
@@ -16,18 +19,147 @@ from vcdriver.exceptions import (
     TooManyObjectsFound,
     NoObjectFound,
     TimeoutError,
-    IpError
+    IpError,
+    WinRmError
 )
 
 
 init()
 
+# Container views are server side objects, reused across lookups and
+# destroyed when evicted or when the session is closed
+_MAX_CONTAINER_VIEWS = 32
+_container_views = collections.OrderedDict()
+_container_views_lock = threading.Lock()
 
-def get_all_vcenter_objects(connection, object_type):
+
+# The InventoryMirror answering the lookups from memory, if any
+_inventory_mirror = None
+
+
+def set_inventory_mirror(mirror):
+    """
+    Set the inventory mirror used by the lookups
+    :param mirror: The vcdriver.inventory.InventoryMirror, or None
+    """
+    global _inventory_mirror
+    _inventory_mirror = mirror
+
+
+def inventory_mirror(connection=None, running=True):
+    """
+    Get the running inventory mirror
+    :param connection: If given, the mirror has to follow this connection
+    :param running: If False, a mirror whose updates stopped with an error
+        (e.g. because its session expired) is returned too
+
+    :return: The InventoryMirror, or None
+    """
+    mirror = _inventory_mirror
+    if mirror is None or (running and not mirror.running):
+        return None
+    if connection is not None and mirror.connection is not connection:
+        return None
+    return mirror
+
+
+class _SharedView(object):
+    """ A registered container view and the lookups using it """
+    __slots__ = ('view', 'users', 'retired')
+
+    def __init__(self, view):
+        self.view = view
+        self.users = 0
+        # Evicted or dropped while in use, the last user destroys it
+        self.retired = False
+
+
+@contextlib.contextmanager
+def container_view(connection, object_type, scope=None, recursive=True):
+    """
+    Use a container view, reusing the one created for the same arguments.
+    A view is never destroyed while it is in use, even if it is evicted
+    meanwhile, and it is created outside of the registry lock
+    :param connection: A vcenter connection
+    :param object_type: A vcenter object type, like vim.VirtualMachine
+    :param scope: A folder, datacenter or cluster to limit the view to,
+        by default the whole inventory
+    :param recursive: Whether to include the objects of the children
+
+    :return: The container view, usable until the context exits
+    """
+    key = (connection, scope, object_type, recursive)
+    stale = []
+    with _container_views_lock:
+        shared = _container_views.pop(key, None)
+        if shared is not None:
+            _container_views[key] = shared
+            shared.users += 1
+    if shared is None:
+        content = connection.RetrieveContent()
+        created = _SharedView(content.viewManager.CreateContainerView(
+            scope or content.rootFolder, [object_type], recursive
+        ))
+        with _container_views_lock:
+            shared = _container_views.pop(key, None)
+            if shared is None:
+                # Nobody created the same view meanwhile
+                shared = created
+                while len(_container_views) >= _MAX_CONTAINER_VIEWS:
+                    evicted = _container_views.popitem(last=False)[1]
+                    evicted.retired = True
+                    if not evicted.users:
+                        stale.append(evicted)
+            else:
+                stale.append(created)
+            _container_views[key] = shared
+            shared.users += 1
+    for evicted in stale:
+        _destroy_view(evicted.view)
+    try:
+        yield shared.view
+    finally:
+        with _container_views_lock:
+            shared.users -= 1
+            last = shared.retired and not shared.users
+        if last:
+            _destroy_view(shared.view)
+
+
+def destroy_container_views(release=True):
+    """
+    Destroy all the container views created by container_view, those still
+    in use are destroyed when their last user is done
+    :param release: If False, the views are only forgotten, without
+        destroying them on the server, e.g. once their session is gone
+    """
+    stale = []
+    with _container_views_lock:
+        while _container_views:
+            shared = _container_views.popitem()[1]
+            if release:
+                shared.retired = True
+                if not shared.users:
+                    stale.append(shared)
+    for shared in stale:
+        _destroy_view(shared.view)
+
+
+def _destroy_view(view):
+    try:
+        view.DestroyView()
+    except Exception:
+        # The session might be already gone, with its views
+        pass
+
+
+def get_all_vcenter_objects(connection, object_type, scope=None):
     """
     Return all the vcenter objects of a given type
     :param connection: A vcenter connection
     :param object_type:  A vcenter object type, like vim.VirtualMachine
+    :param scope: A folder, datacenter or cluster to limit the search to,
+        by default the whole inventory
 
     :return: A list with all the objects found
     """
@@ -37,29 +169,126 @@ def get_all_vcenter_objects(connection, object_type):
     )
     sys.stdout.flush()
     start = time.time()
-    content = connection.RetrieveContent()
-    view = content.viewManager.CreateContainerView
-    objects = [
-        obj for obj in view(content.rootFolder, [object_type], True).view
-    ]
+    mirror = inventory_mirror(connection)
+    if scope is None and mirror is not None and mirror.mirrors(object_type):
+        objects = mirror.get_all(object_type)
+    else:
+        with container_view(connection, object_type, scope) as view:
+            objects = list(view.view)
     print(datetime.timedelta(seconds=time.time() - start))
     return objects
 
 
-def get_vcenter_object_by_name(connection, object_type, name):
+def get_vcenter_property(obj, path):
+    """
+    Read a single property of a vcenter object in one round trip, retrieving
+    only its value instead of the data object holding it
+    :param obj: The vcenter object
+    :param path: The property path e.g. "runtime.powerState"
+
+    :return: The property value, None if unset
+    """
+    collector = vmodl.query.PropertyCollector('propertyCollector', obj._stub)
+    result = collector.RetrievePropertiesEx(
+        [vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=obj)],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                type=type(obj), pathSet=[path]
+            )]
+        )],
+        vmodl.query.PropertyCollector.RetrieveOptions()
+    )
+    for object_content in result.objects if result is not None else ():
+        for prop in object_content.propSet:
+            return prop.val
+    return None
+
+
+def iter_vcenter_properties(
+        connection, object_type, paths, scope=None, page_size=1000
+):
+    """
+    Iterate some properties of all the vcenter objects of a given type. They
+    are retrieved in pages with the property collector, so neither the whole
+    inventory nor a round trip per object are needed
+    :param connection: A vcenter connection
+    :param object_type: A vcenter object type, like vim.VirtualMachine
+    :param paths: The property paths e.g. ["name", "runtime.powerState"]
+    :param scope: A folder, datacenter or cluster to limit the search to,
+        by default the whole inventory
+    :param page_size: The maximum number of objects retrieved at once
+
+    :return: A generator of (object, values) pairs, where values is the list
+        of the property values in the order of paths, None if unset
+    """
+    paths = list(paths)
+    mirror = inventory_mirror(connection)
+    if scope is None and mirror is not None and set(paths).issubset(
+            mirror.properties.get(object_type, ())
+    ):
+        for obj, values in mirror.get_all_properties(object_type, paths):
+            yield obj, values
+        return
+    collector = connection.RetrieveContent().propertyCollector
+    # The view is kept alive until the last page is read
+    with container_view(connection, object_type, scope) as view:
+        result = collector.RetrievePropertiesEx(
+            [vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=view,
+                    skip=True,
+                    selectSet=[vmodl.query.PropertyCollector.TraversalSpec(
+                        name='traverseView',
+                        path='view',
+                        skip=False,
+                        type=vim.view.ContainerView
+                    )]
+                )],
+                propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                    type=object_type, pathSet=paths
+                )]
+            )],
+            vmodl.query.PropertyCollector.RetrieveOptions(
+                maxObjects=page_size
+            )
+        )
+        try:
+            while result is not None:
+                for object_content in result.objects:
+                    values = dict(
+                        (prop.name, prop.val)
+                        for prop in object_content.propSet
+                    )
+                    yield object_content.obj, [
+                        values.get(path) for path in paths
+                    ]
+                token, result = result.token, None
+                if token:
+                    result = collector.ContinueRetrievePropertiesEx(token)
+        finally:
+            # Release the pages left on the server when the iteration stops
+            # early
+            if result is not None and result.token:
+                collector.CancelRetrievePropertiesEx(result.token)
+
+
+def get_vcenter_object_by_name(connection, object_type, name, scope=None):
     """
     Find a vcenter object
     :param connection: A vcenter connection
     :param object_type: A vcenter object type, like vim.VirtualMachine
     :param name: The name of the object
+    :param scope: A folder, datacenter or cluster to limit the search to,
+        by default the whole inventory
 
     :return: The object found
 
     :raise: TooManyObjectsFound: If more than one object is found
     :raise: NoObjectFound: If no results are found
     """
-    content = connection.RetrieveContent()
-    view = content.viewManager.CreateContainerView
+    mirror = inventory_mirror(connection)
+    if scope is None and mirror is not None and mirror.mirrors(object_type):
+        return mirror.get_by_name(object_type, name)
 
     def name_matches(obj):
         try:
@@ -68,10 +297,8 @@ def get_vcenter_object_by_name(connection, object_type, name):
             pass
         return False
 
-    objects = [
-        obj for obj in view(content.rootFolder, [object_type], True).view
-        if name_matches(obj)
-    ]
+    with container_view(connection, object_type, scope) as view:
+        objects = [obj for obj in view.view if name_matches(obj)]
     count = len(objects)
     if count == 1:
         return objects[0]
@@ -81,6 +308,105 @@ def get_vcenter_object_by_name(connection, object_type, name):
         raise NoObjectFound(object_type, name)
 
 
+def _search_index_result(obj, object_type, key):
+    if obj is None:
+        raise NoObjectFound(object_type, key)
+    return obj
+
+
+def get_vcenter_object_by_inventory_path(connection, path):
+    """
+    Find a vcenter object by its inventory path, resolved by the server
+    :param connection: A vcenter connection
+    :param path: The inventory path e.g. "datacenter/vm/folder/vm-name"
+
+    :return: The object found
+
+    :raise: NoObjectFound: If no results are found
+    """
+    return _search_index_result(
+        connection.RetrieveContent().searchIndex.FindByInventoryPath(path),
+        vim.ManagedEntity,
+        path
+    )
+
+
+def get_virtual_machine_by_uuid(
+        connection, uuid, instance_uuid=True, datacenter=None
+):
+    """
+    Find a virtual machine by its uuid, resolved by the server
+    :param connection: A vcenter connection
+    :param uuid: The uuid
+    :param instance_uuid: If True it is the vcenter instance uuid, otherwise
+        the bios uuid
+    :param datacenter: A datacenter to limit the search to
+
+    :return: The virtual machine object found
+
+    :raise: NoObjectFound: If no results are found
+    """
+    return _search_index_result(
+        connection.RetrieveContent().searchIndex.FindByUuid(
+            datacenter, uuid, True, instance_uuid
+        ),
+        vim.VirtualMachine,
+        uuid
+    )
+
+
+def get_virtual_machine_by_ip(connection, ip, datacenter=None):
+    """
+    Find a virtual machine by its guest IP, resolved by the server
+    :param connection: A vcenter connection
+    :param ip: The IP reported by the vmware tools
+    :param datacenter: A datacenter to limit the search to
+
+    :return: The virtual machine object found
+
+    :raise: NoObjectFound: If no results are found
+    """
+    return _search_index_result(
+        connection.RetrieveContent().searchIndex.FindByIp(
+            datacenter, ip, True
+        ),
+        vim.VirtualMachine,
+        ip
+    )
+
+
+def get_virtual_machine_by_dns_name(connection, dns_name, datacenter=None):
+    """
+    Find a virtual machine by its guest DNS name, resolved by the server
+    :param connection: A vcenter connection
+    :param dns_name: The DNS name reported by the vmware tools
+    :param datacenter: A datacenter to limit the search to
+
+    :return: The virtual machine object found
+
+    :raise: NoObjectFound: If no results are found
+    """
+    return _search_index_result(
+        connection.RetrieveContent().searchIndex.FindByDnsName(
+            datacenter, dns_name, True
+        ),
+        vim.VirtualMachine,
+        dns_name
+    )
+
+
+def get_vcenter_object_by_id(connection, object_type, object_id):
+    """
+    Bind a vcenter object from its managed object id without any lookup
+    :param connection: A vcenter connection
+    :param object_type: A vcenter object type, like vim.VirtualMachine
+    :param object_id: The managed object id e.g. "vm-4856"
+
+    :return: The object
+    """
+    return object_type(object_id, connection._stub)
+
+
 def styled_print(styles):
     """
     Generate a function that prints a message with a given style
@@ -222,6 +548,151 @@ def wait_for_vcenter_task(task, task_description, timeout, _poll_interval=1):
             raise task.info.error
 
 
+def wait_for_vcenter_tasks(tasks, task_description, timeout, _max_wait=60):
+    """
+    Wait for several vcenter tasks to finish, following them together with a
+    dedicated property collector, so each round trip covers all the tasks
+    and the server answers as soon as any of them changes
+    :param tasks: A list of vcenter task objects (of the same session)
+    :param task_description: The task description
+    :param timeout: The timeout, in seconds. The current state of the tasks
+        is always retrieved once, even if the timeout is 0
+    :param _max_wait: The longest wait of each round trip, in seconds
+
+    :return: A list with the result of each task, or its error if it failed
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    tasks = list(tasks)
+    if not tasks:
+        return []
+    print('Waiting for [{}] ... '.format(task_description), end='')
+    sys.stdout.flush()
+    start = time.time()
+    collector = vmodl.query.PropertyCollector(
+        'propertyCollector', tasks[0]._stub
+    ).CreatePropertyCollector()
+    try:
+        collector.CreateFilter(
+            vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[
+                    vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+                    for task in tasks
+                ],
+                propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.Task,
+                    pathSet=['info.state', 'info.result', 'info.error']
+                )]
+            ),
+            True
+        )
+        infos = dict((task, {}) for task in tasks)
+        version = ''
+        wait = 0
+        while True:
+            update_set = collector.WaitForUpdatesEx(
+                version,
+                vmodl.query.PropertyCollector.WaitOptions(
+                    maxWaitSeconds=wait
+                )
+            )
+            if update_set is not None:
+                version = update_set.version
+                for filter_update in update_set.filterSet:
+                    for object_update in filter_update.objectSet:
+                        for change in object_update.changeSet:
+                            infos[object_update.obj][change.name] = change.val
+            if all(
+                info.get('info.state') in _TERMINAL_STATES
+                for info in infos.values()
+            ):
+                break
+            remaining = timeout - (time.time() - start)
+            if remaining <= 0:
+                raise TimeoutError(task_description, timeout)
+            wait = max(1, int(min(remaining, _max_wait)))
+    finally:
+        try:
+            collector.DestroyPropertyCollector()
+        except Exception:
+            # The session might be already gone
+            pass
+    print(datetime.timedelta(seconds=time.time() - start))
+    return [
+        infos[task].get('info.result')
+        if infos[task]['info.state'] == vim.TaskInfo.State.success
+        else infos[task].get('info.error')
+        for task in tasks
+    ]
+
+
+def get_vcenter_parents(objects):
+    """
+    Read the parents of some vcenter entities and of all their ancestors in
+    a single round trip, instead of one per level of the inventory
+    :param objects: A list of vcenter managed entities (of the same session)
+
+    :return: A dictionary of entity -> parent, where the parent of a virtual
+        machine inside a vApp is the vApp
+    """
+    objects = list(objects)
+    if not objects:
+        return {}
+    collector = vmodl.query.PropertyCollector(
+        'propertyCollector', objects[0]._stub
+    )
+    up = vmodl.query.PropertyCollector.SelectionSpec(name='parent')
+    result = collector.RetrievePropertiesEx(
+        [vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[
+                vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=obj,
+                    skip=False,
+                    selectSet=[
+                        vmodl.query.PropertyCollector.TraversalSpec(
+                            name='parent',
+                            path='parent',
+                            skip=False,
+                            type=vim.ManagedEntity,
+                            selectSet=[up]
+                        ),
+                        vmodl.query.PropertyCollector.TraversalSpec(
+                            name='parentVApp',
+                            path='parentVApp',
+                            skip=False,
+                            type=vim.VirtualMachine,
+                            selectSet=[up]
+                        )
+                    ]
+                )
+                for obj in objects
+            ],
+            propSet=[
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.ManagedEntity, pathSet=['parent']
+                ),
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.VirtualMachine, pathSet=['parentVApp']
+                )
+            ]
+        )],
+        vmodl.query.PropertyCollector.RetrieveOptions()
+    )
+    parents = {}
+    while result is not None:
+        for object_content in result.objects:
+            values = dict(
+                (prop.name, prop.val) for prop in object_content.propSet
+            )
+            parents[object_content.obj] = (
+                values.get('parent') or values.get('parentVApp')
+            )
+        token, result = result.token, None
+        if token:
+            result = collector.ContinueRetrievePropertiesEx(token)
+    return parents
+
+
 @contextlib.contextmanager
 def fabric_context(host, username, password):
     """
@@ -266,3 +737,121 @@ def check_winrm_service(host, username, password, **kwargs):
     with hide_std():
         winrm.Session(host, (username, password), **kwargs).run_ps('ls')
     return True
+
+
+def powershell_quote(value):
+    """
+    Quote a value as a powershell literal string
+    :param value: The value, e.g. a remote path
+
+    :return: The single quoted string
+    """
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+@contextlib.contextmanager
+def winrm_shell(pywinrm_session):
+    """
+    Open a single remote shell to run several powershell scripts without
+    paying the shell creation round trips on each one
+    :param pywinrm_session: The WinRM session
+
+    :return: A function that runs a script in the shell and returns a tuple
+        with the status code, the stdout and the stderr (as bytes)
+    """
+    protocol = pywinrm_session.protocol
+    shell_id = protocol.open_shell()
+
+    def run_ps(script):
+        command_id = protocol.run_command(
+            shell_id,
+            'powershell',
+            [
+                '-encodedcommand',
+                base64.b64encode(script.encode('utf_16_le')).decode('ascii')
+            ]
+        )
+        try:
+            stdout, stderr, status = protocol.get_command_output(
+                shell_id, command_id
+            )
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
+        return status, stdout, stderr
+
+    try:
+        yield run_ps
+    finally:
+        protocol.close_shell(shell_id)
+
+
+@contextlib.contextmanager
+def winrm_stdin_script(pywinrm_session, script):
+    """
+    Run a single powershell script in its own remote shell and feed its
+    standard input while it runs, e.g. to stream data through one process
+    instead of starting one per piece. Each piece is a WinRM message, so it
+    is bounded by the MaxEnvelopeSizekb of the guest
+    :param pywinrm_session: The WinRM session
+    :param script: The powershell script, reading [Console]::In
+
+    :return: A function that sends bytes to the standard input, which is
+        closed when the context exits
+
+    :raise: WinRmError: If the script fails
+    """
+    protocol = pywinrm_session.protocol
+    shell_id = protocol.open_shell()
+    try:
+        command_id = protocol.run_command(
+            shell_id,
+            'powershell',
+            [
+                '-encodedcommand',
+                base64.b64encode(script.encode('utf_16_le')).decode('ascii')
+            ]
+        )
+        try:
+            yield lambda data: protocol.send_command_input(
+                shell_id, command_id, data
+            )
+            protocol.send_command_input(shell_id, command_id, b'', end=True)
+            stdout, stderr, status = protocol.get_command_output(
+                shell_id, command_id
+            )
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
+    finally:
+        protocol.close_shell(shell_id)
+    if status != 0:
+        raise WinRmError(
+            script, status,
+            stdout.decode('ascii', 'replace'),
+            stderr.decode('ascii', 'replace')
+        )
+
+
+def print_progress(description, transferred, size):
+    """
+    Print a progress bar on the current line
+    :param description: The task description
+    :param transferred: The number of bytes done
+    :param size: The total number of bytes
+    """
+    if transferred > size:
+        transferred = size
+    progress_blocks = transferred * 30 // size
+    percentage_string = str((100 * transferred) // size) + ' %'
+    percentage_string = (
+        ' ' * (5 - len(percentage_string)) + percentage_string
+    )
+    print(
+        '\r{} ... [{}{}] {}'.format(
+            description,
+            '=' * progress_blocks,
+            ' ' * (30 - progress_blocks),
+            percentage_string
+        ),
+        end=''
+    )
+    sys.stdout.flush()
@@ -0,0 +1,306 @@
+from __future__ import print_function
+import collections
+import datetime
+import sys
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+from vcdriver.exceptions import NoObjectFound, TooManyObjectsFound
+from vcdriver.helpers import set_inventory_mirror
+from vcdriver.session import connection
+
+
+DEFAULT_PROPERTIES = {
+    vim.VirtualMachine: [
+        'name',
+        'runtime.powerState',
+        'guest.ipAddress',
+        'guest.toolsRunningStatus'
+    ],
+    vim.Folder: ['name'],
+    vim.Datastore: ['name', 'summary.capacity', 'summary.freeSpace'],
+    vim.ResourcePool: ['name']
+}
+
+
+class InventoryMirror(object):
+    def __init__(self, properties=None, conn=None, max_wait_seconds=60):
+        """
+        A local copy of the vcenter inventory kept up to date in a background
+        thread, so that lookups and property reads are answered from memory
+        :param properties: A dictionary of vcenter object type -> list of
+            property paths to mirror, by default DEFAULT_PROPERTIES. The
+            "name" property is needed for the name lookups
+        :param conn: A vcenter connection, by default the session connection
+        :param max_wait_seconds: Seconds each update request waits on the
+            server before returning empty
+
+        version: Increases every time a batch of updates is applied
+        error: The exception that stopped the background thread, if any
+        """
+        self.properties = dict(properties or DEFAULT_PROPERTIES)
+        self.connection = conn
+        self.max_wait_seconds = max_wait_seconds
+        self.version = 0
+        self.error = None
+        self._objects = {}
+        self._names = collections.defaultdict(set)
+        self._condition = threading.Condition()
+        self._collector = None
+        self._view = None
+        self._update_version = ''
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        """ Whether the mirror is being kept up to date """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Retrieve the whole mirrored inventory and start following the changes
+        """
+        if self._thread is not None:
+            return
+        print('Mirroring the Vcenter inventory ... ', end='')
+        sys.stdout.flush()
+        start = time.time()
+        with self._condition:
+            # Restarted, e.g. in a renewed session
+            self._objects.clear()
+            self._names.clear()
+        self._update_version = ''
+        self.error = None
+        self.connection = self.connection or connection()
+        content = self.connection.RetrieveContent()
+        self._view = content.viewManager.CreateContainerView(
+            content.rootFolder, list(self.properties), True
+        )
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._collector.CreateFilter(
+            vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=self._view,
+                    skip=True,
+                    selectSet=[vmodl.query.PropertyCollector.TraversalSpec(
+                        name='traverseView',
+                        path='view',
+                        skip=False,
+                        type=vim.view.ContainerView
+                    )]
+                )],
+                propSet=[
+                    vmodl.query.PropertyCollector.PropertySpec(
+                        type=object_type, pathSet=paths
+                    )
+                    for object_type, paths in self.properties.items()
+                ]
+            ),
+            True
+        )
+        self._stopped.clear()
+        self._wait_for_updates()
+        self._thread = threading.Thread(target=self._follow_updates)
+        self._thread.daemon = True
+        self._thread.start()
+        set_inventory_mirror(self)
+        print('{} objects in {}'.format(
+            len(self._objects), datetime.timedelta(seconds=time.time() - start)
+        ))
+
+    def stop(self, release=True):
+        """
+        Stop following the changes and release the server side objects
+        :param release: If False, the server side objects are only forgotten,
+            e.g. once their session is gone
+        """
+        if self._thread is None:
+            return
+        set_inventory_mirror(None)
+        self._stopped.set()
+        if self._thread.is_alive():
+            try:
+                self._collector.CancelWaitForUpdates()
+            except Exception:
+                # The session might be already gone
+                pass
+        self._thread.join()
+        self._thread = None
+        if not release:
+            return
+        for destroy in (
+            self._collector.DestroyPropertyCollector, self._view.DestroyView
+        ):
+            try:
+                destroy()
+            except Exception:
+                pass
+
+    def mirrors(self, object_type):
+        """
+        Whether the objects of a type can be looked up by name in the mirror
+        :param object_type: A vcenter object type, like vim.VirtualMachine
+        """
+        return 'name' in self.properties.get(object_type, ())
+
+    def get_all(self, object_type):
+        """
+        Return all the mirrored objects of a given type
+        :param object_type: A vcenter object type, like vim.VirtualMachine
+
+        :return: A list with all the objects
+        """
+        with self._condition:
+            return [
+                obj for obj in self._objects
+                if isinstance(obj, object_type)
+            ]
+
+    def get_all_properties(self, object_type, paths):
+        """
+        Return all the mirrored objects of a given type with some of their
+        properties, read at once so no object is half listed
+        :param object_type: A vcenter object type, like vim.VirtualMachine
+        :param paths: The mirrored property paths e.g. ["name"]
+
+        :return: A list of (object, values) pairs, where values is the list
+            of the property values in the order of paths, None if unset
+        """
+        with self._condition:
+            return [
+                (obj, [properties.get(path) for path in paths])
+                for obj, properties in self._objects.items()
+                if isinstance(obj, object_type)
+            ]
+
+    def get_by_name(self, object_type, name):
+        """
+        Find a mirrored object
+        :param object_type: A vcenter object type, like vim.VirtualMachine
+        :param name: The name of the object
+
+        :return: The object found
+
+        :raise: TooManyObjectsFound: If more than one object is found
+        :raise: NoObjectFound: If no results are found
+        """
+        with self._condition:
+            objects = [
+                obj for obj in self._names.get(name, ())
+                if isinstance(obj, object_type)
+            ]
+        if len(objects) == 1:
+            return objects[0]
+        elif len(objects) > 1:
+            raise TooManyObjectsFound(object_type, name)
+        else:
+            raise NoObjectFound(object_type, name)
+
+    def get_property(self, obj, path):
+        """
+        Read a mirrored property
+        :param obj: The vcenter object
+        :param path: The property path e.g. "runtime.powerState"
+
+        :return: The property value, None if unset
+
+        :raise: KeyError: If the object or the property is not mirrored
+        """
+        if not any(
+            isinstance(obj, object_type) and path in paths
+            for object_type, paths in self.properties.items()
+        ):
+            raise KeyError(path)
+        with self._condition:
+            return self._objects[obj].get(path)
+
+    def wait_for_version(self, version, timeout=None):
+        """
+        Wait until the mirror has applied a given version
+        :param version: The version to wait for
+        :param timeout: The timeout, in seconds
+
+        :return: True if the version was reached, False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self.version < version:
+                remaining = None if deadline is None else (
+                    deadline - time.time()
+                )
+                if (remaining is not None and remaining <= 0) or (
+                    not self.running
+                ):
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _follow_updates(self):
+        try:
+            while not self._stopped.is_set():
+                self._wait_for_updates()
+        except Exception as e:
+            if not self._stopped.is_set():
+                self.error = e
+        finally:
+            with self._condition:
+                self._condition.notify_all()
+
+    def _wait_for_updates(self):
+        """ Apply the next batches of updates, if any, from the server """
+        update_set = self._collector.WaitForUpdatesEx(
+            self._update_version,
+            vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=self.max_wait_seconds
+            )
+        )
+        while update_set is not None:
+            self._apply(update_set)
+            self._update_version = update_set.version
+            if not update_set.truncated:
+                break
+            update_set = self._collector.WaitForUpdatesEx(
+                self._update_version,
+                vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+            )
+
+    def _apply(self, update_set):
+        """
+        Apply a batch of updates
+        :param update_set: The vcenter UpdateSet
+        """
+        with self._condition:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    obj = object_update.obj
+                    self._unindex(obj)
+                    if object_update.kind == 'leave':
+                        self._objects.pop(obj, None)
+                        continue
+                    properties = self._objects.setdefault(obj, {})
+                    for change in object_update.changeSet:
+                        if change.op in ('remove', 'indirectRemove'):
+                            properties.pop(change.name, None)
+                        else:
+                            properties[change.name] = change.val
+                    if properties.get('name') is not None:
+                        self._names[properties['name']].add(obj)
+            self.version += 1
+            self._condition.notify_all()
+
+    def _unindex(self, obj):
+        name = self._objects.get(obj, {}).get('name')
+        if name is not None:
+            self._names[name].discard(obj)
+            if not self._names[name]:
+                del self._names[name]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
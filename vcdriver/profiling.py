@@ -0,0 +1,233 @@
+from __future__ import print_function
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+from vcdriver.session import connection
+
+
+# Modules whose frames are plumbing rather than a vcdriver operation
+_INTERNAL_MODULES = frozenset(('vcdriver.config', 'vcdriver.profiling'))
+_UNATTRIBUTED = '<unattributed>'
+# The stub methods replaced while a profiler is attached
+_STUB_METHODS = ('InvokeMethod', 'GetConnection', 'ReturnConnection')
+
+
+class SoapCallStats(object):
+    """ Accumulated figures for one SOAP method within one operation """
+    __slots__ = ('calls', 'seconds', 'request_bytes', 'response_bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def add(self, seconds, request_bytes, response_bytes):
+        self.calls += 1
+        self.seconds += seconds
+        self.request_bytes += request_bytes
+        self.response_bytes += response_bytes
+
+
+class _CountingResponse(object):
+    """ Proxy of an http response that counts the bytes read from it """
+    def __init__(self, response, sizes):
+        self._response = response
+        self._sizes = sizes
+
+    def read(self, *args, **kwargs):
+        data = self._response.read(*args, **kwargs)
+        self._sizes[1] += len(data)
+        return data
+
+    def __getattr__(self, item):
+        return getattr(self._response, item)
+
+
+class _CountingConnection(object):
+    """ Proxy of an http connection that counts the bytes on the wire """
+    def __init__(self, conn, sizes):
+        self._connection = conn
+        self._sizes = sizes
+
+    def request(self, method, url, body=None, headers=None):
+        self._sizes[0] += len(body or b'')
+        return self._connection.request(method, url, body, headers or {})
+
+    def getresponse(self):
+        return _CountingResponse(self._connection.getresponse(), self._sizes)
+
+    def __getattr__(self, item):
+        return getattr(self._connection, item)
+
+
+def _calling_operation():
+    """
+    Find the vcdriver API that triggered the current SOAP call
+
+    :return: The outermost vcdriver function in the stack, e.g.
+        "VirtualMachine.create"
+    """
+    operation = _UNATTRIBUTED
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if (
+            module.startswith('vcdriver.') and
+            module not in _INTERNAL_MODULES
+        ):
+            name = frame.f_code.co_name
+            instance = frame.f_locals.get('self')
+            if instance is not None:
+                name = '{}.{}'.format(type(instance).__name__, name)
+            operation = name
+        frame = frame.f_back
+    return operation
+
+
+class Profiler(object):
+    def __init__(self):
+        """
+        stats: A dictionary of operation -> SOAP method -> SoapCallStats
+        """
+        self.stats = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stub = None
+        self._saved = {}
+
+    def attach(self, stub):
+        """
+        Start recording the SOAP traffic of a pyVmomi stub. Profilers can be
+        nested, as long as they are detached in the reverse order
+        :param stub: The SoapStubAdapter, e.g. connection()._stub
+        """
+        self._saved = dict(
+            (attribute, vars(stub)[attribute])
+            for attribute in _STUB_METHODS if attribute in vars(stub)
+        )
+        invoke_method = stub.InvokeMethod
+        get_connection = stub.GetConnection
+        return_connection = stub.ReturnConnection
+
+        def profiled_invoke_method(mo, info, *args, **kwargs):
+            method = info.wsdlName
+            if method == 'Fetch' and args and args[0]:
+                # Property reads are all "Fetch", name the property instead
+                method = 'Fetch({})'.format(args[0][0])
+            sizes = self._local.sizes = [0, 0]
+            start = time.time()
+            try:
+                return invoke_method(mo, info, *args, **kwargs)
+            finally:
+                self._local.sizes = None
+                self.record(
+                    _calling_operation(), method, time.time() - start,
+                    sizes[0], sizes[1]
+                )
+
+        def profiled_get_connection():
+            conn = get_connection()
+            sizes = getattr(self._local, 'sizes', None)
+            if sizes is None:
+                return conn
+            return _CountingConnection(conn, sizes)
+
+        def profiled_return_connection(conn):
+            return return_connection(getattr(conn, '_connection', conn))
+
+        stub.InvokeMethod = profiled_invoke_method
+        stub.GetConnection = profiled_get_connection
+        stub.ReturnConnection = profiled_return_connection
+        self._stub = stub
+
+    def detach(self):
+        """
+        Stop recording and restore the stub methods found by attach, which
+        are those of an enclosing profiler if any
+        """
+        if self._stub is not None:
+            for attribute in _STUB_METHODS:
+                if attribute in self._saved:
+                    setattr(self._stub, attribute, self._saved[attribute])
+                else:
+                    delattr(self._stub, attribute)
+            self._stub = None
+            self._saved = {}
+
+    def record(
+            self, operation, method, seconds, request_bytes, response_bytes
+    ):
+        """
+        Account a SOAP call
+        :param operation: The vcdriver operation that made the call
+        :param method: The SOAP method name
+        :param seconds: The round trip time
+        :param request_bytes: The size of the request body
+        :param response_bytes: The size of the response body
+        """
+        with self._lock:
+            methods = self.stats.setdefault(
+                operation, collections.OrderedDict()
+            )
+            methods.setdefault(method, SoapCallStats()).add(
+                seconds, request_bytes, response_bytes
+            )
+
+    def reset(self):
+        """ Forget all the recorded calls """
+        with self._lock:
+            self.stats.clear()
+
+    def report(self):
+        """
+        Build the per operation report
+
+        :return: A string table with calls, time and bytes per SOAP method
+        """
+        lines = ['SOAP calls per operation', '========================']
+        row = '{:<40} {:>7} {:>10} {:>12} {:>12}'
+        with self._lock:
+            for operation, methods in self.stats.items():
+                total = SoapCallStats()
+                lines.append('')
+                lines.append(operation)
+                lines.append(row.format(
+                    'method', 'calls', 'seconds', 'sent', 'received'
+                ))
+                for method, stats in methods.items():
+                    total.calls += stats.calls
+                    total.seconds += stats.seconds
+                    total.request_bytes += stats.request_bytes
+                    total.response_bytes += stats.response_bytes
+                    lines.append(row.format(
+                        method, stats.calls, '{:.3f}'.format(stats.seconds),
+                        stats.request_bytes, stats.response_bytes
+                    ))
+                lines.append(row.format(
+                    'TOTAL', total.calls, '{:.3f}'.format(total.seconds),
+                    total.request_bytes, total.response_bytes
+                ))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def profile(conn=None, quiet=False):
+    """
+    Count and time every SOAP call made to vcenter within a context
+    :param conn: A vcenter connection, by default the session connection
+    :param quiet: If true, the report will not be printed at the end
+
+    :return: The Profiler recording the calls
+    """
+    profiler = Profiler()
+    profiler.attach((conn or connection())._stub)
+    try:
+        yield profiler
+    finally:
+        profiler.detach()
+        if not quiet:
+            print(profiler.report())
@@ -0,0 +1,163 @@
+from __future__ import print_function
+import collections
+import datetime
+import errno
+import select
+import socket
+import time
+
+from vcdriver.exceptions import TimeoutError
+from vcdriver.helpers import timeout_loop, validate_ipv6
+
+
+SSH_PORT = 22
+WINRM_PORT = 5985
+WINRM_SSL_PORT = 5986
+
+# Connection attempts still in progress
+_CONNECTING = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+class ReadinessResult(collections.namedtuple(
+        'ReadinessResult', ['port_seconds', 'probe_seconds']
+)):
+    """
+    The latency of each readiness stage: until the port accepted TCP
+    connections, then until the authenticated probe succeeded
+    """
+    @property
+    def seconds(self):
+        return self.port_seconds + self.probe_seconds
+
+
+def _connect(host, port):
+    """
+    Start a non-blocking TCP connection
+    :param host: The IPv4/IPv6 address
+    :param port: The TCP port
+
+    :return: The socket, None if the connection failed straight away
+    """
+    family = socket.AF_INET6 if validate_ipv6(host) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    if sock.connect_ex((host, port)) in _CONNECTING + (0,):
+        return sock
+    sock.close()
+    return None
+
+
+def wait_for_ports(addresses, timeout, _poll_interval=1):
+    """
+    Wait until several TCP ports accept connections, with non-blocking
+    connects multiplexed by select, so no attempt blocks for the whole
+    connect timeout of a booting guest
+    :param addresses: An iterable of (host, port) pairs
+    :param timeout: The timeout, in seconds
+    :param _poll_interval: Seconds between the rounds of connections, the
+        connections still in progress carry over to the next round
+
+    :return: A dictionary of (host, port) -> seconds until it accepted
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    start = time.time()
+    latencies = {}
+    pending = set(addresses)
+    # Connections still in progress are kept across rounds, so a slow
+    # handshake is not restarted every poll interval
+    sockets = {}
+    try:
+        while pending:
+            round_start = time.time()
+            connecting = set(sockets.values())
+            for address in pending - connecting:
+                sock = _connect(*address)
+                if sock is not None:
+                    sockets[sock] = address
+            writable = select.select(
+                [], list(sockets), [], _poll_interval
+            )[1] if sockets else []
+            for sock in writable:
+                address = sockets.pop(sock)
+                if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    latencies[address] = time.time() - start
+                    pending.discard(address)
+                sock.close()
+            if pending:
+                if time.time() - start >= timeout:
+                    raise TimeoutError('Open ports {}'.format(
+                        ', '.join(
+                            '{}:{}'.format(*address)
+                            for address in sorted(pending)
+                        )
+                    ), timeout)
+                time.sleep(
+                    max(0, _poll_interval - (time.time() - round_start))
+                )
+    finally:
+        for sock in sockets:
+            sock.close()
+    return latencies
+
+
+def wait_for_services(services, description, timeout, quiet=False):
+    """
+    Wait until several services are ready in two stages: first all the ports
+    are polled together with cheap TCP connects, then the authenticated probe
+    of each service runs only once its port accepts connections
+    :param services: An iterable of (host, port, probe) tuples, where probe
+        is a function of no arguments that returns True or raises when the
+        service is not ready
+    :param description: The description of the services
+    :param timeout: The timeout, in seconds
+    :param quiet: If true, the stage latencies will not be printed
+
+    :return: A dictionary of (host, port) -> ReadinessResult
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    services = list(services)
+    start = time.time()
+    port_latencies = wait_for_ports(
+        [(host, port) for host, port, _ in services], timeout
+    )
+    results = {}
+    for host, port, probe in services:
+        probe_start = time.time()
+        # Even when the ports used up the timeout, the probe gets one attempt
+        timeout_loop(
+            max(timeout - (probe_start - start), 1),
+            '{} on {}:{}'.format(description, host, port),
+            1, True, probe
+        )
+        results[(host, port)] = ReadinessResult(
+            port_latencies[(host, port)], time.time() - probe_start
+        )
+    if not quiet:
+        for (host, port), result in sorted(results.items()):
+            print('{} on {}:{} ... port {}, probe {}'.format(
+                description, host, port,
+                datetime.timedelta(seconds=result.port_seconds),
+                datetime.timedelta(seconds=result.probe_seconds)
+            ))
+    return results
+
+
+def wait_for_service(host, port, probe, description, timeout, quiet=True):
+    """
+    Wait until a service is ready, see wait_for_services
+    :param host: The IPv4/IPv6 address
+    :param port: The TCP port
+    :param probe: The authenticated probe
+    :param description: The description of the service
+    :param timeout: The timeout, in seconds
+    :param quiet: If true, the stage latencies will not be printed
+
+    :return: The ReadinessResult
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    return wait_for_services(
+        [(host, port, probe)], description, timeout, quiet
+    )[(host, port)]
@@ -0,0 +1,150 @@
+from __future__ import print_function
+import datetime
+import threading
+import time
+
+from vcdriver.vm import query_virtual_machines
+
+
+class ReapResult(list):
+    """
+    The list of destroyed virtual machines, with the stale ones found, the
+    ones whose teardown failed and the teardown figures
+    """
+    def __init__(self, vms=(), stale=(), failed=(), seconds=0.0):
+        super(ReapResult, self).__init__(vms)
+        self.stale = list(stale)
+        self.failed = list(failed)
+        self.seconds = seconds
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    @property
+    def throughput(self):
+        """ Virtual machines destroyed per minute """
+        if self.seconds > 0:
+            return 60 * len(self) / self.seconds
+        return 0.0
+
+
+def find_stale_virtual_machines(
+        name=None,
+        folder=None,
+        older_than=datetime.timedelta(hours=6),
+        timeout=600
+):
+    """
+    Find the virtual machines left behind, with a single bulk retrieval.
+    Templates are never stale
+    :param name: A glob pattern or a compiled regular expression for the
+        names, see query_virtual_machines
+    :param folder: The folder (or its name) to limit the search to
+    :param older_than: A timedelta, only the machines created longer ago
+        are stale
+    :param timeout: The timeout for the tasks of the machines
+
+    :return: A list with the stale VirtualMachine objects
+
+    :raise: ValueError: If neither a name nor a folder is given, so the whole
+        inventory is never reaped by mistake
+    """
+    if name is None and folder is None:
+        raise ValueError('A name pattern or a folder is required')
+    return [
+        record.virtual_machine(timeout=timeout)
+        for record in query_virtual_machines(
+            name=name,
+            scope=folder,
+            created_before=datetime.datetime.utcnow() - older_than,
+            template=False
+        )
+    ]
+
+
+def reap_virtual_machines(
+        name=None,
+        folder=None,
+        older_than=datetime.timedelta(hours=6),
+        dry_run=False,
+        workers=8,
+        rate=None,
+        timeout=600,
+        quiet=False
+):
+    """
+    Destroy the virtual machines left behind e.g. by crashed test runs that
+    never left the virtual_machines context manager. The teardowns run
+    concurrently and a failure does not stop the others
+    :param name: A glob pattern or a compiled regular expression for the
+        names, see query_virtual_machines
+    :param folder: The folder (or its name) to limit the search to
+    :param older_than: A timedelta, only the machines created longer ago
+        are destroyed
+    :param dry_run: If True, the stale machines are only listed
+    :param workers: The number of machines torn down at once
+    :param rate: The maximum number of teardowns started per second, by
+        default unlimited
+    :param timeout: The timeout for the tasks of each machine
+    :param quiet: If true, the machines and the figures will not be printed
+
+    :return: The ReapResult
+
+    :raise: ValueError: If neither a name nor a folder is given
+    """
+    start = time.time()
+    stale = find_stale_virtual_machines(name, folder, older_than, timeout)
+    result = ReapResult(stale=stale)
+    if dry_run or not stale:
+        if not quiet:
+            for vm in stale:
+                print('Stale virtual machine "{}"'.format(vm.name))
+        result.seconds = time.time() - start
+        return result
+    pending = iter(stale)
+    lock = threading.Lock()
+    schedule = {'next_start': time.time()}
+
+    def reap():
+        while True:
+            with lock:
+                vm = next(pending, None)
+                if vm is None:
+                    return
+                delay = 0
+                if rate:
+                    now = time.time()
+                    delay = max(schedule['next_start'] - now, 0)
+                    schedule['next_start'] = now + delay + 1.0 / rate
+            time.sleep(delay)
+            try:
+                vm.destroy()
+            except Exception as e:
+                with lock:
+                    result.failed.append((vm, e))
+            else:
+                with lock:
+                    result.append(vm)
+
+    threads = [
+        threading.Thread(target=reap)
+        for _ in range(min(workers, len(stale)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.seconds = time.time() - start
+    if not quiet:
+        for vm, error in result.failed:
+            print('Failed to destroy "{}": {}'.format(vm.name, error))
+        print(
+            'Reaped {} of {} stale virtual machines in {} '
+            '({:.2f} per minute)'.format(
+                len(result), len(stale),
+                datetime.timedelta(seconds=result.seconds),
+                result.throughput
+            )
+        )
+    return result
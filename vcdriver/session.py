@@ -1,23 +1,109 @@
 import atexit
+import json
+import os
 import ssl
+import tempfile
+import threading
 
 from pyVim.connect import SmartConnect, Disconnect
+from pyVmomi import SoapStubAdapter, vim
 
-from vcdriver.config import configurable
+from vcdriver.config import configurable, read
+from vcdriver.helpers import destroy_container_views, inventory_mirror
 
 
 _session_id = None
 _connection_obj = None
+# The (session file, "user@host:port") where the session is kept for other
+# processes, if any
+_persisted = None
+# The (username, password) of the session, to renew it
+_credentials = None
+# The (thread, stop event) of the keepalive, if running
+_keepalive = None
+_renew_lock = threading.Lock()
+
+_replace = getattr(os, 'replace', os.rename)
 
 
 def close():
-    """ Close the session if exists """
-    global _session_id, _connection_obj
+    """
+    Close the session if exists. A session persisted in the session file is
+    not logged out, so that other processes can reattach to it until it
+    expires
+    """
+    global _session_id, _connection_obj, _persisted, _credentials
     if _connection_obj:
-        Disconnect(_connection_obj)
-        print('Vcenter session with ID {} closed'.format(_session_id))
+        mirror = inventory_mirror(_connection_obj)
+        if mirror is not None:
+            mirror.stop()
+        destroy_container_views()
+        if _persisted:
+            print('Vcenter session with ID {} kept'.format(_session_id))
+        else:
+            Disconnect(_connection_obj)
+            print('Vcenter session with ID {} closed'.format(_session_id))
         _session_id = None
         _connection_obj = None
+        _persisted = None
+        _credentials = None
+
+
+def _load_sessions(session_file):
+    """
+    :param session_file: The session file path
+
+    :return: A dictionary of "user@host:port" -> persisted session
+    """
+    try:
+        with open(session_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_session(session_file, key, stub):
+    """
+    Persist the session cookie and the negotiated API version, in a file only
+    readable by its owner that is replaced atomically
+    :param session_file: The session file path
+    :param key: The "user@host:port" of the session
+    :param stub: The SoapStubAdapter of the session
+    """
+    sessions = _load_sessions(session_file)
+    sessions[key] = {'cookie': stub.cookie, 'version': stub.version}
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(session_file))
+    )
+    with os.fdopen(fd, 'w') as f:
+        json.dump(sessions, f)
+    _replace(temp_path, session_file)
+
+
+def _reattach(session, context, **kwargs):
+    """
+    Reattach to a persisted session, without the version negotiation and the
+    login of SmartConnect
+    :param session: The persisted session
+    :param context: The SSL context
+
+    :return: The connection, None if the session has expired
+    """
+    stub = SoapStubAdapter(
+        host=kwargs['vcdriver_host'],
+        port=int(kwargs['vcdriver_port']),
+        version=session['version'],
+        connectionPoolTimeout=int(kwargs['vcdriver_idle_timeout']),
+        sslContext=context
+    )
+    stub.cookie = session['cookie']
+    service_instance = vim.ServiceInstance('ServiceInstance', stub)
+    try:
+        if service_instance.content.sessionManager.currentSession:
+            return service_instance
+    except vim.fault.NotAuthenticated:
+        pass
+    return None
 
 
 @configurable([
@@ -28,21 +114,46 @@ def close():
     ('Vsphere Session', 'vcdriver_idle_timeout'),
 ])
 def connection(**kwargs):
-    """ Open the session if it does not exist and return the connection """
-    global _session_id, _connection_obj
+    """
+    Open the session if it does not exist and return the connection. When the
+    vcdriver_session_file option is set, the session is persisted there and
+    the next processes reattach to it instead of logging in again, until it
+    expires
+    """
+    global _session_id, _connection_obj, _persisted, _credentials
     if not _connection_obj:
         context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
         context.verify_mode = ssl.CERT_NONE
-        _connection_obj = SmartConnect(
-            host=kwargs['vcdriver_host'],
-            port=kwargs['vcdriver_port'],
-            user=kwargs['vcdriver_username'],
-            pwd=kwargs['vcdriver_password'],
-            connectionPoolTimeout=int(kwargs['vcdriver_idle_timeout']),
-            sslContext=context
+        session_file = kwargs.get('vcdriver_session_file') or read()[
+            'Vsphere Session'
+        ].get('vcdriver_session_file')
+        key = '{}@{}:{}'.format(
+            kwargs['vcdriver_username'],
+            kwargs['vcdriver_host'],
+            kwargs['vcdriver_port']
+        )
+        session = session_file and _load_sessions(session_file).get(key)
+        if session:
+            _connection_obj = _reattach(session, context, **kwargs)
+        action = 'reattached'
+        if not _connection_obj:
+            action = 'opened'
+            _connection_obj = SmartConnect(
+                host=kwargs['vcdriver_host'],
+                port=kwargs['vcdriver_port'],
+                user=kwargs['vcdriver_username'],
+                pwd=kwargs['vcdriver_password'],
+                connectionPoolTimeout=int(kwargs['vcdriver_idle_timeout']),
+                sslContext=context
+            )
+            if session_file:
+                _save_session(session_file, key, _connection_obj._stub)
+        _persisted = (session_file, key) if session_file else None
+        _credentials = (
+            kwargs['vcdriver_username'], kwargs['vcdriver_password']
         )
         _session_id = _connection_obj.content.sessionManager.currentSession.key
-        print('Vcenter session opened with ID {}'.format(_session_id))
+        print('Vcenter session {} with ID {}'.format(action, _session_id))
         atexit.register(close)
     return _connection_obj
 
@@ -55,3 +166,115 @@ def id():
     """
     global _session_id
     return _session_id
+
+
+def renew(force=False):
+    """
+    Log in again on the current connection with its credentials once the
+    session expired. The new session cookie is kept by the same stub, so the
+    vcenter objects already bound to it keep working without being looked up
+    again, while the container views of the old session are discarded and
+    the inventory mirror following the connection, if any, is started again
+    in the new session. A session still alive is kept as is, so the other
+    processes sharing a persisted session are not logged out
+    :param force: If True, log out and in again even if the session is alive
+
+    :return: The connection
+    """
+    global _session_id
+    with _renew_lock:
+        if not _connection_obj:
+            return connection()
+        session_manager = _connection_obj.content.sessionManager
+        alive = _session_alive(session_manager)
+        if alive and not force:
+            return _connection_obj
+        # The server side objects can only be released while their session
+        # is alive, otherwise they are gone with it
+        mirror = inventory_mirror(_connection_obj, running=False)
+        if mirror is not None:
+            mirror.stop(release=alive)
+        destroy_container_views(release=alive)
+        if alive:
+            try:
+                session_manager.Logout()
+            except vim.fault.NotAuthenticated:
+                pass
+        _session_id = session_manager.Login(*_credentials).key
+        if _persisted:
+            _save_session(_persisted[0], _persisted[1], _connection_obj._stub)
+        print('Vcenter session renewed with ID {}'.format(_session_id))
+        if mirror is not None:
+            mirror.start()
+        return _connection_obj
+
+
+def _session_alive(session_manager):
+    """
+    :param session_manager: The session manager of a vcenter connection
+
+    :return: Whether the session is still authenticated
+    """
+    try:
+        return session_manager.currentSession is not None
+    except vim.fault.NotAuthenticated:
+        return False
+
+
+def _ping(conn):
+    """
+    :param conn: A vcenter connection
+
+    :return: Whether its session is still authenticated
+    """
+    try:
+        conn.CurrentTime()
+    except vim.fault.NotAuthenticated:
+        return False
+    return True
+
+
+def _keep_alive(interval, stopped):
+    """
+    :param interval: Seconds between the calls
+    :param stopped: The event that stops the keepalive
+    """
+    while not stopped.wait(interval):
+        conn = _connection_obj
+        if conn is None:
+            continue
+        try:
+            if not _ping(conn):
+                renew()
+        except Exception:
+            # A network glitch must not stop the keepalive, the next round
+            # will tell
+            pass
+
+
+def start_keepalive(interval=600):
+    """
+    Keep the session alive in a background thread, calling CurrentTime before
+    the idle timeout runs out, and renewing the session if it expired anyway
+    (e.g. after the machine was suspended)
+    :param interval: Seconds between the calls, below the session timeout of
+        vcenter (30 minutes by default)
+    """
+    global _keepalive
+    if _keepalive is not None:
+        return
+    stopped = threading.Event()
+    thread = threading.Thread(target=_keep_alive, args=(interval, stopped))
+    thread.daemon = True
+    _keepalive = (thread, stopped)
+    thread.start()
+
+
+def stop_keepalive():
+    """ Stop the keepalive thread, if running """
+    global _keepalive
+    if _keepalive is not None:
+        thread, stopped = _keepalive
+        _keepalive = None
+        stopped.set()
+        thread.join()
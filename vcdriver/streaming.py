@@ -0,0 +1,239 @@
+import base64
+import codecs
+import collections
+import io
+import time
+
+from winrm.exceptions import WinRMOperationTimeoutError
+
+from vcdriver.exceptions import TimeoutError
+from vcdriver.transfer import _open_ssh_channel
+
+
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+# Longer lines are handed over in pieces to keep the memory bounded
+_MAX_LINE = 64 * 1024
+
+# Seconds each WinRM receive waits for output, which bounds how long a
+# cancellation takes to be noticed
+WINRM_RECEIVE_TIMEOUT = 20
+
+
+class LineSplitter(object):
+    """ Split a stream of utf-8 chunks into lines, without the line breaks """
+    def __init__(self, max_line=_MAX_LINE):
+        self.max_line = max_line
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._partial = ''
+
+    def feed(self, data):
+        """
+        :param data: The next chunk of bytes
+
+        :return: The list of lines completed by the chunk
+        """
+        lines = (self._partial + self._decoder.decode(data)).split('\n')
+        self._partial = lines.pop()
+        while len(self._partial) > self.max_line:
+            lines.append(self._partial[:self.max_line])
+            self._partial = self._partial[self.max_line:]
+        return [line.rstrip('\r') for line in lines]
+
+    def flush(self):
+        """ :return: The list with the last unfinished line, if any """
+        line = self._partial + self._decoder.decode(b'', True)
+        self._partial = ''
+        return [line.rstrip('\r')] if line else []
+
+
+class OutputSink(object):
+    def __init__(
+            self, tail_lines=100, spool_path=None, separator=u'\n',
+            tail_size=None
+    ):
+        """
+        Keep a bounded tail of each output stream and optionally append the
+        whole output to a local file, so the memory stays constant
+        :param tail_lines: The number of lines (or chunks) kept for each
+            stream
+        :param spool_path: The local file where every line is appended
+        :param separator: What follows each piece of output, a line break
+            for lines and nothing for chunks
+        :param tail_size: If given, the maximum number of characters kept for
+            each stream, since a single chunk can be arbitrarily big
+
+        tails: A dictionary of stream name -> deque with its last lines
+        """
+        self.tails = collections.defaultdict(
+            lambda: collections.deque(maxlen=tail_lines)
+        )
+        self.spool_path = spool_path
+        self.separator = separator
+        self.tail_size = tail_size
+        self._sizes = collections.defaultdict(int)
+        self._spool = None
+
+    def write(self, stream, line):
+        """
+        :param stream: The stream name, stdout or stderr
+        :param line: The line, without the line break
+        """
+        tail = self.tails[stream]
+        if len(tail) == tail.maxlen:
+            self._sizes[stream] -= len(tail[0])
+        tail.append(line)
+        self._sizes[stream] += len(line)
+        if self.tail_size is not None:
+            while self._sizes[stream] > self.tail_size:
+                excess = self._sizes[stream] - self.tail_size
+                if len(tail[0]) <= excess:
+                    self._sizes[stream] -= len(tail.popleft())
+                else:
+                    tail[0] = tail[0][excess:]
+                    self._sizes[stream] = self.tail_size
+        if self.spool_path is not None:
+            if self._spool is None:
+                self._spool = io.open(self.spool_path, 'a', encoding='utf-8')
+            self._spool.write(line + self.separator)
+
+    def tail(self, stream):
+        """ :return: The last lines of a stream, joined """
+        return self.separator.join(self.tails[stream])
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+
+class SshOutput(object):
+    def __init__(self, command, use_sudo=False, _poll_interval=0.1):
+        """
+        Run a command through a raw ssh channel and iterate its output as
+        (stream, line) pairs while it runs. The channel has to be opened
+        inside a fabric_context, with open or when the iteration starts, but
+        it is read outside of it
+        :param command: The shell command
+        :param use_sudo: If True, it runs as sudo (requires passwordless sudo)
+
+        return_code: The exit code, once the iteration is over
+        """
+        self.command = command
+        self.use_sudo = use_sudo
+        self.return_code = None
+        self._poll_interval = _poll_interval
+        self._channel = None
+
+    def open(self):
+        """ Start the command on the current fabric host """
+        self._channel = _open_ssh_channel(self.command, self.use_sudo)
+
+    def __iter__(self):
+        if self._channel is None:
+            self.open()
+        channel = self._channel
+        splitters = {STDOUT: LineSplitter(), STDERR: LineSplitter()}
+        readers = (
+            (STDOUT, channel.recv_ready, channel.recv),
+            (STDERR, channel.recv_stderr_ready, channel.recv_stderr)
+        )
+        try:
+            while True:
+                received = False
+                for stream, ready, recv in readers:
+                    if ready():
+                        received = True
+                        for line in splitters[stream].feed(recv(32768)):
+                            yield stream, line
+                if not received:
+                    if channel.exit_status_ready() and not (
+                        channel.recv_ready() or channel.recv_stderr_ready()
+                    ):
+                        break
+                    time.sleep(self._poll_interval)
+            for stream in (STDOUT, STDERR):
+                for line in splitters[stream].flush():
+                    yield stream, line
+            self.return_code = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+
+class WinRmOutput(object):
+    def __init__(
+            self, pywinrm_session, script, encoding='utf-8', cancel=None,
+            timeout=None
+    ):
+        """
+        Run a powershell script with the WinRM shell, command and receive
+        primitives and iterate its output as (stream, text) chunks as they
+        arrive. Closing the iteration early terminates the script
+        :param pywinrm_session: The WinRM session
+        :param script: The powershell script
+        :param encoding: The encoding of the guest output, decoded
+            incrementally
+        :param cancel: An event (e.g. threading.Event) that terminates the
+            script when set
+        :param timeout: If given, the seconds after which the script is
+            terminated and TimeoutError is raised. It is checked between
+            receives, so it may be exceeded by the receive timeout
+
+        return_code: The exit code, once the script has finished
+        cancelled: Whether the script was terminated through the event
+        """
+        self.pywinrm_session = pywinrm_session
+        self.script = script
+        self.encoding = encoding
+        self.cancel = cancel
+        self.timeout = timeout
+        self.return_code = None
+        self.cancelled = False
+
+    def __iter__(self):
+        protocol = self.pywinrm_session.protocol
+        receive = getattr(
+            protocol, 'get_command_output_raw', None
+        ) or protocol._raw_get_command_output
+        decoders = dict(
+            (stream, codecs.getincrementaldecoder(self.encoding)('replace'))
+            for stream in (STDOUT, STDERR)
+        )
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        shell_id = protocol.open_shell()
+        try:
+            command_id = protocol.run_command(
+                shell_id,
+                'powershell',
+                [
+                    '-encodedcommand',
+                    base64.b64encode(
+                        self.script.encode('utf_16_le')
+                    ).decode('ascii')
+                ]
+            )
+            try:
+                done = False
+                while not done:
+                    if self.cancel is not None and self.cancel.is_set():
+                        self.cancelled = True
+                        return
+                    if self.timeout is not None and time.time() >= deadline:
+                        raise TimeoutError('WinRM script', self.timeout)
+                    try:
+                        stdout, stderr, code, done = receive(
+                            shell_id, command_id
+                        )
+                    except WinRMOperationTimeoutError:
+                        continue
+                    for stream, data in ((STDOUT, stdout), (STDERR, stderr)):
+                        text = decoders[stream].decode(data, done)
+                        if text:
+                            yield stream, text
+                self.return_code = code
+            finally:
+                protocol.cleanup_command(shell_id, command_id)
+        finally:
+            protocol.close_shell(shell_id)
@@ -0,0 +1,432 @@
+from __future__ import print_function
+import base64
+import contextlib
+import datetime
+import gzip
+import hashlib
+import mmap
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from fabric.state import connections, env
+import six
+from six.moves import shlex_quote
+
+
+# Refuse absolute paths and links escaping the destination when supported
+_EXTRACT_KWARGS = (
+    {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+)
+
+
+# Slices of a memoryview share the mapped pages instead of copying them,
+# python 2 mmap objects do not export buffers to memoryview
+_mapped_buffer = memoryview if six.PY3 else (lambda mapped: mapped)
+
+
+class TransferResult(list):
+    """
+    The list of transferred paths, with the same failed/succeeded interface
+    as the fabric put/get results and the transfer figures
+    """
+    def __init__(self, paths=(), failed=(), size=0, seconds=0.0):
+        super(TransferResult, self).__init__(paths)
+        self.failed = list(failed)
+        self.size = size
+        self.seconds = seconds
+        self.manifest = None
+        self.offset = 0
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    @property
+    def throughput(self):
+        """ Bytes per second sent over the wire """
+        if self.seconds > 0:
+            return self.size / self.seconds
+        return 0.0
+
+
+class _CountingFile(object):
+    """ Proxy of a file object that counts the bytes going through it """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self._fileobj.write(data)
+
+    def read(self, *args):
+        data = self._fileobj.read(*args)
+        self.size += len(data)
+        return data
+
+
+def print_throughput(description, result):
+    """
+    Print the time and throughput of a transfer
+    :param description: The transfer description
+    :param result: The TransferResult
+    """
+    print('{} ... {} bytes in {} ({:.2f} MB/s)'.format(
+        description,
+        result.size,
+        datetime.timedelta(seconds=result.seconds),
+        result.throughput / (1024 * 1024)
+    ))
+
+
+def base64_chunks(local_path, step, offset=0):
+    """
+    Read a file in chunks through a memory map, without copying it into read
+    buffers first, and base64 encode them, ready to be embedded into remote
+    commands
+    :param local_path: The local file
+    :param step: Number of bytes of each chunk
+    :param offset: The offset of the first chunk
+
+    :return: A generator of (offset, size, base64 string) tuples
+    """
+    with open(local_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset >= size:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = _mapped_buffer(mapped)
+        try:
+            for start in range(offset, size, step):
+                yield start, min(step, size - start), base64.b64encode(
+                    view[start:start + step]
+                ).decode('ascii')
+        finally:
+            # The mapping can only be closed once no view is exported
+            del view
+            mapped.close()
+
+
+def gzip_file(local_path, level=6):
+    """
+    Compress a file into a new temporary file, streaming it from disk
+    :param local_path: The file to compress
+    :param level: The gzip compression level
+
+    :return: The path of the temporary gzip file, to be removed by the caller
+    """
+    handle, compressed_path = tempfile.mkstemp(suffix='.gz')
+    os.close(handle)
+    with open(local_path, 'rb') as source:
+        with gzip.open(compressed_path, 'wb', level) as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+    return compressed_path
+
+
+def _open_ssh_channel(command, use_sudo):
+    """
+    Run a command on the current fabric host through a raw channel
+    :param command: The shell command
+    :param use_sudo: If True, it runs through non interactive sudo
+
+    :return: The paramiko channel
+    """
+    if use_sudo:
+        command = 'sudo -n sh -c {}'.format(shlex_quote(command))
+    channel = connections[env.host_string].get_transport().open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def _archive_mode(direction, compress):
+    return '{}|{}'.format(direction, 'gz' if compress else '')
+
+
+def ssh_archive_upload(
+        local_path, remote_path, use_sudo=False, compress=False, members=None
+):
+    """
+    Upload a file or directory tree as a single tar stream over one ssh
+    channel, unpacking it remotely into the remote directory. It has to be
+    used inside a fabric_context
+    :param local_path: The local file or directory
+    :param remote_path: The remote directory, created if missing
+    :param use_sudo: If True, it unpacks as sudo (requires passwordless sudo)
+    :param compress: If True, the stream is gzip compressed
+    :param members: If given, only these archive names (as the keys of
+        local_manifest) are sent instead of the whole tree
+
+    :return: A TransferResult with the remote paths
+    """
+    start = time.time()
+    channel = _open_ssh_channel(
+        'mkdir -p {0} && tar -x{1}f - -C {0}'.format(
+            shlex_quote(remote_path), 'z' if compress else ''
+        ),
+        use_sudo
+    )
+    channel_file = channel.makefile('wb')
+    stream = _CountingFile(channel_file)
+    local_path = os.path.normpath(local_path)
+    with contextlib.closing(
+        tarfile.open(fileobj=stream, mode=_archive_mode('w', compress))
+    ) as archive:
+        if members is None:
+            archive.add(local_path, arcname=os.path.basename(local_path))
+        else:
+            for member in members:
+                archive.add(
+                    os.path.join(os.path.dirname(local_path), member),
+                    arcname=member,
+                    recursive=False
+                )
+        names = [
+            '/'.join((remote_path.rstrip('/'), member.name))
+            for member in archive.getmembers() if not member.isdir()
+        ]
+    channel_file.flush()
+    channel.shutdown_write()
+    failed = [] if channel.recv_exit_status() == 0 else [local_path]
+    return TransferResult(names, failed, stream.size, time.time() - start)
+
+
+def _file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_prefix_digest(path, length, block_size=1024 * 1024):
+    """
+    Hash the beginning of a local file
+    :param path: The local file
+    :param length: The number of bytes to hash
+
+    :return: The sha256 hex digest, None if the file is shorter
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while length > 0:
+            block = f.read(min(block_size, length))
+            if not block:
+                return None
+            digest.update(block)
+            length -= len(block)
+    return digest.hexdigest()
+
+
+def local_manifest(local_path):
+    """
+    Hash the files of a local file or directory tree
+    :param local_path: The local file or directory
+
+    :return: A dictionary of archive name -> sha1 hex digest, where the
+        archive names are relative to the parent of local_path
+    """
+    local_path = os.path.normpath(local_path)
+    parent = os.path.dirname(local_path)
+    if os.path.isfile(local_path):
+        paths = [local_path]
+    else:
+        paths = [
+            os.path.join(root, file_name)
+            for root, _, file_names in os.walk(local_path)
+            for file_name in file_names
+        ]
+    return dict(
+        (os.path.relpath(path, parent).replace(os.sep, '/'),
+         _file_digest(path))
+        for path in paths
+    )
+
+
+def ssh_remote_manifest(remote_path, name, use_sudo=False):
+    """
+    Hash the remote files of a tree previously uploaded to a remote
+    directory. It has to be used inside a fabric_context
+    :param remote_path: The remote directory
+    :param name: The archive name of the tree inside the remote directory
+    :param use_sudo: If True, it runs as sudo (requires passwordless sudo)
+
+    :return: A dictionary of archive name -> sha1 hex digest, empty if
+        nothing was found
+    """
+    channel = _open_ssh_channel(
+        'cd {} && find {} -type f -exec sha1sum {{}} +'.format(
+            shlex_quote(remote_path), shlex_quote(name)
+        ),
+        use_sudo
+    )
+    output = channel.makefile('rb').read().decode('utf-8')
+    channel.recv_exit_status()
+    manifest = {}
+    for line in output.splitlines():
+        digest, _, path = line.partition(' ')
+        if path:
+            manifest[path[1:]] = digest
+    return manifest
+
+
+def ssh_sync_upload(
+        local_path, remote_path, manifest=None, use_sudo=False, compress=False
+):
+    """
+    Upload only the files of a tree whose content differs from the remote
+    copy. It has to be used inside a fabric_context
+    :param local_path: The local file or directory
+    :param remote_path: The remote directory, created if missing
+    :param manifest: The known remote manifest from a previous sync. If None,
+        it is computed on the remote host
+    :param use_sudo: If True, it runs as sudo (requires passwordless sudo)
+    :param compress: If True, the stream is gzip compressed
+
+    :return: A TransferResult with the remote paths sent, and the resulting
+        remote manifest in its manifest attribute
+    """
+    start = time.time()
+    local = local_manifest(local_path)
+    if manifest is None:
+        manifest = ssh_remote_manifest(
+            remote_path,
+            os.path.basename(os.path.normpath(local_path)),
+            use_sudo
+        )
+    changed = sorted(
+        name for name, digest in local.items() if manifest.get(name) != digest
+    )
+    if changed:
+        result = ssh_archive_upload(
+            local_path, remote_path, use_sudo, compress, changed
+        )
+    else:
+        result = TransferResult()
+    result.seconds = time.time() - start
+    result.manifest = dict(manifest)
+    if result.succeeded:
+        result.manifest.update(local)
+    return result
+
+
+def _unsafe_member(member, local_path):
+    """
+    Check a tar member by hand on the pythons without tarfile.data_filter
+    :param member: The TarInfo
+    :param local_path: The directory the archive is unpacked into
+
+    :return: Whether the member is not a file, directory or link, or it
+        would be written or point outside the local directory
+    """
+    root = os.path.realpath(local_path)
+    targets = [os.path.join(root, member.name)]
+    if member.issym():
+        targets.append(os.path.join(
+            root, os.path.dirname(member.name), member.linkname
+        ))
+    elif member.islnk():
+        targets.append(os.path.join(root, member.linkname))
+    elif not (member.isfile() or member.isdir()):
+        return True
+    for target in targets:
+        target = os.path.realpath(target)
+        if target != root and not target.startswith(os.path.join(root, '')):
+            return True
+    return False
+
+
+def ssh_archive_download(
+        remote_path, local_path, use_sudo=False, compress=False
+):
+    """
+    Download a remote file or directory tree as a single tar stream over one
+    ssh channel, unpacking it into the local directory. It has to be used
+    inside a fabric_context
+    :param remote_path: The remote file or directory
+    :param local_path: The local directory, created if missing
+    :param use_sudo: If True, it packs as sudo (requires passwordless sudo)
+    :param compress: If True, the stream is gzip compressed
+
+    :return: A TransferResult with the local paths, failed if the archive is
+        truncated or it has members escaping the local directory, which are
+        not unpacked
+    """
+    start = time.time()
+    remote_path = remote_path.rstrip('/') or '/'
+    channel = _open_ssh_channel(
+        'tar -c{}f - -C {} {}'.format(
+            'z' if compress else '',
+            shlex_quote(os.path.dirname(remote_path) or '.'),
+            shlex_quote(os.path.basename(remote_path))
+        ),
+        use_sudo
+    )
+    stream = _CountingFile(channel.makefile('rb'))
+    names = []
+    complete = True
+    try:
+        with contextlib.closing(
+            tarfile.open(fileobj=stream, mode=_archive_mode('r', compress))
+        ) as archive:
+            for member in archive:
+                if not _EXTRACT_KWARGS and _unsafe_member(member, local_path):
+                    complete = False
+                    continue
+                archive.extract(member, local_path, **_EXTRACT_KWARGS)
+                if not member.isdir():
+                    names.append(os.path.join(local_path, member.name))
+    except tarfile.ReadError:
+        complete = False
+    if channel.recv_exit_status() != 0:
+        complete = False
+    failed = [] if complete else [remote_path]
+    return TransferResult(names, failed, stream.size, time.time() - start)
+
+
+def ssh_resume_upload(local_path, remote_path, use_sudo=False):
+    """
+    Upload a file over one ssh channel, continuing a previous interrupted
+    upload when the remote file is a prefix of the local one. It has to be
+    used inside a fabric_context
+    :param local_path: The local file
+    :param remote_path: The remote file, or a directory to put it into
+    :param use_sudo: If True, it writes as sudo (requires passwordless sudo)
+
+    :return: A TransferResult with the remote path, where offset is the
+        number of bytes that were already uploaded
+    """
+    start = time.time()
+    target = 'p={}; [ -d "$p" ] && p="$p"/{}; '.format(
+        shlex_quote(remote_path),
+        shlex_quote(os.path.basename(local_path))
+    )
+    channel = _open_ssh_channel(
+        target + 'echo "$p"; [ -f "$p" ] && stat -c %s "$p" && '
+        'sha256sum < "$p"',
+        use_sudo
+    )
+    output = channel.makefile('rb').read().decode('utf-8').split('\n')
+    channel.recv_exit_status()
+    path = output[0]
+    offset = 0
+    if len(output) > 2 and output[1] and output[2]:
+        length = int(output[1])
+        if file_prefix_digest(local_path, length) == output[2].split()[0]:
+            offset = length
+    channel = _open_ssh_channel(
+        target + 'cat {} "$p"'.format('>>' if offset else '>'), use_sudo
+    )
+    channel_file = channel.makefile('wb')
+    stream = _CountingFile(channel_file)
+    with open(local_path, 'rb') as f:
+        f.seek(offset)
+        shutil.copyfileobj(f, stream, 1024 * 1024)
+    channel_file.flush()
+    channel.shutdown_write()
+    failed = [] if channel.recv_exit_status() == 0 else [local_path]
+    result = TransferResult([path], failed, stream.size, time.time() - start)
+    result.offset = offset
+    return result
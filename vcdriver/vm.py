@@ -1,16 +1,25 @@
 from __future__ import print_function
 
 import base64
+import codecs
+import collections
 import contextlib
 import datetime
+import fnmatch
+import functools
+import hashlib
 import os
-import sys
+import re
+import tempfile
+import threading
 import time
 import uuid
 
 from colorama import Style, Fore
 from fabric.api import sudo, run, get, put, hide
 from pyVmomi import vim
+import requests
+import six
 import winrm
 
 from vcdriver.config import configurable
@@ -19,26 +28,80 @@ from vcdriver.exceptions import (
     WinRmError,
     UploadError,
     DownloadError,
+    GuestOperationError,
     NoObjectFound,
     TooManyObjectsFound,
     NotEnoughDiskSpace,
-    TimeoutError
+    IpError,
+    IpPoolExhausted,
+    TimeoutError,
+    VcenterMismatch
 )
 from vcdriver.helpers import (
     get_all_vcenter_objects,
+    get_vcenter_object_by_id,
     get_vcenter_object_by_name,
+    get_vcenter_parents,
+    get_vcenter_property,
+    get_virtual_machine_by_uuid,
+    inventory_mirror,
+    iter_vcenter_properties,
     styled_print,
     timeout_loop,
     validate_ip,
+    validate_ipv4,
     wait_for_vcenter_task,
+    wait_for_vcenter_tasks,
     fabric_context,
     check_ssh_service,
     check_winrm_service,
+    powershell_quote,
+    print_progress,
+    winrm_shell,
+    winrm_stdin_script,
+)
+from vcdriver.readiness import (
+    SSH_PORT,
+    WINRM_PORT,
+    WINRM_SSL_PORT,
+    wait_for_service,
 )
 from vcdriver.session import (
     connection,
-    close,
+    renew,
     )
+from vcdriver.streaming import (
+    OutputSink,
+    SshOutput,
+    WinRmOutput,
+    STDERR,
+    STDOUT,
+    WINRM_RECEIVE_TIMEOUT,
+)
+from vcdriver.transfer import (
+    TransferResult,
+    base64_chunks,
+    file_prefix_digest,
+    gzip_file,
+    print_throughput,
+    ssh_archive_download,
+    ssh_archive_upload,
+    ssh_resume_upload,
+    ssh_sync_upload,
+)
+
+# Serializes the lazy binding of unpickled handles
+_bind_lock = threading.Lock()
+
+# The static IPs given back to their pools (iterators), handed out again
+# before the pools are advanced
+_released_ips = {}
+_ip_pool_lock = threading.Lock()
+
+# The minimum chunk of the parallel WinRM uploads, sent through the standard
+# input of the writers. With its base64 encodings it stays well within the
+# default MaxEnvelopeSizekb of 500
+_WINRM_STDIN_STEP = 128 * 1024
 
 
 class VirtualMachine(object):
@@ -53,12 +116,25 @@ class VirtualMachine(object):
         :param template: The virtual machine template name to be cloned
         :param timeout: The timeout for the tasks
 
+        skipped_tasks: The number of power tasks not sent to vcenter because
+            the virtual machine was already in the requested power state
         _vm_object: An internal instance of the vcenter vm object
+        _ssh_manifests: The remote file manifests of the synced uploads
+        _winrm_scripts: The digests of the scripts cached on the guest
+        _power_state: The last known power state, None if unknown
+        _static_ip: The IP given to the guest at clone time, if any
+        _ip_pool: The pool the static IP was taken from, if any
         """
         self.name = name or str(uuid.uuid4())
         self.template = template
         self.timeout = timeout
+        self.skipped_tasks = 0
         self._vm_object = None
+        self._ssh_manifests = {}
+        self._winrm_scripts = set()
+        self._power_state = None
+        self._static_ip = None
+        self._ip_pool = None
 
     @configurable([
         ('Virtual Machine Deployment', 'vcdriver_resource_pool'),
@@ -66,8 +142,47 @@ class VirtualMachine(object):
         ('Virtual Machine Deployment', 'vcdriver_data_store_threshold'),
         ('Virtual Machine Deployment', 'vcdriver_folder')
     ])
-    def create(self, **kwargs):
-        """ Create the virtual machine and update the vm object """
+    def create(
+            self,
+            ip_source=None,
+            subnet_mask='255.255.255.0',
+            gateway=None,
+            dns_servers=(),
+            hostname=None,
+            domain='',
+            windows=False,
+            time_zone=85,
+            full_name=None,
+            org_name=None,
+            admin_password=None,
+            **kwargs
+    ):
+        """
+        Create the virtual machine and update the vm object
+        :param ip_source: To customize the guest with a static IPv4 address
+            instead of waiting for DHCP: the address, an iterator over a pool
+            of addresses (shared by the machines created with it, e.g.
+            iter(addresses)) or a callable that gets this VirtualMachine and
+            returns the address. An address taken from a pool goes back to it
+            when the clone fails or the machine is destroyed
+        :param subnet_mask: The subnet mask of the static IP
+        :param gateway: The default gateway of the static IP
+        :param dns_servers: The list of DNS servers of the static IP
+        :param hostname: The guest hostname, by default the machine name
+        :param domain: The guest domain
+        :param windows: Whether to customize the guest with sysprep instead
+            of the linux customization
+        :param time_zone: The sysprep time zone index, by default GMT
+        :param full_name: The sysprep user full name, by default the hostname
+        :param org_name: The sysprep organization, by default the hostname
+        :param admin_password: The sysprep administrator password, by
+            default left unchanged
+
+        :raise: IpPoolExhausted: If the pool has no addresses left
+        :raise: IpError: If the allocated IP is not a valid IPv4 address
+        :raise: TypeError: If ip_source is a list or another iterable that
+            is not an iterator
+        """
         conn = connection()
         if not self._vm_object:
             data_store_name = kwargs['vcdriver_data_store']
@@ -84,48 +199,131 @@ class VirtualMachine(object):
                 raise NotEnoughDiskSpace(
                     data_store_name, threshold, free_percentage
                 )
-            self._vm_object = wait_for_vcenter_task(
-                get_vcenter_object_by_name(
-                    conn, vim.VirtualMachine, self.template
-                ).CloneVM_Task(
-                    folder=get_vcenter_object_by_name(
-                        conn, vim.Folder, kwargs['vcdriver_folder']
-                    ),
-                    name=self.name,
-                    spec=vim.vm.CloneSpec(
-                        location=vim.vm.RelocateSpec(
-                            datastore=data_store,
-                            pool=get_vcenter_object_by_name(
-                                conn,
-                                vim.ResourcePool,
-                                kwargs['vcdriver_resource_pool']
-                            )
+            customization = ip_pool = None
+            if ip_source is not None:
+                static_ip, ip_pool = self._allocate_ip(ip_source)
+                hostname = hostname or self.name
+                customization = _customization_spec(
+                    static_ip, subnet_mask, gateway, dns_servers, hostname,
+                    domain, windows, time_zone, full_name or hostname,
+                    org_name or hostname, admin_password
+                )
+            try:
+                self._vm_object = wait_for_vcenter_task(
+                    get_vcenter_object_by_name(
+                        conn, vim.VirtualMachine, self.template
+                    ).CloneVM_Task(
+                        folder=get_vcenter_object_by_name(
+                            conn, vim.Folder, kwargs['vcdriver_folder']
                         ),
-                        powerOn=True,
-                        template=False
-                    )
-                ),
-                'Create virtual machine "{}" from template "{}"'.format(
-                    self.name, self.template
-                ),
-                self.timeout
-            )
-
-    def find(self):
-        """ Find and update the vm object based on the name """
+                        name=self.name,
+                        spec=vim.vm.CloneSpec(
+                            location=vim.vm.RelocateSpec(
+                                datastore=data_store,
+                                pool=get_vcenter_object_by_name(
+                                    conn,
+                                    vim.ResourcePool,
+                                    kwargs['vcdriver_resource_pool']
+                                )
+                            ),
+                            customization=customization,
+                            powerOn=True,
+                            template=False
+                        )
+                    ),
+                    'Create virtual machine "{}" from template "{}"'.format(
+                        self.name, self.template
+                    ),
+                    self.timeout
+                )
+            except TimeoutError:
+                # The clone might still complete with the address
+                raise
+            except Exception:
+                if ip_pool is not None:
+                    _release_ip(ip_pool, static_ip)
+                raise
+            self._power_state = 'poweredOn'
+            if customization is not None:
+                self._static_ip = static_ip
+                self._ip_pool = ip_pool
+
+    def find(self, scope=None):
+        """
+        Find and update the vm object based on the name
+        :param scope: A folder, datacenter or cluster to limit the search to,
+            by default the whole inventory
+        """
         if not self._vm_object:
             self._vm_object = get_vcenter_object_by_name(
-                connection(), vim.VirtualMachine, self.name
+                connection(), vim.VirtualMachine, self.name, scope
             )
 
+    @classmethod
+    def from_instance_uuid(cls, instance_uuid, template=None, timeout=3600):
+        """
+        Get an existing virtual machine by its vcenter instance uuid, without
+        searching the inventory by name
+        :param instance_uuid: The vcenter instance uuid
+        :param template: The virtual machine template name
+        :param timeout: The timeout for the tasks
+
+        :return: The VirtualMachine
+
+        :raise: NoObjectFound: If no results are found
+        """
+        return cls._from_vm_object(
+            get_virtual_machine_by_uuid(connection(), instance_uuid),
+            template,
+            timeout
+        )
+
+    @classmethod
+    def from_vm_id(cls, vm_id, template=None, timeout=3600):
+        """
+        Get an existing virtual machine by its vcenter ID, without searching
+        the inventory by name
+        :param vm_id: The vcenter ID as returned by vm_id() i.e: vm-4856
+        :param template: The virtual machine template name
+        :param timeout: The timeout for the tasks
+
+        :return: The VirtualMachine
+        """
+        return cls._from_vm_object(
+            get_vcenter_object_by_id(
+                connection(), vim.VirtualMachine, vm_id
+            ),
+            template,
+            timeout
+        )
+
+    @classmethod
+    def _from_vm_object(cls, vm_object, template, timeout):
+        """
+        Build a VirtualMachine bound to a vcenter vm object
+        :param vm_object: The vcenter vm object
+        :param template: The virtual machine template name
+        :param timeout: The timeout for the tasks
+
+        :return: The VirtualMachine
+        """
+        machine = cls(name=vm_object.name, template=template, timeout=timeout)
+        machine._vm_object = vm_object
+        return machine
+
     def refresh(self):
-        """ Close session and create a new session """
+        """
+        Renew the session if it expired and keep the vm object bound to it
+        by its ID, without searching the inventory
+        """
         if self._vm_object:
-            close()
-            # Refresh object with updated data (connection id changed)
-            self._vm_object = get_vcenter_object_by_name(
-                connection(), vim.VirtualMachine, self.name
+            conn = renew()
+            if self._vm_object._stub is not conn._stub:
+                # The object belongs to a connection that was closed
+                self._vm_object = get_vcenter_object_by_id(
+                    conn, vim.VirtualMachine, self._vm_object._moId
                 )
+            self._power_state = None
 
     def destroy(self):
         """ Destroy the virtual machine and set the vm object to None """
@@ -137,18 +335,42 @@ class VirtualMachine(object):
                 self.timeout
             )
             self._vm_object = None
+            self._ssh_manifests.clear()
+            self._winrm_scripts.clear()
+            self._power_state = None
+            if self._ip_pool is not None:
+                _release_ip(self._ip_pool, self._static_ip)
+            self._static_ip = None
+            self._ip_pool = None
+
+    def power_state(self, refresh=False):
+        """
+        Get the power state of the virtual machine. It is pushed by the
+        inventory mirror when one is running, otherwise the last known state
+        is kept and vcenter is only asked when it is unknown
+        :param refresh: Ask vcenter even if the state is known, to see the
+            changes made outside this object
+
+        :return: "poweredOn", "poweredOff", "suspended" or None
+        """
+        if self._vm_object:
+            if (
+                refresh or self._power_state is None or
+                inventory_mirror() is not None
+            ):
+                self._power_state = self._read_property('runtime.powerState')
+            return self._power_state
 
     def power_on(self):
         """ Power on the virtual machine """
-        if self._vm_object:
-            try:
-                wait_for_vcenter_task(
-                    self._vm_object.PowerOnVM_Task(),
-                    'Power on virtual machine "{}"'.format(self.name),
-                    self.timeout
-                )
-            except vim.fault.InvalidPowerState:
-                pass
+        if self._vm_object and not self._skip_power_task(
+                lambda state: state == 'poweredOn'
+        ):
+            self._run_power_task(
+                self._vm_object.PowerOnVM_Task,
+                'Power on virtual machine "{}"'.format(self.name),
+                'poweredOn'
+            )
 
     def power_off(self, delay_by=None):
         """
@@ -159,14 +381,14 @@ class VirtualMachine(object):
         """
         if self._vm_object:
             if delay_by is None:
-                try:
-                    wait_for_vcenter_task(
-                        self._vm_object.PowerOffVM_Task(),
+                if not self._skip_power_task(
+                        lambda state: state == 'poweredOff'
+                ):
+                    self._run_power_task(
+                        self._vm_object.PowerOffVM_Task,
                         'Power off virtual machine "{}"'.format(self.name),
-                        self.timeout
+                        'poweredOff'
                     )
-                except vim.fault.InvalidPowerState:
-                    pass
             else:
                 self._schedule_vcenter_task_on_vm(
                     vim.VirtualMachine.PowerOff,
@@ -178,15 +400,14 @@ class VirtualMachine(object):
 
     def reset(self):
         """ Reset the virtual machine """
-        if self._vm_object:
-            try:
-                wait_for_vcenter_task(
-                    self._vm_object.ResetVM_Task(),
-                    'Reset virtual machine "{}"'.format(self.name),
-                    self.timeout
-                )
-            except vim.fault.InvalidPowerState:
-                pass
+        if self._vm_object and not self._skip_power_task(
+                lambda state: state == 'poweredOff'
+        ):
+            self._run_power_task(
+                self._vm_object.ResetVM_Task,
+                'Reset virtual machine "{}"'.format(self.name),
+                'poweredOn'
+            )
 
     def reboot(self):
         """
@@ -194,7 +415,7 @@ class VirtualMachine(object):
         Need Vmware tools installed in the virtual machine
         """
         if self._vm_object:
-            if self._vm_object.summary.runtime.powerState == 'poweredOn':
+            if self.power_state() == 'poweredOn':
                 self._wait_for_vmware_tools()
                 self._vm_object.RebootGuest()
 
@@ -204,23 +425,28 @@ class VirtualMachine(object):
         Need Vmware tools installed in the virtual machine
         """
         if self._vm_object:
-            if self._vm_object.summary.runtime.powerState == 'poweredOn':
+            if self.power_state() == 'poweredOn':
                 self._wait_for_vmware_tools()
                 self._vm_object.ShutdownGuest()
+                # The guest powers off on its own time
+                self._power_state = None
 
     def ip(self):
         """
-        Poll vcenter to get the virtual machine IP
+        Poll vcenter to get the virtual machine IP, unless it was given a
+        static IP at creation
 
         :return: Return the ip
         """
         if self._vm_object:
-            if not self._vm_object.summary.guest.ipAddress:
+            if self._static_ip:
+                return self._static_ip
+            if not self._summary_property('guest.ipAddress'):
                 timeout_loop(
                     self.timeout, 'Get IP', 1, False,
-                    lambda: self._vm_object.summary.guest.ipAddress
+                    self._summary_property, 'guest.ipAddress'
                 )
-            ip = self._vm_object.summary.guest.ipAddress
+            ip = self._summary_property('guest.ipAddress')
             validate_ip(ip)
             return ip
 
@@ -247,9 +473,7 @@ class VirtualMachine(object):
         :return: The datetime object
         """
         # TODO: https://www.virtuallyghetto.com/2018/04/vm-creation-date-now-available-in-vsphere-6-7.html # noqa
-        return datetime.datetime.strptime(
-            self._vm_object.config.changeVersion, '%Y-%m-%dT%H:%M:%S.%fZ'
-        )
+        return _parse_change_version(self._vm_object.config.changeVersion)
 
     @configurable([
         ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_username'),
@@ -289,6 +513,68 @@ class VirtualMachine(object):
                     raise SshError(command, result.return_code, result.stdout)
                 return result
 
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_password')
+    ])
+    def ssh_lines(
+            self, command, use_sudo=False, tail_lines=100, spool_path=None,
+            **kwargs
+    ):
+        """
+        Executes a shell command through ssh, yielding its output while it
+        runs instead of buffering it
+        :param command: The command to be executed
+        :param use_sudo: If True, it runs as sudo (requires passwordless sudo)
+        :param tail_lines: The number of lines of each stream kept for the
+            SshError message
+        :param spool_path: A local file where the whole output is appended
+
+        :return: A generator of (stream, line) pairs, where stream is
+            "stdout" or "stderr" and the line has no line break
+
+        :raise: SshError: If the command fails, once the output is consumed
+        """
+        if self._vm_object:
+            self._wait_for_ssh_service(
+                kwargs['vcdriver_vm_ssh_username'],
+                kwargs['vcdriver_vm_ssh_password']
+            )
+            output = SshOutput(command, use_sudo)
+            # The fabric settings are global, so they are not held while the
+            # caller consumes the lines
+            with fabric_context(
+                    self.ip(),
+                    kwargs['vcdriver_vm_ssh_username'],
+                    kwargs['vcdriver_vm_ssh_password']
+            ):
+                output.open()
+            sink = OutputSink(tail_lines, spool_path)
+            try:
+                for stream, line in output:
+                    sink.write(stream, line)
+                    yield stream, line
+            finally:
+                sink.close()
+            if output.return_code != 0:
+                raise SshError(
+                    command, output.return_code,
+                    sink.tail(STDOUT), sink.tail(STDERR)
+                )
+
+    def ssh_stream(self, command, callback, **kwargs):
+        """
+        Executes a shell command through ssh, handing its output over to a
+        callback while it runs, see ssh_lines
+        :param command: The command to be executed
+        :param callback: A function of (stream, line)
+        :param kwargs: The ssh_lines keyword arguments
+
+        :raise: SshError: If the command fails
+        """
+        for stream, line in self.ssh_lines(command, **kwargs):
+            callback(stream, line)
+
     @configurable([
         ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_username'),
         ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_password')
@@ -299,6 +585,10 @@ class VirtualMachine(object):
             local_path,
             use_sudo=False,
             quiet=False,
+            archive=False,
+            compress=False,
+            sync=False,
+            resume=False,
             **kwargs
     ):
         """
@@ -307,11 +597,26 @@ class VirtualMachine(object):
         :param local_path: The local local
         :param use_sudo: If True, it runs as sudo
         :param quiet: Whether to hide the stdout/stderr output or not
+        :param archive: If True, the files are sent as a single tar stream
+            and unpacked inside the remote_path directory, which is much
+            faster for trees with many small files
+        :param compress: If True, the archive stream is gzip compressed
+        :param sync: If True, only the files whose content changed since the
+            last synced upload to the same remote_path are sent, as an
+            archive. The remote manifest is cached in this object and
+            discarded when the vm is destroyed or reverted
+        :param resume: If True, a single file is sent over one ssh channel,
+            continuing from the end of the remote file when it is a prefix
+            of the local one, e.g. after an interrupted upload. It cannot be
+            combined with archive or sync
 
         :return: The list of uploaded files
 
         :raise: UploadError: If the task fails
+        :raise: ValueError: If resume is combined with archive or sync
         """
+        if resume and (archive or sync):
+            raise ValueError('resume cannot be combined with archive or sync')
         if self._vm_object:
             self._wait_for_ssh_service(
                 kwargs['vcdriver_vm_ssh_username'],
@@ -322,7 +627,43 @@ class VirtualMachine(object):
                     kwargs['vcdriver_vm_ssh_username'],
                     kwargs['vcdriver_vm_ssh_password']
             ):
-                if quiet:
+                if sync:
+                    key = (remote_path, os.path.abspath(local_path))
+                    result = ssh_sync_upload(
+                        local_path, remote_path,
+                        self._ssh_manifests.pop(key, None), use_sudo, compress
+                    )
+                    if result.succeeded:
+                        self._ssh_manifests[key] = result.manifest
+                    if not quiet:
+                        print_throughput(
+                            'Sync upload "{}" to "{}" ({} changed)'.format(
+                                local_path, remote_path, len(result)
+                            ),
+                            result
+                        )
+                elif resume:
+                    result = ssh_resume_upload(
+                        local_path, remote_path, use_sudo
+                    )
+                    if not quiet:
+                        print_throughput(
+                            'Resumable upload "{}" to "{}" (from byte {})'
+                            .format(local_path, remote_path, result.offset),
+                            result
+                        )
+                elif archive:
+                    result = ssh_archive_upload(
+                        local_path, remote_path, use_sudo, compress
+                    )
+                    if not quiet:
+                        print_throughput(
+                            'Archive upload "{}" to "{}"'.format(
+                                local_path, remote_path
+                            ),
+                            result
+                        )
+                elif quiet:
                     with hide('everything'):
                         result = put(
                             local_path, remote_path, use_sudo=use_sudo
@@ -347,6 +688,8 @@ class VirtualMachine(object):
             local_path,
             use_sudo=False,
             quiet=False,
+            archive=False,
+            compress=False,
             **kwargs
     ):
         """
@@ -355,6 +698,10 @@ class VirtualMachine(object):
         :param local_path: The local local
         :param use_sudo: If True, it runs as sudo
         :param quiet: Whether to hide the stdout/stderr output or not
+        :param archive: If True, the files are received as a single tar
+            stream and unpacked inside the local_path directory, which is
+            much faster for trees with many small files
+        :param compress: If True, the archive stream is gzip compressed
 
         :return: The list of downloaded files
 
@@ -370,7 +717,18 @@ class VirtualMachine(object):
                     kwargs['vcdriver_vm_ssh_username'],
                     kwargs['vcdriver_vm_ssh_password']
             ):
-                if quiet:
+                if archive:
+                    result = ssh_archive_download(
+                        remote_path, local_path, use_sudo, compress
+                    )
+                    if not quiet:
+                        print_throughput(
+                            'Archive download "{}" to "{}"'.format(
+                                remote_path, local_path
+                            ),
+                            result
+                        )
+                elif quiet:
                     with hide('everything'):
                         result = get(
                             remote_path, local_path, use_sudo=use_sudo
@@ -414,16 +772,163 @@ class VirtualMachine(object):
             if not quiet:
                 print('Executing remotely on {} ...'.format(self.ip()))
                 styled_print(Style.DIM)(script)
-            status, stdout, stderr = self._run_winrm_ps(winrm_session, script)
-            if not quiet:
-                styled_print(Style.BRIGHT)('CODE: {}'.format(status))
-                styled_print(Fore.GREEN)(stdout)
-            if status != 0:
-                if not quiet:
-                    styled_print(Fore.RED)(stderr)
-                raise WinRmError(script, status, stdout, stderr)
+            return self._check_winrm_result(
+                script,
+                self._run_winrm_ps(winrm_session, script),
+                quiet
+            )
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_password')
+    ])
+    def winrm_script(
+            self, script, parameters=None, winrm_kwargs=dict(), quiet=False,
+            **kwargs
+    ):
+        """
+        Executes a remote windows powershell script cached on the guest. The
+        first run uploads it to a file named after its SHA256 digest (unless
+        the guest already has it), the next ones only send its path
+        :param script: A string with the powershell script
+        :param parameters: A list of positional arguments or a dictionary of
+            named parameters for the script
+        :param winrm_kwargs: The pywinrm Protocol class kwargs
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: A tuple with the status code, the stdout and the stderr
+
+        :raise: WinRmError: If the command fails
+        """
+        if self._vm_object:
+            self._wait_for_winrm_service(
+                kwargs['vcdriver_vm_winrm_username'],
+                kwargs['vcdriver_vm_winrm_password'],
+                **winrm_kwargs
+            )
+            winrm_session = self._open_winrm_session(
+                kwargs['vcdriver_vm_winrm_username'],
+                kwargs['vcdriver_vm_winrm_password'],
+                winrm_kwargs
+            )
+            # The BOM makes windows powershell read the file as utf-8
+            content = codecs.BOM_UTF8 + script.encode('utf-8')
+            digest = hashlib.sha256(content).hexdigest()
+            remote_path = '$env:TEMP\\vcdriver-{}.ps1'.format(digest)
+            missing = 'vcdriver: missing script {}'.format(digest)
+            if isinstance(parameters, dict):
+                arguments = ''.join(
+                    ' -{} {}'.format(name, powershell_quote(value))
+                    for name, value in sorted(parameters.items())
+                )
             else:
-                return status, stdout, stderr
+                arguments = ''.join(
+                    ' {}'.format(powershell_quote(value))
+                    for value in parameters or ()
+                )
+            # Run as a script block, which the execution policy of the guest
+            # does not apply to, failing like winrm when the script throws
+            # or its last command fails
+            invocation = (
+                'if (Test-Path -LiteralPath "{0}") {{ '
+                '$global:LASTEXITCODE = 0; try {{ & ([ScriptBlock]::Create('
+                '[IO.File]::ReadAllText("{0}"))){1}; $ok = $? }} catch {{ '
+                'Write-Error $_; exit 1 }}; if ($LASTEXITCODE) {{ '
+                'exit $LASTEXITCODE }}; if (-not $ok) {{ exit 1 }}; exit 0 '
+                '}} else {{ Write-Output "{2}"; exit 1 }}'.format(
+                    remote_path, arguments, missing
+                )
+            )
+            if not quiet:
+                print('Executing remotely on {} ...'.format(self.ip()))
+                styled_print(Style.DIM)(invocation)
+            if digest not in self._winrm_scripts:
+                self._winrm_cache_script(
+                    winrm_session, remote_path, content, digest
+                )
+            result = self._run_winrm_ps(winrm_session, invocation)
+            if result[0] != 0 and result[1].strip() == missing:
+                # Removed from the guest since it was cached
+                self._winrm_cache_script(
+                    winrm_session, remote_path, content, digest
+                )
+                result = self._run_winrm_ps(winrm_session, invocation)
+            return self._check_winrm_result(invocation, result, quiet)
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_password')
+    ])
+    def winrm_chunks(
+            self, script, winrm_kwargs=dict(), encoding='utf-8',
+            tail_chunks=100, spool_path=None, cancel=None, timeout=None,
+            tail_size=64 * 1024, **kwargs
+    ):
+        """
+        Executes a remote windows powershell script, yielding its output as
+        it arrives instead of buffering it
+        :param script: A string with the powershell script
+        :param winrm_kwargs: The pywinrm Protocol class kwargs
+        :param encoding: The encoding of the guest output
+        :param tail_chunks: The number of chunks of each stream kept for the
+            WinRmError message
+        :param spool_path: A local file where the whole output is appended
+        :param cancel: An event (e.g. threading.Event) that terminates the
+            script when set, noticed within WINRM_RECEIVE_TIMEOUT seconds.
+            Closing the generator terminates it too
+        :param timeout: If given, the seconds after which the script is
+            terminated, noticed within WINRM_RECEIVE_TIMEOUT seconds
+        :param tail_size: The maximum number of characters of each stream
+            kept for the WinRmError message
+
+        :return: A generator of (stream, text) pairs, where stream is
+            "stdout" or "stderr"
+
+        :raise: WinRmError: If the script fails, once the output is consumed
+        :raise: TimeoutError: If the script runs longer than the timeout
+        """
+        if self._vm_object:
+            self._wait_for_winrm_service(
+                kwargs['vcdriver_vm_winrm_username'],
+                kwargs['vcdriver_vm_winrm_password'],
+                **winrm_kwargs
+            )
+            winrm_session = self._open_winrm_session(
+                kwargs['vcdriver_vm_winrm_username'],
+                kwargs['vcdriver_vm_winrm_password'],
+                winrm_kwargs,
+                WINRM_RECEIVE_TIMEOUT
+            )
+            sink = OutputSink(
+                tail_chunks, spool_path, separator=u'', tail_size=tail_size
+            )
+            output = WinRmOutput(
+                winrm_session, script, encoding, cancel, timeout
+            )
+            try:
+                for stream, text in output:
+                    sink.write(stream, text)
+                    yield stream, text
+            finally:
+                sink.close()
+            if not output.cancelled and output.return_code != 0:
+                raise WinRmError(
+                    script, output.return_code,
+                    sink.tail(STDOUT), sink.tail(STDERR)
+                )
+
+    def winrm_stream(self, script, callback, **kwargs):
+        """
+        Executes a remote windows powershell script, handing its output over
+        to a callback as it arrives, see winrm_chunks
+        :param script: A string with the powershell script
+        :param callback: A function of (stream, text)
+        :param kwargs: The winrm_chunks keyword arguments
+
+        :raise: WinRmError: If the script fails
+        """
+        for stream, text in self.winrm_chunks(script, **kwargs):
+            callback(stream, text)
 
     @configurable([
         ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_username'),
@@ -436,6 +941,9 @@ class VirtualMachine(object):
             step=1024,
             winrm_kwargs=dict(),
             quiet=False,
+            compress=False,
+            parallel=None,
+            resume=False,
             **kwargs
     ):
         """
@@ -445,91 +953,356 @@ class VirtualMachine(object):
         :param step: Number of bytes to send in each chunk
         :param winrm_kwargs: The pywinrm Protocol class kwargs
         :param quiet: Whether to hide the stdout/stderr output or not
-
-        :return: A tuple with the status code, the stdout and the stderr
+        :param compress: If True, the file is gzip compressed locally and
+            decompressed on the guest. It falls back to a plain copy when
+            compression does not save at least 10%
+        :param parallel: If given, the number of WinRM shells writing the
+            chunks concurrently at their offsets of a preallocated remote
+            file, which is then verified with its SHA256. Each shell runs a
+            single powershell process fed through its standard input, in
+            chunks of at least 128 KiB
+        :param resume: If True, the plain copy continues from the end of the
+            remote file when it is a prefix of the local one, e.g. after an
+            interrupted upload, instead of starting over. It cannot be
+            combined with compress or parallel
+
+        :return: A TransferResult in parallel mode, None otherwise
+
+        :raise: WinRmError: If a remote command fails
+        :raise: UploadError: If the parallel upload does not match the file
+        :raise: ValueError: If resume is combined with compress or parallel
         """
+        if resume and (compress or parallel):
+            raise ValueError(
+                'resume cannot be combined with compress or parallel'
+            )
         if self._vm_object:
+            if parallel:
+                return self._winrm_upload_parallel(
+                    kwargs['vcdriver_vm_winrm_username'],
+                    kwargs['vcdriver_vm_winrm_password'],
+                    winrm_kwargs, remote_path, local_path, step, parallel,
+                    quiet
+                )
             winrm_session = self._open_winrm_session(
                 kwargs['vcdriver_vm_winrm_username'],
                 kwargs['vcdriver_vm_winrm_password'],
                 winrm_kwargs
             )
-            self._run_winrm_ps(
-                winrm_session,
-                'if (Test-Path -path {0}) {{ Remove-Item -path {0} }}'.format(
-                    remote_path)
+            if compress:
+                compressed_path = gzip_file(local_path)
+                try:
+                    if (
+                        os.stat(compressed_path).st_size <
+                        os.stat(local_path).st_size * 0.9
+                    ):
+                        self._winrm_upload_gzip(
+                            winrm_session, remote_path, compressed_path,
+                            step, quiet
+                        )
+                        return
+                finally:
+                    os.remove(compressed_path)
+            self._winrm_upload_chunks(
+                winrm_session, remote_path, local_path, step, quiet,
+                self._winrm_resume_offset(
+                    winrm_session, remote_path, local_path
+                ) if resume else 0
             )
-            size = os.stat(local_path).st_size
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_password')
+    ])
+    def winrm_download(
+            self,
+            remote_path,
+            local_path,
+            step=1024 * 1024,
+            winrm_kwargs=dict(),
+            quiet=False,
+            **kwargs
+    ):
+        """
+        Copy a file from the virtual machine through winrm. The file is read
+        in chunks through a single remote shell and written to disk as they
+        arrive, so the memory used does not depend on the file size
+        :param remote_path: The remote location
+        :param local_path: The local location
+        :param step: Number of bytes to read in each chunk
+        :param winrm_kwargs: The pywinrm Protocol class kwargs
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: The SHA256 hex digest of the file
+
+        :raise: WinRmError: If a remote command fails
+        :raise: DownloadError: If the downloaded file does not match the
+            remote one
+        """
+        if self._vm_object:
+            winrm_session = self._open_winrm_session(
+                kwargs['vcdriver_vm_winrm_username'],
+                kwargs['vcdriver_vm_winrm_password'],
+                winrm_kwargs
+            )
+            path = powershell_quote(remote_path)
+            digest = hashlib.sha256()
             start = time.time()
-            with open(local_path, 'rb') as f:
-                for i in range(0, size, step):
-                    script = (
-                        'add-content -value '
-                        '$([System.Convert]::FromBase64String("{}")) '
-                        '-encoding byte -path {}'.format(
-                            base64.b64encode(f.read(step)).decode(),
-                            remote_path
+            with winrm_shell(winrm_session) as run_ps:
+
+                def run_or_fail(script):
+                    code, stdout, stderr = run_ps(script)
+                    if time.time() - start >= self.timeout:
+                        raise TimeoutError(
+                            'WinRM download file transfer', self.timeout
                         )
-                    )
-                    while True:
-                        code, stdout, stderr = self._run_winrm_ps(
-                            winrm_session, script
+                    if code != 0:
+                        raise WinRmError(
+                            script, code, stdout.decode('ascii', 'replace'),
+                            stderr.decode('ascii', 'replace')
                         )
-                        if time.time() - start >= self.timeout:
-                            raise TimeoutError(
-                                'WinRM upload file transfer', self.timeout
+                    return stdout.decode('ascii').strip()
+
+                size = int(run_or_fail(
+                    '(Get-Item -LiteralPath {}).Length'.format(path)
+                ))
+                transferred = 0
+                with open(local_path, 'wb') as f:
+                    while transferred < size:
+                        chunk = base64.b64decode(run_or_fail(
+                            '$f = [System.IO.File]::Open({}, "Open", "Read", '
+                            '"ReadWrite"); try {{ $f.Seek({}, "Begin") | '
+                            'Out-Null; $b = New-Object byte[] {}; '
+                            '$n = $f.Read($b, 0, $b.Length); '
+                            '[Console]::Out.Write('
+                            '[System.Convert]::ToBase64String($b, 0, $n)) '
+                            '}} finally {{ $f.Close() }}'.format(
+                                path, transferred, step
                             )
-                        if code == 0:
+                        ))
+                        if not chunk:
                             break
-                        elif code == 1 and 'used by another process' in stderr:
-                            # Small delay so previous write can settle down
-                            time.sleep(0.1)
-                        else:
-                            raise WinRmError(script, code, stdout, stderr)
-                    if not quiet:
-                        transferred = i + step
-                        if transferred > size:
-                            transferred = size
-                        progress_blocks = transferred * 30 // size
-                        percentage_string = str(
-                            (100 * transferred) // size
-                        ) + ' %'
-                        percentage_string = (
-                            ' ' * (5 - len(percentage_string)) +
-                            percentage_string
-                        )
-                        print(
-                            '\r{} ... [{}{}] {}'.format(
+                        f.write(chunk)
+                        digest.update(chunk)
+                        transferred += len(chunk)
+                        if not quiet:
+                            print_progress(
                                 'Copying "{}" to "{}"'.format(
-                                    local_path, remote_path
+                                    remote_path, local_path
                                 ),
-                                '=' * progress_blocks,
-                                ' ' * (30 - progress_blocks),
-                                percentage_string
-                            ),
-                            end=''
-                        )
-                        sys.stdout.flush()
-            if not quiet:
+                                transferred,
+                                size
+                            )
+                remote_digest = run_or_fail(_remote_sha256_script(path))
+            if not quiet and size:
                 print('')
+            if remote_digest.upper() != digest.hexdigest().upper():
+                raise DownloadError(
+                    local_path=local_path, remote_path=remote_path
+                )
+            return digest.hexdigest()
 
-    def find_snapshot(self, name):
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_password')
+    ])
+    def guest_upload(
+            self,
+            remote_path,
+            local_path,
+            overwrite=True,
+            quiet=False,
+            **kwargs
+    ):
         """
-        Find a snapshot by name
-        :param name: The name of the snapshot
+        Copy a file through the vmware tools guest operations. The file is
+        streamed from disk in a single http request and the guest does not
+        need any network service nor an IP
+        :param remote_path: The remote location
+        :param local_path: The local location
+        :param overwrite: Whether to replace an existing remote file or not
+        :param quiet: Whether to hide the stdout/stderr output or not
 
-        :return: The given snapshot
+        :return: A TransferResult with the remote path
 
-        :raise: TooManyObjectsFound: If more than one object is found
-        :raise: NoObjectFound: If no results are found
+        :raise: UploadError: If the transfer fails
         """
         if self._vm_object:
-            if self._vm_object.snapshot is not None:
-                found_snapshots = self._get_snapshots_by_name(
-                    self._vm_object.snapshot.rootSnapshotList, name
-                )
-            else:
-                found_snapshots = []
+            self._wait_for_vmware_tools()
+            size = os.stat(local_path).st_size
+            start = time.time()
+            url = self._guest_file_manager().InitiateFileTransferToGuest(
+                self._vm_object,
+                self._guest_auth(
+                    kwargs['vcdriver_vm_guest_username'],
+                    kwargs['vcdriver_vm_guest_password']
+                ),
+                remote_path,
+                vim.vm.guest.FileManager.FileAttributes(),
+                size,
+                overwrite
+            )
+            with open(local_path, 'rb') as f:
+                response = requests.put(
+                    self._guest_transfer_url(url),
+                    data=f,
+                    headers={'Content-Length': str(size)},
+                    verify=False,
+                    timeout=self.timeout
+                )
+            if response.status_code != 200:
+                raise UploadError(
+                    local_path=local_path, remote_path=remote_path
+                )
+            result = TransferResult(
+                [remote_path], size=size, seconds=time.time() - start
+            )
+            if not quiet:
+                print_throughput(
+                    'Guest upload "{}" to "{}"'.format(
+                        local_path, remote_path
+                    ),
+                    result
+                )
+            return result
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_password')
+    ])
+    def guest_download(
+            self, remote_path, local_path, step=1024 * 1024, quiet=False,
+            **kwargs
+    ):
+        """
+        Copy a file from the virtual machine through the vmware tools guest
+        operations, streaming it to disk
+        :param remote_path: The remote location
+        :param local_path: The local location
+        :param step: Number of bytes written to disk at once
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: A TransferResult with the local path
+
+        :raise: DownloadError: If the transfer fails
+        """
+        if self._vm_object:
+            self._wait_for_vmware_tools()
+            start = time.time()
+            info = self._guest_file_manager().InitiateFileTransferFromGuest(
+                self._vm_object,
+                self._guest_auth(
+                    kwargs['vcdriver_vm_guest_username'],
+                    kwargs['vcdriver_vm_guest_password']
+                ),
+                remote_path
+            )
+            response = requests.get(
+                self._guest_transfer_url(info.url),
+                stream=True,
+                verify=False,
+                timeout=self.timeout
+            )
+            size = 0
+            with contextlib.closing(response):
+                if response.status_code != 200:
+                    raise DownloadError(
+                        local_path=local_path, remote_path=remote_path
+                    )
+                with open(local_path, 'wb') as f:
+                    for chunk in response.iter_content(step):
+                        f.write(chunk)
+                        size += len(chunk)
+            if size != info.size:
+                raise DownloadError(
+                    local_path=local_path, remote_path=remote_path
+                )
+            result = TransferResult(
+                [local_path], size=size, seconds=time.time() - start
+            )
+            if not quiet:
+                print_throughput(
+                    'Guest download "{}" to "{}"'.format(
+                        remote_path, local_path
+                    ),
+                    result
+                )
+            return result
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_password')
+    ])
+    def guest_run(
+            self, program, arguments='', working_directory=None, **kwargs
+    ):
+        """
+        Run a program in the guest through the vmware tools guest operations
+        and wait for it. The output is not captured, redirect it to a file
+        and use guest_download to read it
+        :param program: The absolute path of the program in the guest
+        :param arguments: The program arguments
+        :param working_directory: The working directory in the guest
+
+        :return: The exit code
+
+        :raise: GuestOperationError: If the program exits with non zero code
+        """
+        if self._vm_object:
+            self._wait_for_vmware_tools()
+            auth = self._guest_auth(
+                kwargs['vcdriver_vm_guest_username'],
+                kwargs['vcdriver_vm_guest_password']
+            )
+            process_manager = (
+                connection().content.guestOperationsManager.processManager
+            )
+            pid = process_manager.StartProgramInGuest(
+                self._vm_object,
+                auth,
+                vim.vm.guest.ProcessManager.ProgramSpec(
+                    programPath=program,
+                    arguments=arguments,
+                    workingDirectory=working_directory
+                )
+            )
+
+            def process_info():
+                return process_manager.ListProcessesInGuest(
+                    self._vm_object, auth, [pid]
+                )[0]
+
+            timeout_loop(
+                self.timeout,
+                'Guest program "{} {}"'.format(program, arguments),
+                1,
+                True,
+                lambda: process_info().endTime is not None
+            )
+            code = process_info().exitCode
+            if code != 0:
+                raise GuestOperationError(
+                    '{} {}'.format(program, arguments), code
+                )
+            return code
+
+    def find_snapshot(self, name):
+        """
+        Find a snapshot by name
+        :param name: The name of the snapshot
+
+        :return: The given snapshot
+
+        :raise: TooManyObjectsFound: If more than one object is found
+        :raise: NoObjectFound: If no results are found
+        """
+        if self._vm_object:
+            if self._vm_object.snapshot is not None:
+                found_snapshots = self._get_snapshots_by_name(
+                    self._vm_object.snapshot.rootSnapshotList, name
+                )
+            else:
+                found_snapshots = []
             if len(found_snapshots) > 1:
                 raise TooManyObjectsFound(vim.vm.Snapshot, name)
             elif len(found_snapshots) == 0:
@@ -567,6 +1340,9 @@ class VirtualMachine(object):
                 'Restoring snapshot "{}" on "{}"'.format(name, self.name),
                 self.timeout
             )
+            self._ssh_manifests.clear()
+            self._winrm_scripts.clear()
+            self._power_state = None
 
     def remove_snapshot(self, name, remove_children=False):
         """
@@ -620,51 +1396,492 @@ class VirtualMachine(object):
             )
         )
 
-    def _open_winrm_session(self, username, password, winrm_kwargs):
+    def _open_winrm_session(
+            self, username, password, winrm_kwargs, operation_timeout=None
+    ):
         """
         Open a WinRM session
         :param username: The winrm username
         :param password: The winrm password
         :param winrm_kwargs: The pywinrm Protocol class kwargs
+        :param operation_timeout: Seconds each operation waits on the server,
+            by default the virtual machine timeout
 
         :return: Return the winrm session
         """
+        operation_timeout = operation_timeout or self.timeout
         return winrm.Session(
             target=self.ip(),
             auth=(username, password),
-            read_timeout_sec=self.timeout + 1,
-            operation_timeout_sec=self.timeout,
+            read_timeout_sec=operation_timeout + 1,
+            operation_timeout_sec=operation_timeout,
             **winrm_kwargs
         )
 
+    def _check_winrm_result(self, script, result, quiet):
+        """
+        Print the result of a powershell script and check its status
+        :param script: The powershell script
+        :param result: A tuple with the status code, the stdout and the stderr
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: The result
+
+        :raise: WinRmError: If the script failed
+        """
+        status, stdout, stderr = result
+        if not quiet:
+            styled_print(Style.BRIGHT)('CODE: {}'.format(status))
+            styled_print(Fore.GREEN)(stdout)
+        if status != 0:
+            if not quiet:
+                styled_print(Fore.RED)(stderr)
+            raise WinRmError(script, status, stdout, stderr)
+        return result
+
+    def _winrm_cache_script(self, winrm_session, remote_path, content, digest):
+        """
+        Make sure the guest has a cached script, uploading it only when the
+        remote file is missing or has a different digest. The upload goes to
+        a unique temporary file, moved into place once its digest matches,
+        so concurrent or interrupted uploads never leave a partial script
+        :param winrm_session: The WinRM session
+        :param remote_path: The remote location
+        :param content: The script file content, as bytes
+        :param digest: The SHA256 hex digest of the content
+
+        :raise: UploadError: If the uploaded script does not match the digest
+        """
+        code, stdout, _ = self._run_winrm_ps(
+            winrm_session,
+            'if (Test-Path -LiteralPath "{0}") {{ $f = [System.IO.File]::'
+            'OpenRead("{0}"); try {{ [BitConverter]::ToString([Security.'
+            'Cryptography.SHA256]::Create().ComputeHash($f)).Replace("-", '
+            '"") }} finally {{ $f.Close() }} }}'.format(remote_path)
+        )
+        if code != 0 or stdout.strip().lower() != digest:
+            temporary_path = '{}.{}.tmp'.format(remote_path, uuid.uuid4().hex)
+            fd, local_path = tempfile.mkstemp(suffix='.ps1')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                # Keeps each command under the 8191 characters limit of the
+                # remote command line once encoded
+                self._winrm_upload_chunks(
+                    winrm_session, temporary_path, local_path, 2048, True
+                )
+            finally:
+                os.remove(local_path)
+            code, stdout, _ = self._run_winrm_ps(
+                winrm_session,
+                '$h = & {{ {0} }}; if ($h -eq "{1}") {{ Move-Item '
+                '-LiteralPath "{2}" -Destination "{3}" -Force }} else {{ '
+                'Remove-Item -LiteralPath "{2}" }}; $h'.format(
+                    _remote_sha256_script('"{}"'.format(temporary_path)),
+                    digest, temporary_path, remote_path
+                )
+            )
+            if code != 0 or stdout.strip().lower() != digest:
+                raise UploadError(
+                    local_path=local_path, remote_path=remote_path
+                )
+        self._winrm_scripts.add(digest)
+
+    def _winrm_resume_offset(self, winrm_session, remote_path, local_path):
+        """
+        Find where an interrupted upload can continue from
+        :param winrm_session: The WinRM session
+        :param remote_path: The remote location
+        :param local_path: The local location
+
+        :return: The size of the remote file if the local file starts with
+            the same content, 0 otherwise
+        """
+        code, stdout, _ = self._run_winrm_ps(
+            winrm_session,
+            '$i = Get-Item -path {} -ErrorAction SilentlyContinue; if ($i) '
+            '{{ $i.Length; {} }}'.format(
+                remote_path, _remote_sha256_script('$i.FullName')
+            )
+        )
+        lines = stdout.split()
+        if code == 0 and len(lines) == 2:
+            length = int(lines[0])
+            if file_prefix_digest(local_path, length) == lines[1].lower():
+                return length
+        return 0
+
+    def _winrm_upload_chunks(
+            self, winrm_session, remote_path, local_path, step, quiet,
+            offset=0
+    ):
+        """
+        Replace a remote file with the local one, appending it in chunks
+        :param winrm_session: The WinRM session
+        :param remote_path: The remote location
+        :param local_path: The local location
+        :param step: Number of bytes to send in each chunk
+        :param quiet: Whether to hide the progress or not
+        :param offset: If given, the remote file already has the local
+            content up to this offset and it is appended from there
+        """
+        if not offset:
+            self._run_winrm_ps(
+                winrm_session,
+                'if (Test-Path -path {0}) {{ Remove-Item -path {0} }}'.format(
+                    remote_path)
+            )
+        size = os.stat(local_path).st_size
+        start = time.time()
+        prefix = 'add-content -value $([System.Convert]::FromBase64String("'
+        suffix = '")) -encoding byte -path {}'.format(remote_path)
+        for chunk_offset, chunk_size, data in base64_chunks(
+                local_path, step, offset
+        ):
+            script = ''.join((prefix, data, suffix))
+            while True:
+                code, stdout, stderr = self._run_winrm_ps(
+                    winrm_session, script
+                )
+                if time.time() - start >= self.timeout:
+                    raise TimeoutError(
+                        'WinRM upload file transfer', self.timeout
+                    )
+                if code == 0:
+                    break
+                elif code == 1 and 'used by another process' in stderr:
+                    # Small delay so previous write can settle down
+                    time.sleep(0.1)
+                else:
+                    raise WinRmError(script, code, stdout, stderr)
+            if not quiet:
+                print_progress(
+                    'Copying "{}" to "{}"'.format(local_path, remote_path),
+                    chunk_offset + chunk_size,
+                    size
+                )
+        if not quiet:
+            print('')
+
+    def _winrm_upload_parallel(
+            self, username, password, winrm_kwargs, remote_path, local_path,
+            step, parallel, quiet
+    ):
+        """
+        Replace a remote file with the local one, writing its chunks at their
+        offsets through several WinRM shells at once
+        :param username: The winrm username
+        :param password: The winrm password
+        :param winrm_kwargs: The pywinrm Protocol class kwargs
+        :param remote_path: The remote location
+        :param local_path: The local location
+        :param step: Number of bytes to send in each chunk, raised to
+            _WINRM_STDIN_STEP
+        :param parallel: The number of WinRM shells
+        :param quiet: Whether to hide the progress or not
+
+        :return: The TransferResult
+
+        :raise: WinRmError: If a remote command fails
+        :raise: UploadError: If the remote file does not match the local one
+        :raise: TimeoutError: If the chunks are not sent within the timeout
+        """
+        path = powershell_quote(remote_path)
+        size = os.stat(local_path).st_size
+        start = time.time()
+        winrm_session = self._open_winrm_session(
+            username, password, winrm_kwargs
+        )
+        script = (
+            '$f = [System.IO.File]::Open({}, "Create", "Write", '
+            '"ReadWrite"); try {{ $f.SetLength({}) }} finally {{ '
+            '$f.Close() }}'.format(path, size)
+        )
+        code, stdout, stderr = self._run_winrm_ps(winrm_session, script)
+        if code != 0:
+            raise WinRmError(script, code, stdout, stderr)
+        step = max(step, _WINRM_STDIN_STEP)
+        chunks = base64_chunks(local_path, step)
+        lock = threading.Lock()
+        errors = []
+        progress = {'transferred': 0}
+        # Each line of the standard input is an offset and a base64 chunk
+        writer = (
+            '$f = [System.IO.File]::Open({}, "Open", "Write", "ReadWrite"); '
+            'try {{ while ($null -ne ($l = [Console]::In.ReadLine())) {{ '
+            '$o, $d = $l.Split(" "); '
+            '$b = [System.Convert]::FromBase64String($d); '
+            '$f.Seek([long]$o, "Begin") | Out-Null; '
+            '$f.Write($b, 0, $b.Length) }} }} finally {{ $f.Close() }}'
+            .format(path)
+        )
+
+        def next_chunk():
+            with lock:
+                if time.time() - start >= self.timeout:
+                    raise TimeoutError(
+                        'WinRM upload file transfer', self.timeout
+                    )
+                return next(chunks, None)
+
+        def write_chunks():
+            try:
+                with winrm_stdin_script(self._open_winrm_session(
+                        username, password, winrm_kwargs
+                ), writer) as send:
+                    for offset, chunk_size, data in iter(next_chunk, None):
+                        send('{} {}\r\n'.format(offset, data).encode('ascii'))
+                        with lock:
+                            progress['transferred'] += chunk_size
+                            if not quiet:
+                                print_progress(
+                                    'Copying "{}" to "{}"'.format(
+                                        local_path, remote_path
+                                    ),
+                                    progress['transferred'],
+                                    size
+                                )
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                    # The other writers stop at their next chunk
+                    chunks.close()
+
+        workers = [
+            threading.Thread(target=write_chunks)
+            for _ in range(min(parallel, -(-size // step)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        chunks.close()
+        if errors:
+            raise errors[0]
+        if not quiet and size:
+            print('')
+        code, stdout, stderr = self._run_winrm_ps(
+            winrm_session, _remote_sha256_script(path)
+        )
+        if code != 0 or stdout.strip().lower() != file_prefix_digest(
+                local_path, size
+        ):
+            raise UploadError(local_path=local_path, remote_path=remote_path)
+        return TransferResult([remote_path], size=size, seconds=(
+            time.time() - start
+        ))
+
+    def _winrm_upload_gzip(
+            self, winrm_session, remote_path, compressed_path, step, quiet
+    ):
+        """
+        Upload a gzip file next to the remote location and decompress it
+        :param winrm_session: The WinRM session
+        :param remote_path: The remote location of the decompressed file
+        :param compressed_path: The local gzip file
+        :param step: Number of bytes to send in each chunk
+        :param quiet: Whether to hide the progress or not
+
+        :raise: WinRmError: If the decompression fails
+        """
+        archive_path = '{}.gz'.format(remote_path)
+        self._winrm_upload_chunks(
+            winrm_session, archive_path, compressed_path, step, quiet
+        )
+        script = (
+            '$i = [System.IO.File]::OpenRead({0}); '
+            '$o = [System.IO.File]::Create({1}); '
+            '$z = New-Object System.IO.Compression.GZipStream('
+            '$i, [System.IO.Compression.CompressionMode]::Decompress); '
+            'try {{ $z.CopyTo($o) }} '
+            'finally {{ $z.Close(); $o.Close(); $i.Close() }}; '
+            'Remove-Item -LiteralPath {0}'.format(
+                powershell_quote(archive_path), powershell_quote(remote_path)
+            )
+        )
+        code, stdout, stderr = self._run_winrm_ps(winrm_session, script)
+        if code != 0:
+            raise WinRmError(script, code, stdout, stderr)
+
+    @staticmethod
+    def _guest_auth(username, password):
+        """
+        Build the guest operations credentials
+        :param username: The guest username
+        :param password: The guest password
+
+        :return: The vcenter guest authentication object
+        """
+        return vim.vm.guest.NamePasswordAuthentication(
+            username=username, password=password
+        )
+
+    @staticmethod
+    def _guest_file_manager():
+        """ Return the vcenter guest operations file manager """
+        return connection().content.guestOperationsManager.fileManager
+
+    @staticmethod
+    def _guest_transfer_url(url):
+        """
+        Resolve the guest transfer url, where the host might be "*" meaning
+        the host the session is connected to
+        :param url: The url returned by the guest file manager
+
+        :return: The url to use
+        """
+        host = connection()._stub.host.rsplit(':', 1)[0]
+        return url.replace('://*', '://{}'.format(host), 1)
+
     def _wait_for_ssh_service(self, username, password):
         """
-        Wait until ssh service is ready
+        Wait until ssh service is ready, logging in only once the port
+        accepts connections
         :param username: SSH username
         :param password: SSH password
+
+        :return: The ReadinessResult
         """
-        timeout_loop(
-            self.timeout, 'Check SSH service', 1, True,
-            check_ssh_service, self.ip(), username, password
+        ip = self.ip()
+        return wait_for_service(
+            ip, SSH_PORT,
+            functools.partial(check_ssh_service, ip, username, password),
+            'Check SSH service', self.timeout
         )
 
     def _wait_for_winrm_service(self, username, password, **kwargs):
         """
-        Wait until winrm service is ready
+        Wait until winrm service is ready, opening a session only once the
+        port accepts connections
         :param username: WinRM username
         :param password: WinRM password
         :param kwargs: pywinrm Protocol kwargs
+
+        :return: The ReadinessResult
         """
-        timeout_loop(
-            self.timeout, 'Check WinRM service', 1, True,
-            check_winrm_service, self.ip(), username, password, **kwargs
+        ip = self.ip()
+        # pywinrm defaults to https when the transport is ssl
+        port = WINRM_SSL_PORT if kwargs.get('transport') == 'ssl' else (
+            WINRM_PORT
         )
+        return wait_for_service(
+            ip, port,
+            functools.partial(
+                check_winrm_service, ip, username, password, **kwargs
+            ),
+            'Check WinRM service', self.timeout
+        )
+
+    def _summary_property(self, path):
+        """
+        Read a property of the vm summary, from memory when an inventory
+        mirror is running
+        :param path: The property path e.g. "runtime.powerState"
+
+        :return: The property value
+        """
+        mirror = inventory_mirror()
+        if mirror is not None:
+            try:
+                return mirror.get_property(self._vm_object, path)
+            except KeyError:
+                pass
+        return functools.reduce(
+            getattr, path.split('.'), self._vm_object.summary
+        )
+
+    def _read_property(self, path):
+        """
+        Read a property alone, from memory when an inventory mirror is
+        running, instead of the whole summary
+        :param path: The property path e.g. "runtime.powerState"
+
+        :return: The property value
+        """
+        mirror = inventory_mirror()
+        if mirror is not None:
+            try:
+                return mirror.get_property(self._vm_object, path)
+            except KeyError:
+                pass
+        return get_vcenter_property(self._vm_object, path)
+
+    def _allocate_ip(self, ip_source):
+        """
+        Get a static IP for the virtual machine
+        :param ip_source: The address, an iterator over the addresses or a
+            callable that gets this VirtualMachine
+
+        :return: A tuple with the IP and the pool it was taken from, if any
+
+        :raise: IpPoolExhausted: If the iterator has no addresses left
+        :raise: IpError: If the IP is not a valid IPv4 address
+        :raise: TypeError: If the source is an iterable but not an iterator
+        """
+        ip_pool = None
+        if callable(ip_source):
+            ip = ip_source(self)
+        elif isinstance(ip_source, six.string_types):
+            ip = ip_source
+        else:
+            if not hasattr(ip_source, '__iter__') or (
+                    iter(ip_source) is not ip_source
+            ):
+                raise TypeError(
+                    'Invalid type for ip_source. Expected an address, a '
+                    'callable or an iterator, e.g. iter(addresses) to share '
+                    'a list of addresses as a pool.'
+                )
+            with _ip_pool_lock:
+                released = _released_ips.get(ip_source)
+                if released:
+                    ip = released.pop(0)
+                    if not released:
+                        del _released_ips[ip_source]
+                else:
+                    ip = next(ip_source, None)
+            if ip is None:
+                raise IpPoolExhausted()
+            ip_pool = ip_source
+        if not validate_ipv4(ip):
+            raise IpError(ip)
+        return ip, ip_pool
+
+    def _skip_power_task(self, no_op):
+        """
+        Check whether a power task would be a no-op, counting it as skipped.
+        The power state alone is read again (from the mirror, if running) as
+        the guest might have changed it on its own e.g. "sudo poweroff": one
+        round trip instead of a task and its polling
+        :param no_op: A function of the power state, true when the task
+            would not change anything
+
+        :return: Whether the task can be skipped
+        """
+        if no_op(self.power_state(refresh=True)):
+            self.skipped_tasks += 1
+            return True
+        return False
+
+    def _run_power_task(self, task, task_description, power_state):
+        """
+        Run a power task and remember the resulting power state
+        :param task: The vcenter vm method that starts the task
+        :param task_description: The task description
+        :param power_state: The power state after the task
+        """
+        try:
+            wait_for_vcenter_task(task(), task_description, self.timeout)
+            self._power_state = power_state
+        except vim.fault.InvalidPowerState:
+            # The known state was stale
+            self._power_state = None
 
     def _wait_for_vmware_tools(self):
         """ Wait until vmware tools is ready """
         timeout_loop(
             self.timeout, 'Vmware tools readiness', 1, False,
-            lambda: self._vm_object.summary.guest.toolsRunningStatus ==
+            lambda: self._summary_property('guest.toolsRunningStatus') ==
             'guestToolsRunning'
         )
 
@@ -733,6 +1950,68 @@ class VirtualMachine(object):
             self._vm_object, spec
         )
 
+    def __getstate__(self):
+        """
+        Pickle the virtual machine as a lightweight handle, so it can be sent
+        to other processes (e.g. multiprocessing workers): the vcenter vm
+        object is replaced by its ID and the vcenter host it belongs to
+
+        :return: The state
+        """
+        state = self.__dict__.copy()
+        # An unpickled handle not bound yet keeps its ID
+        if '_vm_object' in state:
+            vm_object = state.pop('_vm_object')
+            state['_vm_id'] = state['_vcenter_host'] = None
+            if vm_object:
+                state['_vm_id'] = vm_object._moId
+                state['_vcenter_host'] = vm_object._stub.host
+        # Another process may change the power state meanwhile
+        state['_power_state'] = None
+        # Only this process can give the static IP back to its pool
+        state['_ip_pool'] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled handle. The vm object is bound lazily, by its ID,
+        on first use, to the session of this process, which must be
+        connected to the same vcenter
+        :param state: The state returned by __getstate__
+        """
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        """
+        Bind the vm object of an unpickled handle on first access. The
+        handle keeps its ID until the binding succeeds, so a failed attempt
+        can be retried
+
+        :raise: VcenterMismatch: If the session of this process is connected
+            to another vcenter
+        """
+        if name != '_vm_object' or '_vm_id' not in self.__dict__:
+            raise AttributeError(name)
+        with _bind_lock:
+            if '_vm_id' not in self.__dict__:
+                # Bound by another thread meanwhile
+                return self.__dict__['_vm_object']
+            vm_id = self.__dict__['_vm_id']
+            vcenter_host = self.__dict__['_vcenter_host']
+            vm_object = None
+            if vm_id is not None:
+                conn = connection()
+                if conn._stub.host != vcenter_host:
+                    raise VcenterMismatch(
+                        self.name, vcenter_host, conn._stub.host
+                    )
+                vm_object = get_vcenter_object_by_id(
+                    conn, vim.VirtualMachine, vm_id
+                )
+            self.__dict__['_vm_object'] = vm_object
+            del self.__dict__['_vm_id'], self.__dict__['_vcenter_host']
+            return vm_object
+
     def __str__(self):
         return str(self.name)
 
@@ -770,6 +2049,251 @@ def snapshot(vm):
         vm.remove_snapshot(snapshot_name, False)
 
 
+def _remote_sha256_script(path):
+    """
+    :param path: The quoted remote path
+
+    :return: A powershell script printing the SHA256 hex digest of a file
+    """
+    return (
+        '$f = [System.IO.File]::Open({}, "Open", "Read", "ReadWrite"); '
+        'try {{ [BitConverter]::ToString([Security.Cryptography.SHA256]::'
+        'Create().ComputeHash($f)).Replace("-", "") }} finally {{ '
+        '$f.Close() }}'.format(path)
+    )
+
+
+def _release_ip(ip_pool, ip):
+    """
+    Give a static IP back to its pool, to be handed out again
+    :param ip_pool: The iterator the IP was taken from
+    :param ip: The IP
+    """
+    with _ip_pool_lock:
+        _released_ips.setdefault(ip_pool, []).append(ip)
+
+
+def _customization_spec(
+        ip, subnet_mask, gateway, dns_servers, hostname, domain, windows,
+        time_zone, full_name, org_name, admin_password
+):
+    """
+    Build the guest customization that gives a static IP to the first network
+    adapter of a clone
+    :param ip: The static IPv4 address
+    :param subnet_mask: The subnet mask
+    :param gateway: The default gateway, if any
+    :param dns_servers: The list of DNS servers
+    :param hostname: The guest hostname
+    :param domain: The guest domain
+    :param windows: Whether to use sysprep instead of the linux customization
+    :param time_zone: The sysprep time zone index
+    :param full_name: The sysprep user full name
+    :param org_name: The sysprep organization
+    :param admin_password: The sysprep administrator password, if any
+
+    :return: The vcenter customization specification
+    """
+    computer_name = vim.vm.customization.FixedName(name=hostname)
+    if windows:
+        password = None
+        if admin_password is not None:
+            password = vim.vm.customization.Password(
+                value=admin_password, plainText=True
+            )
+        identity = vim.vm.customization.Sysprep(
+            guiUnattended=vim.vm.customization.GuiUnattended(
+                autoLogon=False, autoLogonCount=0, timeZone=time_zone,
+                password=password
+            ),
+            userData=vim.vm.customization.UserData(
+                computerName=computer_name,
+                fullName=full_name,
+                orgName=org_name,
+                productId=''
+            ),
+            identification=vim.vm.customization.Identification(
+                joinWorkgroup='WORKGROUP'
+            )
+        )
+    else:
+        identity = vim.vm.customization.LinuxPrep(
+            hostName=computer_name, domain=domain
+        )
+    return vim.vm.customization.Specification(
+        identity=identity,
+        globalIPSettings=vim.vm.customization.GlobalIPSettings(
+            dnsServerList=list(dns_servers),
+            dnsSuffixList=[domain] if domain else []
+        ),
+        nicSettingMap=[vim.vm.customization.AdapterMapping(
+            adapter=vim.vm.customization.IPSettings(
+                ip=vim.vm.customization.FixedIp(ipAddress=ip),
+                subnetMask=subnet_mask,
+                gateway=[gateway] if gateway else [],
+                dnsServerList=list(dns_servers)
+            )
+        )]
+    )
+
+
+def _parse_change_version(change_version):
+    """
+    :param change_version: The config.changeVersion of a virtual machine
+
+    :return: The datetime object (UTC)
+    """
+    return datetime.datetime.strptime(
+        change_version, '%Y-%m-%dT%H:%M:%S.%fZ'
+    )
+
+
+def _creation_time(create_date, change_version):
+    """
+    :param create_date: The config.createDate of a virtual machine, only set
+        from vsphere 6.7 onwards
+    :param change_version: The config.changeVersion, used by created_at
+
+    :return: The creation time as a naive UTC datetime, None if unknown
+    """
+    if create_date is not None:
+        offset = create_date.utcoffset()
+        return (create_date - offset if offset else create_date).replace(
+            tzinfo=None
+        )
+    if change_version:
+        try:
+            return _parse_change_version(change_version)
+        except ValueError:
+            # changeVersion is opaque, older hosts do not set a timestamp
+            pass
+    return None
+
+
+def _datacenter(vm_object, parents):
+    """
+    Find the datacenter of a virtual machine
+    :param vm_object: The vcenter virtual machine object
+    :param parents: The parents of the inventory, see get_vcenter_parents
+
+    :return: The vcenter datacenter object, None if it is not inside one
+    """
+    parent = parents.get(vm_object)
+    while parent is not None and not isinstance(parent, vim.Datacenter):
+        parent = parents.get(parent)
+    return parent
+
+
+def _power_fault(fault):
+    """ Being already in the requested power state is not a failure """
+    if isinstance(fault, vim.fault.InvalidPowerState):
+        return None
+    return fault
+
+
+def power_on_virtual_machines(vms, timeout=None):
+    """
+    Power on several virtual machines with one vcenter task per datacenter,
+    letting DRS place them
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param timeout: The timeout, in seconds. By default the highest timeout
+        of the virtual machines
+
+    :return: An ordered dictionary of VirtualMachine -> None if it is
+        powered on, or the vcenter fault that prevented it
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    start = time.time()
+    results = collections.OrderedDict()
+    by_datacenter = collections.OrderedDict()
+    vm_tasks = []
+    parents = get_vcenter_parents(
+        [vm._vm_object for vm in vms if vm._vm_object]
+    )
+    for vm in vms:
+        if vm._vm_object:
+            results[vm] = None
+            datacenter = _datacenter(vm._vm_object, parents)
+            if datacenter is None:
+                # No datacenter to power it on with the others
+                vm_tasks.append((vm, vm._vm_object.PowerOnVM_Task()))
+            else:
+                by_datacenter.setdefault(datacenter, []).append(vm)
+    if not results:
+        return results
+    if timeout is None:
+        timeout = max(vm.timeout for vm in results)
+    option = [vim.option.OptionValue(
+        key='OverrideAutomationLevel',
+        value=vim.cluster.DrsConfigInfo.DrsBehavior.fullyAutomated
+    )]
+    power_on_results = wait_for_vcenter_tasks(
+        [
+            datacenter.PowerOnMultiVM_Task(
+                vm=[vm._vm_object for vm in datacenter_vms], option=option
+            )
+            for datacenter, datacenter_vms in by_datacenter.items()
+        ],
+        'Power on {} virtual machines'.format(len(results)),
+        timeout
+    ) if by_datacenter else []
+    for datacenter_vms, power_on_result in zip(
+            by_datacenter.values(), power_on_results
+    ):
+        machines = dict((vm._vm_object, vm) for vm in datacenter_vms)
+        if isinstance(power_on_result, vim.cluster.PowerOnVmResult):
+            for attempted in power_on_result.attempted:
+                if attempted.task is not None:
+                    vm_tasks.append((machines[attempted.vm], attempted.task))
+            for not_attempted in power_on_result.notAttempted:
+                results[machines[not_attempted.vm]] = _power_fault(
+                    not_attempted.fault
+                )
+        else:
+            for vm in datacenter_vms:
+                results[vm] = _power_fault(power_on_result)
+    if vm_tasks:
+        # Both waits share the timeout
+        faults = wait_for_vcenter_tasks(
+            [task for _, task in vm_tasks],
+            'Power on tasks of {} virtual machines'.format(len(vm_tasks)),
+            max(timeout - (time.time() - start), 0)
+        )
+        for (vm, _), fault in zip(vm_tasks, faults):
+            results[vm] = _power_fault(fault)
+    for vm, fault in results.items():
+        vm._power_state = 'poweredOn' if fault is None else None
+    return results
+
+
+def power_off_virtual_machines(vms, timeout=None):
+    """
+    Power off several virtual machines, starting all the vcenter tasks at
+    once and waiting for them together
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param timeout: The timeout, in seconds. By default the highest timeout
+        of the virtual machines
+
+    :return: An ordered dictionary of VirtualMachine -> None if it is
+        powered off, or the vcenter fault that prevented it
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    found = [vm for vm in vms if vm._vm_object]
+    results = collections.OrderedDict((vm, None) for vm in found)
+    if found:
+        faults = wait_for_vcenter_tasks(
+            [vm._vm_object.PowerOffVM_Task() for vm in found],
+            'Power off {} virtual machines'.format(len(found)),
+            max(vm.timeout for vm in found) if timeout is None else timeout
+        )
+        for vm, fault in zip(found, faults):
+            results[vm] = _power_fault(fault)
+            vm._power_state = 'poweredOff' if results[vm] is None else None
+    return results
+
+
 def get_all_virtual_machines():
     """
     Get all the virtual machines from your Vcenter Instance.
@@ -777,22 +2301,214 @@ def get_all_virtual_machines():
 
     :return: A list with all the VirtualMachine objects
     """
-
-    def process(vm_object):
-        try:
-            name = vm_object.summary.config.name
-        except vim.ManagedObjectNotFound:
-            return None
-
+    conn = connection()
+    mirror = inventory_mirror(conn)
+    if mirror is not None and mirror.mirrors(vim.VirtualMachine):
+        # The objects and their names are read at once, so the machines
+        # deleted meanwhile are not listed
+        names = [
+            (vm_object, values[0])
+            for vm_object, values in mirror.get_all_properties(
+                vim.VirtualMachine, ['name']
+            )
+        ]
+    else:
+        names = []
+        for vm_object in get_all_vcenter_objects(conn, vim.VirtualMachine):
+            try:
+                names.append((vm_object, vm_object.summary.config.name))
+            except vim.ManagedObjectNotFound:
+                pass
+    machines = []
+    for vm_object, name in names:
         machine = VirtualMachine(name=name)
         machine._vm_object = vm_object
+        machines.append(machine)
+    return machines
+
+
+class _VirtualMachineRecord(object):
+    """ The methods of the records yielded by iter_virtual_machines """
+    __slots__ = ()
+
+    def virtual_machine(self, template=None, timeout=3600):
+        """
+        Build the VirtualMachine of the record, bound to its vm object
+        :param template: The virtual machine template name
+        :param timeout: The timeout for the tasks
+
+        :return: The VirtualMachine
+        """
+        machine = VirtualMachine(
+            name=getattr(self, 'name', None) or self.vm_object.name,
+            template=template,
+            timeout=timeout
+        )
+        machine._vm_object = self.vm_object
         return machine
 
-    return [
-        machine
-        for vm_object in get_all_vcenter_objects(
-            connection(), vim.VirtualMachine
+
+# The record types already built, by their property paths
+_record_types = {}
+
+
+def _virtual_machine_record_type(properties):
+    """
+    Get the record type for some virtual machine properties: a namedtuple
+    with the vm object and a field per property, named after its path with
+    underscores instead of dots e.g. "runtime_powerState"
+    :param properties: The tuple of property paths
+
+    :return: The record type
+    """
+    record_type = _record_types.get(properties)
+    if record_type is None:
+        fields = ['vm_object'] + [
+            str(path.replace('.', '_')) for path in properties
+        ]
+        record_type = _record_types[properties] = type(
+            'VirtualMachineRecord',
+            (
+                collections.namedtuple('VirtualMachineRecord', fields),
+                _VirtualMachineRecord
+            ),
+            {'__slots__': ()}
+        )
+    return record_type
+
+
+def iter_virtual_machines(properties=('name',), scope=None, page_size=1000):
+    """
+    Iterate all the virtual machines from your Vcenter Instance as compact
+    records holding only the requested properties. They are retrieved in
+    pages with the property collector, so the first records arrive before the
+    whole inventory is read and the memory does not grow with it
+    :param properties: The property paths of each record e.g.
+        ("name", "runtime.powerState", "guest.ipAddress")
+    :param scope: A folder, datacenter or cluster to limit the search to,
+        by default the whole inventory
+    :param page_size: The maximum number of virtual machines retrieved at once
+
+    :return: A generator of namedtuples with the vm object and the properties
+        (see _virtual_machine_record_type), whose virtual_machine() method
+        builds the VirtualMachine
+    """
+    properties = tuple(properties)
+    record_type = _virtual_machine_record_type(properties)
+    for vm_object, values in iter_vcenter_properties(
+            connection(), vim.VirtualMachine, properties, scope, page_size
+    ):
+        yield record_type(vm_object, *values)
+
+
+def query_virtual_machines(
+        name=None,
+        scope=None,
+        power_state=None,
+        created_after=None,
+        created_before=None,
+        custom_values=None,
+        predicate=None,
+        properties=(),
+        page_size=1000,
+        template=None
+):
+    """
+    Find the virtual machines matching some filters. Only the properties the
+    filters need are retrieved, in bulk with iter_virtual_machines, and the
+    filters are evaluated locally in a single pass e.g. all the powered on
+    machines named "ci-*" created more than 6 hours ago:
+        query_virtual_machines(
+            name='ci-*',
+            power_state='poweredOn',
+            created_before=datetime.datetime.utcnow() - datetime.timedelta(
+                hours=6
+            )
+        )
+    :param name: A glob pattern matching the whole name, or a compiled
+        regular expression searched in the name
+    :param scope: A folder, datacenter or cluster (or the name of a folder) to
+        limit the search to, by default the whole inventory
+    :param power_state: A power state or an iterable of power states e.g.
+        "poweredOn"
+    :param created_after: A UTC datetime, only newer machines match. The
+        creation time is config.createDate, or config.changeVersion (like
+        created_at) when the vsphere version does not set it
+    :param created_before: A UTC datetime, only older machines match
+    :param custom_values: A dictionary of custom attribute name -> value that
+        the machines must have
+    :param predicate: A function that gets each record and returns whether
+        the machine matches, for anything else
+    :param properties: Other property paths to retrieve, e.g. for the
+        predicate
+    :param page_size: The number of machines retrieved per round trip
+    :param template: If False, the templates never match, if True only the
+        templates match, by default both do
+
+    :return: A generator of records, as yielded by iter_virtual_machines,
+        with the name, the properties needed by the filters and the given
+        properties
+    """
+    paths = ['name']
+    if power_state is not None:
+        if isinstance(power_state, six.string_types):
+            power_state = [power_state]
+        power_state = frozenset(power_state)
+        paths.append('runtime.powerState')
+    by_creation = created_after is not None or created_before is not None
+    if by_creation:
+        paths.extend(['config.createDate', 'config.changeVersion'])
+    if custom_values:
+        paths.append('customValue')
+        field_names = dict(
+            (field.key, field.name)
+            for field in connection().content.customFieldsManager.field or ()
         )
-        for machine in (process(vm_object),)
-        if machine is not None
-    ]
+    if template is not None:
+        paths.append('config.template')
+    for path in properties:
+        if path not in paths:
+            paths.append(path)
+    if name is None or hasattr(name, 'search'):
+        name_matches = name and name.search
+    else:
+        name_matches = re.compile(fnmatch.translate(name)).match
+    if isinstance(scope, six.string_types):
+        scope = get_vcenter_object_by_name(connection(), vim.Folder, scope)
+
+    def matches(record):
+        if name_matches and not name_matches(record.name):
+            return False
+        if power_state is not None and (
+                record.runtime_powerState not in power_state
+        ):
+            return False
+        if by_creation:
+            created = _creation_time(
+                record.config_createDate, record.config_changeVersion
+            )
+            if created is None:
+                return False
+            if (created_after is not None and created <= created_after) or (
+                    created_before is not None and created >= created_before
+            ):
+                return False
+        if custom_values:
+            values = dict(
+                (field_names.get(value.key), value.value)
+                for value in record.customValue or ()
+            )
+            if any(
+                    values.get(key) != value
+                    for key, value in custom_values.items()
+            ):
+                return False
+        if template is not None and (
+                bool(record.config_template) != template
+        ):
+            return False
+        return predicate is None or predicate(record)
+
+    for record in iter_virtual_machines(paths, scope, page_size):
+        if record.name is not None and matches(record):
+            yield record